@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import argparse
+import time
+
+import numpy as np
+
+from openpilot.common.transformations.orientation import euler2quat, quat2euler, quat2rot, rot2quat, euler2rot, rot2euler, numpy_wrap
+from openpilot.common.transformations.transformations import (euler2quat_single, quat2euler_single, quat2rot_single,
+                                                    rot2quat_single, euler2rot_single, rot2euler_single)
+
+# batched function, per row reference and input shape
+FUNCTIONS = {
+  "euler2quat": (euler2quat, numpy_wrap(euler2quat_single, (3,), (4,)), (3,)),
+  "quat2euler": (quat2euler, numpy_wrap(quat2euler_single, (4,), (3,)), (4,)),
+  "quat2rot": (quat2rot, numpy_wrap(quat2rot_single, (4,), (3, 3)), (4,)),
+  "rot2quat": (rot2quat, numpy_wrap(rot2quat_single, (3, 3), (4,)), (3, 3)),
+  "euler2rot": (euler2rot, numpy_wrap(euler2rot_single, (3,), (3, 3)), (3,)),
+  "rot2euler": (rot2euler, numpy_wrap(rot2euler_single, (3, 3), (3,)), (3, 3)),
+}
+
+
+def make_inputs(shape: tuple[int, ...], n: int) -> np.ndarray:
+  rng = np.random.default_rng(0)
+  eulers = rng.uniform(-np.pi, np.pi, (n, 3))
+  if shape == (3,):
+    return eulers
+  quats = euler2quat(eulers)
+  return quats if shape == (4,) else quat2rot(quats)
+
+
+def timeit(fn, inp: np.ndarray) -> float:
+  t = time.perf_counter()
+  fn(inp)
+  return time.perf_counter() - t
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Compare batched orientation transforms to the per row Cython loop",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("-n", type=int, default=100_000, help="Number of poses per call")
+  parser.add_argument("--functions", nargs="*", default=list(FUNCTIONS), help="Functions to benchmark")
+  args = parser.parse_args()
+
+  print(f"{'function':<12} {'batched ms':>12} {'per row ms':>12} {'speedup':>8}")
+  for name in args.functions:
+    batch_fn, row_fn, shape = FUNCTIONS[name]
+    inp = make_inputs(shape, args.n)
+    batch_time = min(timeit(batch_fn, inp) for _ in range(5))
+    row_time = timeit(row_fn, inp)
+    print(f"{name:<12} {batch_time * 1e3:>12.2f} {row_time * 1e3:>12.2f} {row_time / batch_time:>7.0f}x")
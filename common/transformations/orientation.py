@@ -2,13 +2,7 @@ import numpy as np
 from collections.abc import Callable
 
 from openpilot.common.transformations.transformations import (ecef_euler_from_ned_single,
-                                                    euler2quat_single,
-                                                    euler2rot_single,
-                                                    ned_euler_from_ecef_single,
-                                                    quat2euler_single,
-                                                    quat2rot_single,
-                                                    rot2euler_single,
-                                                    rot2quat_single)
+                                                    ned_euler_from_ecef_single)
 
 
 def numpy_wrap(function, input_shape, output_shape) -> Callable[..., np.ndarray]:
@@ -33,12 +27,92 @@ def numpy_wrap(function, input_shape, output_shape) -> Callable[..., np.ndarray]
   return f
 
 
-euler2quat = numpy_wrap(euler2quat_single, (3,), (4,))
-quat2euler = numpy_wrap(quat2euler_single, (4,), (3,))
-quat2rot = numpy_wrap(quat2rot_single, (4,), (3, 3))
-rot2quat = numpy_wrap(rot2quat_single, (3, 3), (4,))
-euler2rot = numpy_wrap(euler2rot_single, (3,), (3, 3))
-rot2euler = numpy_wrap(rot2euler_single, (3, 3), (3,))
+# The functions below take either a single input or an array of inputs in the leading dimensions, and
+# follow the Eigen implementations in orientation.cc, so they agree with the *_single functions up to rounding
+
+def _ensure_unique(quat: np.ndarray) -> np.ndarray:
+  return np.where(quat[..., :1] > 0, quat, -quat)
+
+
+def euler2quat(eulers) -> np.ndarray:
+  eulers = np.asarray(eulers, dtype=np.float64)
+  cx, sx = np.cos(eulers[..., 0] / 2), np.sin(eulers[..., 0] / 2)
+  cy, sy = np.cos(eulers[..., 1] / 2), np.sin(eulers[..., 1] / 2)
+  cz, sz = np.cos(eulers[..., 2] / 2), np.sin(eulers[..., 2] / 2)
+
+  # AngleAxis(z) * AngleAxis(y) * AngleAxis(x)
+  quats = np.stack([cz * cy * cx + sz * sy * sx,
+                    cz * cy * sx - sz * sy * cx,
+                    cz * sy * cx + sz * cy * sx,
+                    sz * cy * cx - cz * sy * sx], axis=-1)
+  return _ensure_unique(quats)
+
+
+def quat2euler(quats) -> np.ndarray:
+  quats = np.asarray(quats, dtype=np.float64)
+  w, x, y, z = quats[..., 0], quats[..., 1], quats[..., 2], quats[..., 3]
+  gamma = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+  theta = np.arcsin(np.clip(2 * (w * y - z * x), -1.0, 1.0))
+  psi = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+  return np.stack([gamma, theta, psi], axis=-1)
+
+
+def quat2rot(quats) -> np.ndarray:
+  quats = np.asarray(quats, dtype=np.float64)
+  w, x, y, z = quats[..., 0], quats[..., 1], quats[..., 2], quats[..., 3]
+  tx, ty, tz = 2 * x, 2 * y, 2 * z
+  twx, twy, twz = tx * w, ty * w, tz * w
+  txx, txy, txz = tx * x, ty * x, tz * x
+  tyy, tyz, tzz = ty * y, tz * y, tz * z
+
+  rots = np.stack([1 - (tyy + tzz), txy - twz, txz + twy,
+                   txy + twz, 1 - (txx + tzz), tyz - twx,
+                   txz - twy, tyz + twx, 1 - (txx + tyy)], axis=-1)
+  return rots.reshape(quats.shape[:-1] + (3, 3))
+
+
+def rot2quat(rots) -> np.ndarray:
+  rots = np.asarray(rots, dtype=np.float64)
+  shape = rots.shape[:-2]
+  rots = rots.reshape((-1, 3, 3))
+  quats = np.empty((rots.shape[0], 4))
+
+  # Shepperd's method as in Eigen: use the trace when it is positive, otherwise the largest diagonal element
+  trace = np.trace(rots, axis1=1, axis2=2)
+  pos = trace > 0
+  m = rots[pos]
+  t = np.sqrt(trace[pos] + 1)
+  quats[pos, 0] = 0.5 * t
+  t = 0.5 / t
+  quats[pos, 1] = (m[:, 2, 1] - m[:, 1, 2]) * t
+  quats[pos, 2] = (m[:, 0, 2] - m[:, 2, 0]) * t
+  quats[pos, 3] = (m[:, 1, 0] - m[:, 0, 1]) * t
+
+  diag = np.diagonal(rots, axis1=1, axis2=2)
+  largest = np.where(diag[:, 1] > diag[:, 0], 1, 0)
+  largest = np.where(diag[:, 2] > diag[np.arange(len(diag)), largest], 2, largest)
+  for i in range(3):
+    idx = ~pos & (largest == i)
+    j, k = (i + 1) % 3, (i + 2) % 3
+    m = rots[idx]
+    t = np.sqrt(m[:, i, i] - m[:, j, j] - m[:, k, k] + 1)
+    quats[idx, 1 + i] = 0.5 * t
+    t = 0.5 / t
+    quats[idx, 0] = (m[:, k, j] - m[:, j, k]) * t
+    quats[idx, 1 + j] = (m[:, j, i] + m[:, i, j]) * t
+    quats[idx, 1 + k] = (m[:, k, i] + m[:, i, k]) * t
+
+  return _ensure_unique(quats).reshape(shape + (4,))
+
+
+def euler2rot(eulers) -> np.ndarray:
+  return quat2rot(euler2quat(eulers))
+
+
+def rot2euler(rots) -> np.ndarray:
+  return quat2euler(rot2quat(rots))
+
+
 ecef_euler_from_ned = numpy_wrap(ecef_euler_from_ned_single, (3,), (3,))
 ned_euler_from_ecef = numpy_wrap(ned_euler_from_ecef_single, (3,), (3,))
 
@@ -6,6 +6,8 @@ import unittest
 from openpilot.common.transformations.orientation import euler2quat, quat2euler, euler2rot, rot2euler, \
                                                rot2quat, quat2rot, \
                                                ned_euler_from_ecef
+from openpilot.common.transformations.transformations import euler2quat_single, quat2euler_single, euler2rot_single, \
+                                                   rot2euler_single, rot2quat_single, quat2rot_single
 
 eulers = np.array([[ 1.46520501,  2.78688383,  2.92780854],
        [ 4.86909526,  3.60618161,  4.30648981],
@@ -57,6 +59,26 @@ class TestOrientation(unittest.TestCase):
       np.testing.assert_allclose(quat, rot2quat(quat2rot(list(quat))), rtol=1e-7)
     np.testing.assert_allclose(quats, rot2quat(quat2rot(quats)), rtol=1e-7)
 
+  def test_batch_matches_single(self):
+    rng = np.random.default_rng(0)
+    rand_eulers = rng.uniform(-np.pi, np.pi, (100, 3))
+    rand_quats = euler2quat(rand_eulers)
+    # rotations by pi about each axis hit every branch of rot2quat
+    rand_rots = np.concatenate([quat2rot(rand_quats), [np.diag([1., -1., -1.]), np.diag([-1., 1., -1.]), np.diag([-1., -1., 1.])]])
+
+    for batch_fn, single_fn, inps in [(euler2quat, euler2quat_single, rand_eulers),
+                                      (quat2euler, quat2euler_single, rand_quats),
+                                      (quat2rot, quat2rot_single, rand_quats),
+                                      (euler2rot, euler2rot_single, rand_eulers),
+                                      (rot2quat, rot2quat_single, rand_rots),
+                                      (rot2euler, rot2euler_single, rand_rots)]:
+      expected = np.array([single_fn(inp) for inp in inps])
+      np.testing.assert_allclose(expected, batch_fn(inps), rtol=1e-12, atol=1e-15)
+      np.testing.assert_allclose(expected[0], batch_fn(inps[0]), rtol=1e-12, atol=1e-15)
+      # any number of leading dimensions
+      np.testing.assert_allclose(expected[:4].reshape((2, 2) + expected.shape[1:]),
+                                 batch_fn(inps[:4].reshape((2, 2) + inps.shape[1:])), rtol=1e-12, atol=1e-15)
+
   def test_euler_ned(self):
     for i in range(len(eulers)):
       np.testing.assert_allclose(ned_eulers[i], ned_euler_from_ecef(ecef_positions[i], eulers[i]), rtol=1e-7)
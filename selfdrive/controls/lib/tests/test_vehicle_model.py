@@ -64,6 +64,27 @@ class TestVehicleModel(unittest.TestCase):
 
           np.testing.assert_almost_equal(x1, x2, decimal=3)
 
+  def test_batched_matches_scalar(self):
+    """Verifies that passing arrays gives the same results as looping over the scalar functions"""
+    u, sa, roll = np.meshgrid(np.linspace(0, 30, num=16), np.linspace(math.radians(-20), math.radians(20), num=11),
+                              np.linspace(math.radians(-20), math.radians(20), num=11), indexing="ij")
+    u, sa, roll = u.flatten(), sa.flatten(), roll.flatten()
+    samples = list(zip(sa, u, roll, strict=True))
+
+    # scalar functions use pow, batched ones use multiplication, which can differ in the last bit
+    np.testing.assert_allclose(self.VM.steady_state_sol(sa, u, roll), [self.VM.steady_state_sol(*x) for x in samples], rtol=1e-12, atol=0)
+    np.testing.assert_allclose(self.VM.calc_curvature(sa, u, roll), [self.VM.calc_curvature(*x) for x in samples], rtol=1e-12, atol=0)
+
+    curv = self.VM.calc_curvature(sa, u, roll)
+    moving = u > 0
+    np.testing.assert_allclose(self.VM.get_steer_from_curvature(curv[moving], u[moving], roll[moving]), sa[moving], atol=1e-12)
+
+    A, B = create_dyn_state_matrices(u[moving], self.VM)
+    for i, speed in enumerate(u[moving]):
+      A_i, B_i = create_dyn_state_matrices(speed, self.VM)
+      np.testing.assert_array_equal(A[i], A_i)
+      np.testing.assert_array_equal(B[i], B_i)
+
 
 
 if __name__ == "__main__":
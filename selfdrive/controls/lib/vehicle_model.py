@@ -11,6 +11,9 @@ The system is defined by
 x_dot = A*x + B*u
 
 A depends on longitudinal speed, u [m/s], and vehicle parameters CP
+
+All functions also accept NumPy arrays of sa, u and roll, which are broadcast
+against each other. Steady state solutions then have shape (..., 2, 1).
 """
 
 import numpy as np
@@ -45,7 +48,7 @@ class VehicleModel:
     self.cR: float = stiffness_factor * self.cR_orig
     self.sR: float = steer_ratio
 
-  def steady_state_sol(self, sa: float, u: float, roll: float) -> np.ndarray:
+  def steady_state_sol(self, sa: float | np.ndarray, u: float | np.ndarray, roll: float | np.ndarray) -> np.ndarray:
     """Returns the steady state solution.
 
     If the speed is too low we can't use the dynamic model (tire slip is undefined),
@@ -59,12 +62,20 @@ class VehicleModel:
     Returns:
       2x1 matrix with steady state solution (lateral speed, rotational speed)
     """
-    if u > 0.1:
-      return dyn_ss_sol(sa, u, roll, self)
-    else:
-      return kin_ss_sol(sa, u, self)
-
-  def calc_curvature(self, sa: float, u: float, roll: float) -> float:
+    if np.ndim(sa) == np.ndim(u) == np.ndim(roll) == 0:
+      if u > 0.1:
+        return dyn_ss_sol(sa, u, roll, self)
+      else:
+        return kin_ss_sol(sa, u, self)
+
+    sa, u, roll = np.broadcast_arrays(sa, u, roll)
+    dyn = u > 0.1
+    sol = np.empty(u.shape + (2, 1))
+    sol[dyn] = dyn_ss_sol(sa[dyn], u[dyn], roll[dyn], self)
+    sol[~dyn] = kin_ss_sol(sa[~dyn], u[~dyn], self)
+    return sol
+
+  def calc_curvature(self, sa: float | np.ndarray, u: float | np.ndarray, roll: float | np.ndarray) -> float | np.ndarray:
     """Returns the curvature. Multiplied by the speed this will give the yaw rate.
 
     Args:
@@ -77,7 +88,7 @@ class VehicleModel:
     """
     return (self.curvature_factor(u) * sa / self.sR) + self.roll_compensation(roll, u)
 
-  def curvature_factor(self, u: float) -> float:
+  def curvature_factor(self, u: float | np.ndarray) -> float | np.ndarray:
     """Returns the curvature factor.
     Multiplied by wheel angle (not steering wheel angle) this will give the curvature.
 
@@ -90,7 +101,7 @@ class VehicleModel:
     sf = calc_slip_factor(self)
     return (1. - self.chi) / (1. - sf * u**2) / self.l
 
-  def get_steer_from_curvature(self, curv: float, u: float, roll: float) -> float:
+  def get_steer_from_curvature(self, curv: float | np.ndarray, u: float | np.ndarray, roll: float | np.ndarray) -> float | np.ndarray:
     """Calculates the required steering wheel angle for a given curvature
 
     Args:
@@ -104,7 +115,7 @@ class VehicleModel:
 
     return (curv - self.roll_compensation(roll, u)) * self.sR * 1.0 / self.curvature_factor(u)
 
-  def roll_compensation(self, roll: float, u: float) -> float:
+  def roll_compensation(self, roll: float | np.ndarray, u: float | np.ndarray) -> float | np.ndarray:
     """Calculates the roll-compensation to curvature
 
     Args:
@@ -117,11 +128,11 @@ class VehicleModel:
     sf = calc_slip_factor(self)
 
     if abs(sf) < 1e-6:
-      return 0
+      return np.zeros(np.broadcast(roll, u).shape) if np.ndim(roll) or np.ndim(u) else 0
     else:
       return (ACCELERATION_DUE_TO_GRAVITY * roll) / ((1 / sf) - u**2)
 
-  def get_steer_from_yaw_rate(self, yaw_rate: float, u: float, roll: float) -> float:
+  def get_steer_from_yaw_rate(self, yaw_rate: float | np.ndarray, u: float | np.ndarray, roll: float | np.ndarray) -> float | np.ndarray:
     """Calculates the required steering wheel angle for a given yaw_rate
 
     Args:
@@ -135,7 +146,7 @@ class VehicleModel:
     curv = yaw_rate / u
     return self.get_steer_from_curvature(curv, u, roll)
 
-  def yaw_rate(self, sa: float, u: float, roll: float) -> float:
+  def yaw_rate(self, sa: float | np.ndarray, u: float | np.ndarray, roll: float | np.ndarray) -> float | np.ndarray:
     """Calculate yaw rate
 
     Args:
@@ -149,7 +160,7 @@ class VehicleModel:
     return self.calc_curvature(sa, u, roll) * u
 
 
-def kin_ss_sol(sa: float, u: float, VM: VehicleModel) -> np.ndarray:
+def kin_ss_sol(sa: float | np.ndarray, u: float | np.ndarray, VM: VehicleModel) -> np.ndarray:
   """Calculate the steady state solution at low speeds
   At low speeds the tire slip is undefined, so a kinematic
   model is used.
@@ -162,13 +173,14 @@ def kin_ss_sol(sa: float, u: float, VM: VehicleModel) -> np.ndarray:
   Returns:
     2x1 matrix with steady state solution
   """
-  K = np.zeros((2, 1))
-  K[0, 0] = VM.aR / VM.sR / VM.l * u
-  K[1, 0] = 1. / VM.sR / VM.l * u
-  return K * sa
+  sa, u = np.broadcast_arrays(sa, u)
+  K = np.zeros(u.shape + (2, 1))
+  K[..., 0, 0] = VM.aR / VM.sR / VM.l * u
+  K[..., 1, 0] = 1. / VM.sR / VM.l * u
+  return K * sa[..., None, None]
 
 
-def create_dyn_state_matrices(u: float, VM: VehicleModel) -> tuple[np.ndarray, np.ndarray]:
+def create_dyn_state_matrices(u: float | np.ndarray, VM: VehicleModel) -> tuple[np.ndarray, np.ndarray]:
   """Returns the A and B matrix for the dynamics system
 
   Args:
@@ -176,7 +188,7 @@ def create_dyn_state_matrices(u: float, VM: VehicleModel) -> tuple[np.ndarray, n
     VM: Vehicle model
 
   Returns:
-    A tuple with the 2x2 A matrix, and 2x2 B matrix
+    A tuple with the 2x2 A matrix, and 2x2 B matrix, stacked with the shape of u for arrays
 
   Parameters in the vehicle model:
     cF: Tire stiffness Front [N/rad]
@@ -188,24 +200,25 @@ def create_dyn_state_matrices(u: float, VM: VehicleModel) -> tuple[np.ndarray, n
     sR: Steering ratio [-]
     chi: Steer ratio rear [-]
   """
-  A = np.zeros((2, 2))
-  B = np.zeros((2, 2))
-  A[0, 0] = - (VM.cF + VM.cR) / (VM.m * u)
-  A[0, 1] = - (VM.cF * VM.aF - VM.cR * VM.aR) / (VM.m * u) - u
-  A[1, 0] = - (VM.cF * VM.aF - VM.cR * VM.aR) / (VM.j * u)
-  A[1, 1] = - (VM.cF * VM.aF**2 + VM.cR * VM.aR**2) / (VM.j * u)
+  u = np.asarray(u, dtype=float)
+  A = np.zeros(u.shape + (2, 2))
+  B = np.zeros(u.shape + (2, 2))
+  A[..., 0, 0] = - (VM.cF + VM.cR) / (VM.m * u)
+  A[..., 0, 1] = - (VM.cF * VM.aF - VM.cR * VM.aR) / (VM.m * u) - u
+  A[..., 1, 0] = - (VM.cF * VM.aF - VM.cR * VM.aR) / (VM.j * u)
+  A[..., 1, 1] = - (VM.cF * VM.aF**2 + VM.cR * VM.aR**2) / (VM.j * u)
 
   # Steering input
-  B[0, 0] = (VM.cF + VM.chi * VM.cR) / VM.m / VM.sR
-  B[1, 0] = (VM.cF * VM.aF - VM.chi * VM.cR * VM.aR) / VM.j / VM.sR
+  B[..., 0, 0] = (VM.cF + VM.chi * VM.cR) / VM.m / VM.sR
+  B[..., 1, 0] = (VM.cF * VM.aF - VM.chi * VM.cR * VM.aR) / VM.j / VM.sR
 
   # Roll input
-  B[0, 1] = -ACCELERATION_DUE_TO_GRAVITY
+  B[..., 0, 1] = -ACCELERATION_DUE_TO_GRAVITY
 
   return A, B
 
 
-def dyn_ss_sol(sa: float, u: float, roll: float, VM: VehicleModel) -> np.ndarray:
+def dyn_ss_sol(sa: float | np.ndarray, u: float | np.ndarray, roll: float | np.ndarray, VM: VehicleModel) -> np.ndarray:
   """Calculate the steady state solution when x_dot = 0,
   Ax + Bu = 0 => x = -A^{-1} B u
 
@@ -218,8 +231,9 @@ def dyn_ss_sol(sa: float, u: float, roll: float, VM: VehicleModel) -> np.ndarray
   Returns:
     2x1 matrix with steady state solution
   """
+  sa, u, roll = np.broadcast_arrays(sa, u, roll)
   A, B = create_dyn_state_matrices(u, VM)
-  inp = np.array([[sa], [roll]])
+  inp = np.stack([sa, roll], axis=-1)[..., None]
   return -solve(A, B) @ inp  # type: ignore
 
 
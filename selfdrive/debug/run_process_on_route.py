@@ -2,7 +2,7 @@
 
 import argparse
 
-from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, replay_process
+from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, DEFAULT_SEEK_WARMUP, replay_process
 from openpilot.tools.lib.helpers import save_log
 from openpilot.tools.lib.logreader import LogReader
 
@@ -10,6 +10,8 @@ if __name__ == "__main__":
   parser = argparse.ArgumentParser(description="Run process on route and create new logs",
                                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
   parser.add_argument("--fingerprint", help="The fingerprint to use")
+  parser.add_argument("--start", type=float, help="Start replaying at this time (seconds from the start of the route)")
+  parser.add_argument("--warmup", type=float, default=DEFAULT_SEEK_WARMUP, help="Seconds replayed before --start to warm up the process")
   parser.add_argument("route", help="The route name to use")
   parser.add_argument("process", help="The process to run")
   args = parser.parse_args()
@@ -19,7 +21,11 @@ if __name__ == "__main__":
   lr = LogReader(args.route)
   inputs = list(lr)
 
-  outputs = replay_process(cfg, inputs, fingerprint=args.fingerprint)
+  outputs = replay_process(cfg, inputs, fingerprint=args.fingerprint, start_time=args.start, warmup=args.warmup)
+  if args.start is not None:
+    # only keep the replayed window
+    start_mono_time = min(i.logMonoTime for i in inputs) + int(args.start * 1e9)
+    inputs = [i for i in inputs if i.logMonoTime >= start_mono_time]
 
   # Remove message generated by the process under test and merge in the new messages
   produces = {o.which() for o in outputs}
@@ -5,19 +5,49 @@ from cereal import log
 
 
 class NPQueue:
+  """Fixed size FIFO of rows in a preallocated circular buffer"""
   def __init__(self, maxlen: int, rowsize: int) -> None:
     self.maxlen = maxlen
-    self.arr = np.empty((0, rowsize))
+    self.buf = np.empty((maxlen, rowsize))
+    self.idx = 0
+    self.len = 0
 
   def __len__(self) -> int:
-    return len(self.arr)
+    return self.len
+
+  @property
+  def arr(self) -> np.ndarray:
+    """Rows from oldest to newest"""
+    if self.len < self.maxlen:
+      return self.buf[:self.len]
+    return np.concatenate([self.buf[self.idx:], self.buf[:self.idx]])
 
   def append(self, pt: list[float]) -> None:
-    if len(self.arr) < self.maxlen:
-      self.arr = np.append(self.arr, [pt], axis=0)
-    else:
-      self.arr[:-1] = self.arr[1:]
-      self.arr[-1] = pt
+    self.buf[self.idx] = pt
+    self.idx = (self.idx + 1) % self.maxlen
+    self.len = min(self.len + 1, self.maxlen)
+
+
+class NPRingBuffer:
+  """Fixed size FIFO of values. Every value is written twice, maxlen apart, so the contents are always
+  a contiguous view from oldest to newest without copying"""
+  def __init__(self, maxlen: int) -> None:
+    self.maxlen = maxlen
+    self.buf = np.empty(2 * maxlen)
+    self.idx = 0
+    self.len = 0
+
+  def __len__(self) -> int:
+    return self.len
+
+  @property
+  def arr(self) -> np.ndarray:
+    return self.buf[self.idx + self.maxlen - self.len:self.idx + self.maxlen]
+
+  def append(self, x: float) -> None:
+    self.buf[self.idx] = self.buf[self.idx + self.maxlen] = x
+    self.idx = (self.idx + 1) % self.maxlen
+    self.len = min(self.len + 1, self.maxlen)
 
 
 class PointBuckets:
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import unittest
+from collections import deque
+
+import numpy as np
+
+from cereal import car
+from openpilot.selfdrive.locationd.helpers import NPQueue, NPRingBuffer
+from openpilot.selfdrive.locationd.torqued import TorqueEstimator, FIT_POINTS_TOTAL, FRICTION_FACTOR, POINTS_PER_BUCKET, slope2rot
+
+
+def get_estimator():
+  CP = car.CarParams.new_message()
+  CP.carFingerprint = "TOYOTA COROLLA TSS2 2019"
+  CP.carName = "toyota"
+  CP.lateralTuning.init("torque")
+  return TorqueEstimator(CP)
+
+
+class TestNPQueue(unittest.TestCase):
+  def test_ring_buffer(self):
+    rng = np.random.default_rng(0)
+    q = NPQueue(maxlen=5, rowsize=3)
+    expected = []
+    for _ in range(23):
+      pt = rng.normal(size=3)
+      q.append(list(pt))
+      expected = (expected + [pt])[-5:]
+      self.assertEqual(len(q), len(expected))
+      np.testing.assert_array_equal(q.arr, expected)
+
+
+class TestNPRingBuffer(unittest.TestCase):
+  def test_ring_buffer(self):
+    buf = NPRingBuffer(maxlen=7)
+    expected = deque(maxlen=7)
+    for i in range(30):
+      buf.append(i)
+      expected.append(i)
+      self.assertEqual(len(buf), len(expected))
+      np.testing.assert_array_equal(buf.arr, expected)
+
+
+class TestTorqued(unittest.TestCase):
+  def test_fit_on_sampled_points(self):
+    estimator = get_estimator()
+    rng = np.random.default_rng(0)
+    # enough points to fill every bucket several times
+    steer = rng.uniform(-0.5, 0.5, 10 * POINTS_PER_BUCKET * len(estimator.filtered_points.buckets))
+    lat_accel = 2.5 * steer + 0.1 + rng.normal(scale=0.2, size=len(steer))
+    for x, y in zip(steer, lat_accel, strict=True):
+      estimator.filtered_points.add_point(float(x), float(y))
+
+    # the fit runs on a random subset of FIT_POINTS_TOTAL of the bucket points
+    np.random.seed(0)
+    points = estimator.filtered_points.get_points(FIT_POINTS_TOTAL)
+    self.assertEqual(len(points), FIT_POINTS_TOTAL)
+    _, _, v = np.linalg.svd(points, full_matrices=False)
+    slope, offset = -v.T[0:2, 2] / v.T[2, 2]
+    _, spread = np.matmul(points[:, [0, 2]], slope2rot(slope)).T
+
+    np.random.seed(0)
+    np.testing.assert_allclose(estimator.estimate_params(), [slope, offset, np.std(spread) * FRICTION_FACTOR])
+
+
+if __name__ == "__main__":
+  unittest.main()
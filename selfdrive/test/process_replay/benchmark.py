@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import json
+import os
+import resource
+import sys
+import time
+from typing import Any
+
+import numpy as np
+
+from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, get_process_config, replay_process
+from openpilot.selfdrive.test.process_replay.test_processes import EXCLUDED_PROCS, segments as test_segments
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.openpilotci import get_url
+
+DEFAULT_SEGMENTS = [segment for car, segment in test_segments if car in ("TOYOTA", "HONDA", "HYUNDAI")]
+DEFAULT_THRESHOLD = 0.2
+
+# metric name -> whether a higher value is a regression
+COMPARED_METRICS = {
+  "msgs_per_s": False,
+  "step_latency_p50_ms": True,
+  "step_latency_p99_ms": True,
+  "peak_rss_mb": True,
+}
+
+
+def load_segment(segment: str) -> LogReader:
+  """segment is either a local log file or a process replay CI segment"""
+  if os.path.exists(segment):
+    return LogReader(segment)
+  return LogReader(get_url(*segment.rsplit("--", 1)))
+
+
+def benchmark_process(proc_name: str, segment: str, in_process: bool = False) -> dict[str, Any]:
+  cfg = get_process_config(proc_name)
+  lr = list(load_segment(segment))
+  input_msgs = sum(m.which() in cfg.pubs for m in lr)
+
+  step_times: dict[str, list[float]] = {}
+  peak_rss: dict[str, int] = {}
+  start_time = time.monotonic()
+  log_msgs = replay_process(cfg, lr, disable_progress=True, in_process=in_process, step_time_store=step_times, peak_rss_store=peak_rss)
+  wall_time = time.monotonic() - start_time
+
+  latencies = np.array(step_times.get(proc_name, [0.])) * 1e3
+  if proc_name in peak_rss:
+    rss_of, rss = "process", peak_rss[proc_name]
+  else:
+    # replayed in-process, only the replay as a whole can be measured. maxrss is in KiB on linux
+    rss_of, rss = "replay", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+  return {
+    "proc": proc_name,
+    "segment": segment,
+    "in_process": in_process,
+    "input_msgs": input_msgs,
+    "output_msgs": len(log_msgs),
+    "steps": len(step_times.get(proc_name, [])),
+    "wall_time_s": wall_time,
+    "msgs_per_s": input_msgs / wall_time,
+    "step_latency_p50_ms": float(np.percentile(latencies, 50)),
+    "step_latency_p99_ms": float(np.percentile(latencies, 99)),
+    "step_latency_max_ms": float(np.max(latencies)),
+    "peak_rss_mb": rss / 1024 / 1024,
+    # whether peak_rss_mb is of the process alone, or of the whole replay including the log
+    "peak_rss_of": rss_of,
+  }
+
+
+def _run_job(job):
+  return benchmark_process(*job)
+
+
+def run_benchmarks(procs: list[str], segments: list[str], in_process: bool = False) -> list[dict[str, Any]]:
+  jobs = [(proc, segment, in_process) for segment in segments for proc in procs]
+  # one job at a time, each in a fresh process, so neither timing nor peak memory are shared between jobs
+  with concurrent.futures.ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as pool:
+    return list(pool.map(_run_job, jobs))
+
+
+def compare_to_baseline(results: list[dict[str, Any]], baseline: list[dict[str, Any]], threshold: float) -> list[str]:
+  """Returns a description of every metric that regressed by more than threshold (relative) from baseline"""
+  baseline_results = {(r["proc"], r["segment"]): r for r in baseline}
+  regressions = []
+  for r in results:
+    ref = baseline_results.get((r["proc"], r["segment"]))
+    if ref is None:
+      continue
+
+    for metric, higher_is_worse in COMPARED_METRICS.items():
+      new, old = r[metric], ref[metric]
+      if old == 0:
+        continue
+      # the memory of a process alone can't be compared to that of a whole replay
+      if metric == "peak_rss_mb" and r.get("peak_rss_of") != ref.get("peak_rss_of"):
+        continue
+      change = (new - old) / old
+      if (change if higher_is_worse else -change) > threshold:
+        regressions.append(f"{r['proc']} {r['segment']}: {metric} {old:.3f} -> {new:.3f} ({change:+.1%})")
+  return regressions
+
+
+def format_results(results: list[dict[str, Any]]) -> str:
+  lines = [f"{'proc':<15} {'msgs/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'rss MB':>8}  segment"]
+  for r in results:
+    lines.append(f"{r['proc']:<15} {r['msgs_per_s']:>10.0f} {r['step_latency_p50_ms']:>8.2f} {r['step_latency_p99_ms']:>8.2f} " +
+                 f"{r['step_latency_max_ms']:>8.2f} {r['peak_rss_mb']:>8.0f}  {r['segment']}")
+  return "\n".join(lines)
+
+
+if __name__ == "__main__":
+  all_procs = [cfg.proc_name for cfg in CONFIGS if cfg.proc_name not in EXCLUDED_PROCS]
+
+  parser = argparse.ArgumentParser(description="Benchmark throughput, step latency and memory of processes under replay",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--procs", nargs="*", default=all_procs, help="Processes to benchmark")
+  parser.add_argument("--segments", nargs="*", default=DEFAULT_SEGMENTS, help="Local log files or process replay CI segments")
+  parser.add_argument("--in-process", action="store_true", help="Replay python processes in-process")
+  parser.add_argument("--output", default="benchmark.json", help="Write results as JSON to this file")
+  parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+  parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Relative change that counts as a regression")
+  args = parser.parse_args()
+
+  results = run_benchmarks(args.procs, args.segments, args.in_process)
+  print(format_results(results))
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=2)
+
+  if args.baseline is not None:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+
+    regressions = compare_to_baseline(results, baseline, args.threshold)
+    if len(regressions):
+      print(f"\n{len(regressions)} regressions against {args.baseline}:")
+      print("\n".join(regressions))
+      sys.exit(1)
+    print(f"\nno regressions against {args.baseline}")
@@ -4,27 +4,28 @@ import math
 import capnp
 import numbers
 import dictdiffer
-from collections import Counter
+from collections import Counter, defaultdict
 
 from openpilot.tools.lib.logreader import LogReader
 
 EPSILON = sys.float_info.epsilon
 
 
-def remove_ignored_fields(msg, ignore):
-  msg = msg.as_builder()
+def compile_ignore_fields(ignore):
+  """Splits ignore fields into paths once, grouped by the message type they apply to ("" for every type)"""
+  compiled = defaultdict(list)
   for key in ignore:
-    attr = msg
-    keys = key.split(".")
-    if msg.which() != keys[0] and len(keys) > 1:
-      continue
+    keys = [int(k) if k.isdigit() else k for k in key.split(".")]
+    compiled[keys[0] if len(keys) > 1 else ""].append(keys)
+  return dict(compiled)
+
 
+def _clear_fields(msg, paths):
+  for keys in paths:
+    attr = msg
     for k in keys[:-1]:
       # indexing into list
-      if k.isdigit():
-        attr = attr[int(k)]
-      else:
-        attr = getattr(attr, k)
+      attr = attr[k] if isinstance(k, int) else getattr(attr, k)
 
     v = getattr(attr, keys[-1])
     if isinstance(v, bool):
@@ -39,12 +40,70 @@ def remove_ignored_fields(msg, ignore):
   return msg
 
 
+def remove_ignored_fields(msg, ignore):
+  msg = msg.as_builder()
+  compiled = compile_ignore_fields(ignore)
+  return _clear_fields(msg, compiled.get("", []) + compiled.get(msg.which(), []))
+
+
+def _segments(msg):
+  """The serialized segments of a message built in this process, without copying it. None for messages read
+  from bytes, pycapnp doesn't expose the data they are read from."""
+  if isinstance(msg, capnp.lib.capnp._DynamicStructBuilder):
+    return msg.to_segments()
+  elif msg.is_root and isinstance(msg._parent, capnp.lib.capnp._MessageBuilder):
+    return msg._parent.get_segments_for_output()
+  return None
+
+
+def _to_dict(v):
+  if isinstance(v, capnp.lib.capnp._DynamicStructReader):
+    return v.to_dict(verbose=True)
+  elif isinstance(v, capnp.lib.capnp._DynamicListReader):
+    return [_to_dict(x) for x in v]
+  elif isinstance(v, capnp.lib.capnp._DynamicEnum):
+    return str(v)
+  return v
+
+
+def _dotted(path):
+  return ".".join(path) if all(isinstance(k, str) and "." not in k for k in path) else list(path)
+
+
+def _diff_values(v1, v2, path, ignore):
+  """Same diff as dictdiffer on the to_dict of v1 and v2, without converting the fields that are equal"""
+  if isinstance(v1, capnp.lib.capnp._DynamicStructReader):
+    fields = list(v1.schema.non_union_fields)
+    if len(v1.schema.union_fields):
+      if v1.which() != v2.which():
+        yield from dictdiffer.diff(_to_dict(v1), _to_dict(v2), node=path, ignore=ignore)
+        return
+      fields.insert(0, v1.which())
+
+    for name in fields:
+      if _dotted(path + [name]) in ignore:
+        continue
+      yield from _diff_values(getattr(v1, name), getattr(v2, name), path + [name], ignore)
+  elif isinstance(v1, capnp.lib.capnp._DynamicListReader):
+    if len(v1) != len(v2):
+      yield from dictdiffer.diff(_to_dict(v1), _to_dict(v2), node=path, ignore=ignore)
+      return
+
+    for i in range(len(v1)):
+      yield from _diff_values(v1[i], v2[i], path + [i], ignore)
+  else:
+    v1, v2 = _to_dict(v1), _to_dict(v2)
+    if dictdiffer.are_different(v1, v2, EPSILON):
+      yield ("change", _dotted(path), (v1, v2))
+
+
 def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
     ignore_msgs = []
   tolerance = EPSILON if tolerance is None else tolerance
+  compiled_ignore = compile_ignore_fields(ignore_fields)
 
   log1, log2 = (
     [m for m in log if m.which() not in ignore_msgs]
@@ -56,36 +115,49 @@ def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=Non
     cnt2 = Counter(m.which() for m in log2)
     raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
 
+  # Dictdiffer only supports relative tolerance, we also want to check for absolute
+  # TODO: add this to dictdiffer
+  def outside_tolerance(diff):
+    try:
+      if diff[0] == "change":
+        a, b = diff[2]
+        finite = math.isfinite(a) and math.isfinite(b)
+        if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+          return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
+    except TypeError:
+      pass
+    return True
+
   diff = []
   for msg1, msg2 in zip(log1, log2, strict=True):
-    if msg1.which() != msg2.which():
+    which = msg1.which()
+    if which != msg2.which():
       raise Exception("msgs not aligned between logs")
 
-    msg1 = remove_ignored_fields(msg1, ignore_fields)
-    msg2 = remove_ignored_fields(msg2, ignore_fields)
-
-    if msg1.to_bytes() != msg2.to_bytes():
-      msg1_dict = msg1.as_reader().to_dict(verbose=True)
-      msg2_dict = msg2.as_reader().to_dict(verbose=True)
-
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
-
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      # TODO: add this to dictdiffer
-      def outside_tolerance(diff):
-        try:
-          if diff[0] == "change":
-            a, b = diff[2]
-            finite = math.isfinite(a) and math.isfinite(b)
-            if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-              return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        except TypeError:
-          pass
-        return True
-
-      dd = list(filter(outside_tolerance, dd))
+    # fast path for identical messages, only the messages without known segments are copied for it
+    msgs, copied = [msg1, msg2], [False, False]
+    segments = [_segments(msg1), _segments(msg2)]
+    for i in range(2):
+      if segments[i] is None:
+        msgs[i] = msgs[i].as_builder()
+        segments[i] = msgs[i].to_segments()
+        copied[i] = True
+    if segments[0] == segments[1]:
+      continue
 
-      diff.extend(dd)
+    # ignored fields are only cleared on copies of the messages that differ
+    paths = compiled_ignore.get("", []) + compiled_ignore.get(which, [])
+    if len(paths):
+      for i in range(2):
+        if not copied[i]:
+          msgs[i] = msgs[i].copy() if isinstance(msgs[i], capnp.lib.capnp._DynamicStructBuilder) else msgs[i].as_builder()
+        msgs[i] = _clear_fields(msgs[i], paths)
+      if msgs[0].to_segments() == msgs[1].to_segments():
+        continue
+
+    readers = [m.as_reader() if isinstance(m, capnp.lib.capnp._DynamicStructBuilder) else m for m in msgs]
+    dd = _diff_values(readers[0], readers[1], [], ignore_fields)
+    diff.extend(filter(outside_tolerance, dd))
   return diff
 
 
@@ -1,4 +1,5 @@
 from collections import defaultdict
+from functools import partial, wraps
 
 from cereal import messaging
 from openpilot.selfdrive.car.fingerprints import MIGRATION
@@ -8,69 +9,100 @@ from openpilot.selfdrive.manager.process_config import managed_processes
 from panda import Panda
 
 
-# TODO: message migration should happen in-place
+def migration(inputs):
+  """
+  Registers the message types a migration reads. A migration is set up once with the whole log and returns
+  a function mapping each message of those types to the list of messages replacing it, or None if it isn't needed.
+  """
+  def decorator(setup):
+    @wraps(setup)
+    def wrapper(lr, *args, **kwargs):
+      fn = setup(lr, *args, **kwargs)
+      return None if fn is None else (frozenset(inputs), fn)
+    return wrapper
+  return decorator
+
+
+def _apply_migrations(msg, stages, start=0):
+  for i in range(start, len(stages)):
+    inputs, fn = stages[i]
+    if msg.which() in inputs:
+      for new_msg in fn(msg):
+        yield from _apply_migrations(new_msg, stages, i + 1)
+      return
+  yield msg
+
+
+def migrate(lr, migrations):
+  """Runs migrations in order in a single pass over lr, only messages of the types they read are touched"""
+  # migrations may scan the log during setup
+  if iter(lr) is lr:
+    lr = list(lr)
+
+  stages = [stage for stage in (m(lr) for m in migrations) if stage is not None]
+
+  for msg in lr:
+    yield from _apply_migrations(msg, stages)
+
+
 def migrate_all(lr, old_logtime=False, manager_states=False, panda_states=False, camera_states=False):
-  msgs = migrate_sensorEvents(lr, old_logtime)
-  msgs = migrate_carParams(msgs, old_logtime)
-  msgs = migrate_gpsLocation(msgs)
-  msgs = migrate_deviceState(msgs)
+  migrations = [partial(migrate_sensorEvents, old_logtime=old_logtime), partial(migrate_carParams, old_logtime=old_logtime),
+                migrate_gpsLocation, migrate_deviceState]
   if manager_states:
-    msgs = migrate_managerState(msgs)
+    migrations.append(migrate_managerState)
   if panda_states:
-    msgs = migrate_pandaStates(msgs)
-    msgs = migrate_peripheralState(msgs)
+    migrations.extend([migrate_pandaStates, migrate_peripheralState])
   if camera_states:
-    msgs = migrate_cameraStates(msgs)
+    migrations.append(migrate_cameraStates)
 
-  return msgs
+  return list(migrate(lr, migrations))
 
 
+@migration(["managerState"])
 def migrate_managerState(lr):
-  all_msgs = []
-  for msg in lr:
-    if msg.which() != "managerState":
-      all_msgs.append(msg)
-      continue
+  processes = [{'name': name, 'running': True} for name in managed_processes]
 
+  def migrate(msg):
     new_msg = msg.as_builder()
-    new_msg.managerState.processes = [{'name': name, 'running': True} for name in managed_processes]
-    all_msgs.append(new_msg.as_reader())
-
-  return all_msgs
+    new_msg.managerState.processes = processes
+    return [new_msg.as_reader()]
+  return migrate
 
 
+@migration(["gpsLocation", "gpsLocationExternal"])
 def migrate_gpsLocation(lr):
-  all_msgs = []
-  for msg in lr:
-    if msg.which() in ('gpsLocation', 'gpsLocationExternal'):
-      new_msg = msg.as_builder()
-      g = getattr(new_msg, new_msg.which())
-      # hasFix is a newer field
-      if not g.hasFix and g.flags == 1:
-        g.hasFix = True
-      all_msgs.append(new_msg.as_reader())
-    else:
-      all_msgs.append(msg)
-  return all_msgs
+  def migrate(msg):
+    g = getattr(msg, msg.which())
+    # hasFix is a newer field
+    if g.hasFix or g.flags != 1:
+      return [msg]
+
+    new_msg = msg.as_builder()
+    getattr(new_msg, new_msg.which()).hasFix = True
+    return [new_msg.as_reader()]
+  return migrate
 
 
+@migration(["initData", "deviceState"])
 def migrate_deviceState(lr):
-  all_msgs = []
   dt = None
-  for msg in lr:
+
+  def migrate(msg):
+    nonlocal dt
     if msg.which() == 'initData':
       dt = msg.initData.deviceType
-    if msg.which() == 'deviceState':
-      n = msg.as_builder()
-      n.deviceState.deviceType = dt
-      all_msgs.append(n.as_reader())
-    else:
-      all_msgs.append(msg)
-  return all_msgs
+      return [msg]
+
+    if dt is not None and str(msg.deviceState.deviceType) == str(dt):
+      return [msg]
+    n = msg.as_builder()
+    n.deviceState.deviceType = dt
+    return [n.as_reader()]
+  return migrate
 
 
+@migration(["pandaStateDEPRECATED", "pandaStates"])
 def migrate_pandaStates(lr):
-  all_msgs = []
   # TODO: safety param migration should be handled automatically
   safety_param_migration = {
     "TOYOTA_PRIUS": EPS_SCALE["TOYOTA_PRIUS"] | Panda.FLAG_TOYOTA_STOCK_LONGITUDINAL,
@@ -81,8 +113,10 @@ def migrate_pandaStates(lr):
   # Migrate safety param base on carState
   CP = next((m.carParams for m in lr if m.which() == 'carParams'), None)
   assert CP is not None, "carParams message not found"
-  if CP.carFingerprint in safety_param_migration:
-    safety_param = safety_param_migration[CP.carFingerprint]
+  # the fingerprint is migrated by migrate_carParams in the same pass
+  car_fingerprint = MIGRATION.get(CP.carFingerprint, CP.carFingerprint)
+  if car_fingerprint in safety_param_migration:
+    safety_param = safety_param_migration[car_fingerprint]
   elif len(CP.safetyConfigs):
     safety_param = CP.safetyConfigs[0].safetyParam
     if CP.safetyConfigs[0].safetyParamDEPRECATED != 0:
@@ -90,44 +124,38 @@ def migrate_pandaStates(lr):
   else:
     safety_param = CP.safetyParamDEPRECATED
 
-  for msg in lr:
+  def migrate(msg):
     if msg.which() == 'pandaStateDEPRECATED':
       new_msg = messaging.new_message('pandaStates', 1)
       new_msg.valid = msg.valid
       new_msg.logMonoTime = msg.logMonoTime
       new_msg.pandaStates[0] = msg.pandaStateDEPRECATED
       new_msg.pandaStates[0].safetyParam = safety_param
-      all_msgs.append(new_msg.as_reader())
-    elif msg.which() == 'pandaStates':
-      new_msg = msg.as_builder()
-      new_msg.pandaStates[-1].safetyParam = safety_param
-      all_msgs.append(new_msg.as_reader())
-    else:
-      all_msgs.append(msg)
+      return [new_msg.as_reader()]
 
-  return all_msgs
+    if msg.pandaStates[-1].safetyParam == safety_param:
+      return [msg]
+    new_msg = msg.as_builder()
+    new_msg.pandaStates[-1].safetyParam = safety_param
+    return [new_msg.as_reader()]
+  return migrate
 
 
+@migration(["pandaStates", "pandaStateDEPRECATED"])
 def migrate_peripheralState(lr):
   if any(msg.which() == "peripheralState" for msg in lr):
-    return lr
-
-  all_msg = []
-  for msg in lr:
-    all_msg.append(msg)
-    if msg.which() not in ["pandaStates", "pandaStateDEPRECATED"]:
-      continue
+    return None
 
+  def migrate(msg):
     new_msg = messaging.new_message("peripheralState")
     new_msg.valid = msg.valid
     new_msg.logMonoTime = msg.logMonoTime
-    all_msg.append(new_msg.as_reader())
-
-  return all_msg
+    return [msg, new_msg.as_reader()]
+  return migrate
 
 
+@migration(["roadCameraState", "wideRoadCameraState", "driverCameraState"])
 def migrate_cameraStates(lr):
-  all_msgs = []
   frame_to_encode_id = defaultdict(dict)
   # just for encodeId fallback mechanism
   min_frame_id = defaultdict(lambda: float('inf'))
@@ -142,11 +170,7 @@ def migrate_cameraStates(lr):
     assert encode_index.segmentId < 1200, f"Encoder index segmentId greater that 1200: {msg.which()} {encode_index.segmentId}"
     frame_to_encode_id[meta.camera_state][encode_index.frameId] = encode_index.segmentId
 
-  for msg in lr:
-    if msg.which() not in ["roadCameraState", "wideRoadCameraState", "driverCameraState"]:
-      all_msgs.append(msg)
-      continue
-
+  def migrate(msg):
     camera_state = getattr(msg, msg.which())
     min_frame_id[msg.which()] = min(min_frame_id[msg.which()], camera_state.frameId)
 
@@ -154,7 +178,7 @@ def migrate_cameraStates(lr):
     if encode_id is None:
       print(f"Missing encoded frame for camera feed {msg.which()} with frameId: {camera_state.frameId}")
       if len(frame_to_encode_id[msg.which()]) != 0:
-        continue
+        return []
 
       # fallback mechanism for logs without encodeIdx (e.g. logs from before 2022 with dcamera recording disabled)
       # try to fake encode_id by subtracting lowest frameId
@@ -174,36 +198,34 @@ def migrate_cameraStates(lr):
     new_msg.logMonoTime = msg.logMonoTime
     new_msg.valid = msg.valid
 
-    all_msgs.append(new_msg.as_reader())
-
-  return all_msgs
+    return [new_msg.as_reader()]
+  return migrate
 
 
+@migration(["carParams"])
 def migrate_carParams(lr, old_logtime=False):
-  all_msgs = []
-  for msg in lr:
-    if msg.which() == 'carParams':
-      CP = messaging.new_message('carParams')
-      CP.valid = True
-      CP.carParams = msg.carParams.as_builder()
-      CP.carParams.carFingerprint = MIGRATION.get(CP.carParams.carFingerprint, CP.carParams.carFingerprint)
-      for car_fw in CP.carParams.carFw:
-        car_fw.brand = CP.carParams.carName
-      if old_logtime:
-        CP.logMonoTime = msg.logMonoTime
-      msg = CP.as_reader()
-    all_msgs.append(msg)
-
-  return all_msgs
+  def migrate(msg):
+    CP = msg.carParams
+    # logMonoTime is reset without old_logtime
+    if old_logtime and msg.valid and CP.carFingerprint not in MIGRATION and all(car_fw.brand == CP.carName for car_fw in CP.carFw):
+      return [msg]
+
+    new_msg = messaging.new_message('carParams')
+    new_msg.valid = True
+    new_msg.carParams = CP.as_builder()
+    new_msg.carParams.carFingerprint = MIGRATION.get(new_msg.carParams.carFingerprint, new_msg.carParams.carFingerprint)
+    for car_fw in new_msg.carParams.carFw:
+      car_fw.brand = new_msg.carParams.carName
+    if old_logtime:
+      new_msg.logMonoTime = msg.logMonoTime
+    return [new_msg.as_reader()]
+  return migrate
 
 
+@migration(["sensorEventsDEPRECATED"])
 def migrate_sensorEvents(lr, old_logtime=False):
-  all_msgs = []
-  for msg in lr:
-    if msg.which() != 'sensorEventsDEPRECATED':
-      all_msgs.append(msg)
-      continue
-
+  def migrate(msg):
+    new_msgs = []
     # migrate to split sensor events
     for evt in msg.sensorEventsDEPRECATED:
       # build new message for each sensor type
@@ -233,6 +255,6 @@ def migrate_sensorEvents(lr, old_logtime=False):
         m_dat.timestamp = evt.timestamp
       setattr(m_dat, evt.which(), getattr(evt, evt.which()))
 
-      all_msgs.append(m.as_reader())
-
-  return all_msgs
+      new_msgs.append(m.as_reader())
+    return new_msgs
+  return migrate
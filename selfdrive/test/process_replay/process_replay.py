@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import gc
 import os
 import time
 import copy
@@ -6,6 +7,9 @@ import json
 import heapq
 import signal
 import platform
+import importlib.util
+import sys
+import threading
 from collections import OrderedDict
 from dataclasses import dataclass, field
 from typing import Any
@@ -34,6 +38,10 @@ from openpilot.tools.lib.framereader import BaseFrameReader
 NUMPY_TOLERANCE = 1e-7
 PROC_REPLAY_DIR = os.path.dirname(os.path.abspath(__file__))
 FAKEDATA = os.path.join(PROC_REPLAY_DIR, "fakedata/")
+# seconds replayed before the start of a seek, to let processes converge from the restored state
+DEFAULT_SEEK_WARMUP = 10.
+# state at the seek point that can't be restored from params
+SEEK_STATE_MSGS = ("initData", "carParams")
 
 class DummySocket:
   def __init__(self):
@@ -144,6 +152,7 @@ class ProcessConfig:
   vision_pubs: list[str] = field(default_factory=list)
   ignore_alive_pubs: list[str] = field(default_factory=list)
   unlocked_pubs: list[str] = field(default_factory=list)
+  in_process: bool = False
 
 
 class ProcessContainer:
@@ -259,6 +268,19 @@ class ProcessContainer:
         while not all(self.pm.all_readers_updated(s) for s in self.cfg.pubs if s not in self.cfg.ignore_alive_pubs):
           time.sleep(0)
 
+  def peak_rss(self) -> int | None:
+    """Peak resident memory of the process in bytes (VmHWM), None if it isn't running"""
+    if self.process.proc is None or self.process.proc.pid is None:
+      return None
+    try:
+      with open(f"/proc/{self.process.proc.pid}/status") as f:
+        for line in f:
+          if line.startswith("VmHWM:"):
+            return int(line.split()[1]) * 1024
+    except OSError:
+      pass
+    return None
+
   def stop(self):
     with self.prefix:
       self.process.signal(signal.SIGKILL)
@@ -317,6 +339,240 @@ class ProcessContainer:
     return output_msgs
 
 
+class InProcessReplayDone(Exception):
+  pass
+
+
+class Lockstep:
+  """Hands batches of messages to a daemon running in a thread, one cycle at a time.
+  The daemon blocks in recv() until the replay calls step(), which returns once the daemon blocks again."""
+  def __init__(self, proc_name: str):
+    self.proc_name = proc_name
+    self.cond = threading.Condition()
+    self.batch: list[capnp._DynamicStructReader] | None = None
+    self.blocked = False
+    self.stopped = False
+    self.done = False
+    self.exception: BaseException | None = None
+
+  def run(self, target: Callable):
+    try:
+      target()
+    except InProcessReplayDone:
+      pass
+    except BaseException as e:
+      self.exception = e
+    finally:
+      with self.cond:
+        self.done = True
+        self.cond.notify_all()
+
+  def recv(self) -> list[capnp._DynamicStructReader]:
+    with self.cond:
+      self.blocked = True
+      self.cond.notify_all()
+      self.cond.wait_for(lambda: self.batch is not None or self.stopped)
+      if self.stopped:
+        raise InProcessReplayDone
+
+      batch, self.batch = self.batch, None
+      self.blocked = False
+      return batch
+
+  def _check_alive(self):
+    if self.exception is not None:
+      raise Exception(f"process {repr(self.proc_name)} crashed") from self.exception
+    if self.done:
+      raise Exception(f"process {repr(self.proc_name)} exited")
+
+  def wait_for_recv_called(self):
+    with self.cond:
+      self.cond.wait_for(lambda: self.blocked or self.done)
+      self._check_alive()
+
+  def step(self, batch: list[capnp._DynamicStructReader]):
+    with self.cond:
+      self.cond.wait_for(lambda: self.blocked or self.done)
+      self._check_alive()
+      self.batch = batch
+      self.cond.notify_all()
+      self.cond.wait_for(lambda: (self.blocked and self.batch is None) or self.done)
+      self._check_alive()
+
+  def stop(self):
+    with self.cond:
+      self.stopped = True
+      self.cond.notify_all()
+
+
+class InProcessSubMaster(messaging.SubMaster):
+  def __init__(self, container: 'InProcessContainer', services: list[str], **kwargs):
+    super().__init__(services, **kwargs)
+    self.container = container
+
+  def update(self, timeout: int = 100) -> None:
+    msgs = self.container.recv_services(list(self.data.keys()))
+    # same clock as the SubMaster of a daemon running as its own process
+    self.update_msgs(time.monotonic(), msgs)
+
+
+class InProcessPubMaster:
+  def __init__(self, container: 'InProcessContainer', services: list[str]):
+    self.container = container
+    self.services = services
+
+  def send(self, s: str, dat: bytes | capnp.lib.capnp._DynamicStructBuilder) -> None:
+    if not isinstance(dat, bytes):
+      dat = dat.to_bytes()
+    self.container.sent.append((s, dat))
+
+  def wait_for_readers_to_update(self, s: str, timeout: int, dt: float = 0.05) -> bool:
+    return True
+
+  def all_readers_updated(self, s: str) -> bool:
+    return True
+
+
+class InProcessMessaging:
+  """Replaces the messaging module of a daemon running in-process. Messages from the replay are handed
+  to its SubMaster and main_pub socket, and everything published is collected by the container."""
+  def __init__(self, container: 'InProcessContainer'):
+    self.container = container
+    self.main_sock = object()
+
+  def __getattr__(self, name: str):
+    return getattr(messaging, name)
+
+  def SubMaster(self, services: list[str], **kwargs) -> InProcessSubMaster:
+    return InProcessSubMaster(self.container, services, **kwargs)
+
+  def PubMaster(self, services: list[str]) -> InProcessPubMaster:
+    return InProcessPubMaster(self.container, services)
+
+  def sub_sock(self, endpoint: str, *args, **kwargs):
+    if endpoint == self.container.cfg.main_pub:
+      return self.main_sock
+    return messaging.sub_sock(endpoint, *args, **kwargs)
+
+  def drain_sock_raw(self, sock, wait_for_one: bool = False) -> list[bytes]:
+    if sock is self.main_sock:
+      return self.container.recv_main_pub()
+    return messaging.drain_sock_raw(sock, wait_for_one=wait_for_one)
+
+
+class InProcessContainer(ProcessContainer):
+  """Runs a python daemon's main loop in a thread of the replay process, in lockstep with the replay.
+  Produces the same output as ProcessContainer without the fake event handshakes of a separate process."""
+  def __init__(self, cfg: ProcessConfig):
+    super().__init__(cfg)
+    assert cfg.in_process, f"{repr(cfg.proc_name)} can't be replayed in-process"
+    assert len(cfg.vision_pubs) == 0
+    self.module: Any = None
+    self.previous_module: Any = None
+    self.lockstep: Lockstep | None = None
+    self.thread: threading.Thread | None = None
+    self.gc_enabled = True
+    self.pending: dict[str, capnp._DynamicStructReader] = {}
+    self.sent: list[tuple[str, bytes]] = []
+
+  def recv_services(self, services: list[str]) -> list[capnp._DynamicStructReader]:
+    # sockets are conflated, so only the latest message of each service is received
+    assert self.lockstep is not None
+    if self.cfg.main_pub is None:
+      self.pending = {m.which(): m for m in self.lockstep.recv()}
+    return [self.pending.pop(s) for s in services if s in self.pending]
+
+  def recv_main_pub(self) -> list[bytes]:
+    assert self.lockstep is not None
+    batch = self.lockstep.recv()
+    self.pending = {m.which(): m for m in batch if m.which() != self.cfg.main_pub}
+    return [m.as_builder().to_bytes() for m in batch if m.which() == self.cfg.main_pub]
+
+  def start(
+    self, params_config: dict[str, Any], environ_config: dict[str, Any],
+    all_msgs: LogIterable, frs: dict[str, BaseFrameReader] | None,
+    fingerprint: str | None, capture_output: bool
+  ):
+    assert not capture_output, "output capture is not supported for in-process replay"
+
+    with self.prefix:
+      self._setup_env(params_config, environ_config)
+
+      if self.cfg.config_callback is not None:
+        params = Params()
+        self.cfg.config_callback(params, self.cfg, all_msgs)
+
+      # processes replayed in-process can't depend on the replay context during init
+      if self.cfg.init_callback is not None:
+        self.cfg.init_callback(None, None, all_msgs, fingerprint)
+
+      # a fresh copy of the daemon's module, so its globals don't carry over from an earlier replay
+      spec = importlib.util.find_spec(self.process.module)
+      assert spec is not None and spec.loader is not None, f"Cannot find module {self.process.module}"
+      self.module = importlib.util.module_from_spec(spec)
+      # registered while it runs, e.g. dataclasses look up the module of their class
+      self.previous_module = sys.modules.get(self.process.module)
+      sys.modules[self.process.module] = self.module
+      spec.loader.exec_module(self.module)
+      self.module.messaging = InProcessMessaging(self)
+      # daemons disable gc for realtime, which shouldn't leak into the replay
+      self.gc_enabled = gc.isenabled()
+
+      self.lockstep = Lockstep(self.cfg.proc_name)
+      self.thread = threading.Thread(target=self.lockstep.run, args=(self.module.main,), name=self.cfg.proc_name, daemon=True)
+      self.thread.start()
+
+      # wait for process to startup
+      with Timeout(10, error_msg=f"timed out waiting for process to start: {repr(self.cfg.proc_name)}"):
+        self.lockstep.wait_for_recv_called()
+
+  def peak_rss(self) -> int | None:
+    # shares the memory of the replay process
+    return None
+
+  def stop(self):
+    with self.prefix:
+      if self.lockstep is not None:
+        self.lockstep.stop()
+      if self.thread is not None:
+        self.thread.join(timeout=self.cfg.timeout)
+      if self.module is not None:
+        if self.previous_module is not None:
+          sys.modules[self.process.module] = self.previous_module
+        else:
+          sys.modules.pop(self.process.module, None)
+      if self.gc_enabled:
+        gc.enable()
+      self.prefix.clean_dirs()
+      self._clean_env()
+
+  def run_step(self, msg: capnp._DynamicStructReader, frs: dict[str, BaseFrameReader] | None) -> list[capnp._DynamicStructReader]:
+    assert self.lockstep is not None
+
+    output_msgs = []
+    with self.prefix, Timeout(self.cfg.timeout, error_msg=f"timed out testing process {repr(self.cfg.proc_name)}"):
+      end_of_cycle = True
+      if self.cfg.should_recv_callback is not None:
+        end_of_cycle = self.cfg.should_recv_callback(msg, self.cfg, self.cnt)
+
+      self.msg_queue.append(msg)
+      if end_of_cycle:
+        self.lockstep.step(self.msg_queue)
+        self.msg_queue = []
+
+        # same order as draining the sub sockets one by one
+        sent = [(s, dat) for s, dat in self.sent if s in self.cfg.subs]
+        sent.sort(key=lambda x: self.cfg.subs.index(x[0]))
+        self.sent = []
+        for _, dat in sent:
+          m = messaging.log_from_bytes(dat).as_builder()
+          m.logMonoTime = msg.logMonoTime + int(self.cfg.processing_time * 1e9)
+          output_msgs.append(m.as_reader())
+        self.cnt += 1
+
+    return output_msgs
+
+
 def controlsd_fingerprint_callback(rc, pm, msgs, fingerprint):
   print("start fingerprinting")
   params = Params()
@@ -483,6 +739,7 @@ CONFIGS = [
     init_callback=get_car_params_callback,
     should_recv_callback=MessageBasedRcvCallback("can"),
     main_pub="can",
+    in_process=True,
   ),
   ProcessConfig(
     proc_name="plannerd",
@@ -492,6 +749,7 @@ CONFIGS = [
     init_callback=get_car_params_callback,
     should_recv_callback=FrequencyBasedRcvCallback("modelV2"),
     tolerance=NUMPY_TOLERANCE,
+    in_process=True,
   ),
   ProcessConfig(
     proc_name="calibrationd",
@@ -499,6 +757,7 @@ CONFIGS = [
     subs=["liveCalibration"],
     ignore=["logMonoTime"],
     should_recv_callback=calibration_rcv_callback,
+    in_process=True,
   ),
   ProcessConfig(
     proc_name="dmonitoringd",
@@ -507,6 +766,7 @@ CONFIGS = [
     ignore=["logMonoTime"],
     should_recv_callback=FrequencyBasedRcvCallback("driverStateV2"),
     tolerance=NUMPY_TOLERANCE,
+    in_process=True,
   ),
   ProcessConfig(
     proc_name="locationd",
@@ -528,6 +788,7 @@ CONFIGS = [
     should_recv_callback=FrequencyBasedRcvCallback("liveLocationKalman"),
     tolerance=NUMPY_TOLERANCE,
     processing_time=0.004,
+    in_process=True,
   ),
   ProcessConfig(
     proc_name="ubloxd",
@@ -543,6 +804,7 @@ CONFIGS = [
     init_callback=get_car_params_callback,
     should_recv_callback=torqued_rcv_callback,
     tolerance=NUMPY_TOLERANCE,
+    in_process=True,
   ),
   ProcessConfig(
     proc_name="modeld",
@@ -615,6 +877,44 @@ def get_custom_params_from_lr(lr: LogIterable, initial_state: str = "first") ->
   return custom_params
 
 
+def seek_log(lr: LogIterable, start_time: float, warmup: float = DEFAULT_SEEK_WARMUP) -> tuple[list[capnp._DynamicStructReader], dict[str, Any]]:
+  """
+  Returns the messages from warmup seconds before start_time (relative to the first message) onwards,
+  and custom params holding the state of the processes at that point (see get_custom_params_from_lr).
+  The last initData and carParams before the window are kept at its start.
+  """
+  all_msgs = sorted(lr, key=lambda m: m.logMonoTime)
+  assert len(all_msgs) != 0, "Cannot seek in an empty log"
+  assert int(start_time * 1e9) <= all_msgs[-1].logMonoTime - all_msgs[0].logMonoTime, f"Cannot seek past the end of the log: {start_time}s"
+  window_start = all_msgs[0].logMonoTime + int(max(start_time - warmup, 0.) * 1e9)
+
+  before = [m for m in all_msgs if m.logMonoTime < window_start]
+  window = [m for m in all_msgs if m.logMonoTime >= window_start]
+
+  state_msgs = {}
+  for m in before:
+    if m.which() in SEEK_STATE_MSGS:
+      state_msgs[m.which()] = m
+  # carParams is only logged every so often, fall back to the first one if none was logged before the window
+  if "carParams" not in state_msgs:
+    cp = next((m for m in window if m.which() == "carParams"), None)
+    if cp is not None:
+      state_msgs["carParams"] = cp
+
+  custom_params = get_custom_params_from_lr(before + list(state_msgs.values()), initial_state="last")
+  window = [m for m in state_msgs.values() if m.logMonoTime < window_start] + window
+  return window, custom_params
+
+
+def get_migration_config(cfgs: list[ProcessConfig]) -> dict[str, bool]:
+  return {
+    "old_logtime": True,
+    "manager_states": True,
+    "panda_states": any("pandaStates" in cfg.pubs for cfg in cfgs),
+    "camera_states": any(len(cfg.vision_pubs) != 0 for cfg in cfgs),
+  }
+
+
 def replay_process_with_name(name: str | Iterable[str], lr: LogIterable, *args, **kwargs) -> list[capnp._DynamicStructReader]:
   if isinstance(name, str):
     cfgs = [get_process_config(name)]
@@ -629,18 +929,34 @@ def replay_process_with_name(name: str | Iterable[str], lr: LogIterable, *args,
 def replay_process(
   cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, BaseFrameReader] = None,
   fingerprint: str = None, return_all_logs: bool = False, custom_params: dict[str, Any] = None,
-  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False
+  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False, in_process: bool = False,
+  migrated: bool = False, step_time_store: dict[str, list[float]] = None, start_time: float = None,
+  warmup: float = DEFAULT_SEEK_WARMUP, peak_rss_store: dict[str, int] = None
 ) -> list[capnp._DynamicStructReader]:
+  """
+  Replays cfg on the messages of lr. With in_process, processes that support it (cfg.in_process) run in
+  a thread of this process in lockstep with the replay, which is much faster than a separate process.
+  Pass migrated if lr was already migrated with get_migration_config(cfg).
+  If step_time_store is given, the wall time of every cycle of each process is appended to it.
+  If peak_rss_store is given, the peak resident memory in bytes of each process that ran as its own process is stored in it.
+  With start_time, replay starts warmup seconds before start_time from the state of the processes at that
+  point (see seek_log), and only messages from start_time onwards are returned.
+  """
   if isinstance(cfg, Iterable):
     cfgs = list(cfg)
   else:
     cfgs = [cfg]
 
-  all_msgs = migrate_all(lr, old_logtime=True,
-                         manager_states=True,
-                         panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
-                         camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
-  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
+  all_msgs = list(lr) if migrated else migrate_all(lr, **get_migration_config(cfgs))
+
+  seek_mono_time = None
+  if start_time is not None:
+    seek_mono_time = min(m.logMonoTime for m in all_msgs) + int(start_time * 1e9)
+    all_msgs, seek_params = seek_log(all_msgs, start_time, warmup)
+    custom_params = {**seek_params, **(custom_params or {})}
+
+  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress, in_process,
+                                       step_time_store, peak_rss_store)
 
   if return_all_logs:
     keys = {m.which() for m in process_logs}
@@ -651,12 +967,17 @@ def replay_process(
   else:
     log_msgs = process_logs
 
+  if seek_mono_time is not None:
+    # drop the output of the warmup
+    log_msgs = [m for m in log_msgs if m.logMonoTime >= seek_mono_time]
+
   return log_msgs
 
 
 def _replay_multi_process(
   cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, BaseFrameReader] | None, fingerprint: str | None,
-  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool
+  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool,
+  in_process: bool = False, step_time_store: dict[str, list[float]] | None = None, peak_rss_store: dict[str, int] | None = None
 ) -> list[capnp._DynamicStructReader]:
   if fingerprint is not None:
     params_config = generate_params_config(lr=lr, fingerprint=fingerprint, custom_params=custom_params)
@@ -680,7 +1001,11 @@ def _replay_multi_process(
   try:
     containers = []
     for cfg in cfgs:
-      container = ProcessContainer(cfg)
+      # output capture relies on a separate process
+      if in_process and cfg.in_process and captured_output_store is None:
+        container = InProcessContainer(cfg)
+      else:
+        container = ProcessContainer(cfg)
       containers.append(container)
       container.start(params_config, env_config, all_msgs, frs, fingerprint, captured_output_store is not None)
 
@@ -707,7 +1032,11 @@ def _replay_multi_process(
 
       target_containers = pubs_to_containers[msg.which()]
       for container in target_containers:
+        cnt, step_start = container.cnt, time.monotonic()
         output_msgs = container.run_step(msg, frs)
+        # only count steps that ran a cycle of the process
+        if step_time_store is not None and container.cnt != cnt:
+          step_time_store.setdefault(container.cfg.proc_name, []).append(time.monotonic() - step_start)
         for m in output_msgs:
           if m.which() in all_pubs:
             internal_pub_queue.append(m)
@@ -715,6 +1044,9 @@ def _replay_multi_process(
         log_msgs.extend(output_msgs)
   finally:
     for container in containers:
+      peak_rss = container.peak_rss() if peak_rss_store is not None else None
+      if peak_rss is not None:
+        peak_rss_store[container.cfg.proc_name] = peak_rss
       container.stop()
       if captured_output_store is not None:
         assert container.capture is not None
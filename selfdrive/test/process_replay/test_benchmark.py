@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+import unittest
+
+from openpilot.selfdrive.test.process_replay.benchmark import compare_to_baseline
+
+
+def result(proc="radard", segment="seg", **kwargs):
+  return {"proc": proc, "segment": segment, "msgs_per_s": 1000., "step_latency_p50_ms": 1., "step_latency_p99_ms": 2.,
+          "peak_rss_mb": 100., "peak_rss_of": "process", **kwargs}
+
+
+class TestBenchmark(unittest.TestCase):
+  def test_no_regression(self):
+    baseline = [result()]
+    self.assertEqual(compare_to_baseline([result()], baseline, 0.2), [])
+    # changes within the threshold and improvements aren't regressions
+    self.assertEqual(compare_to_baseline([result(msgs_per_s=900., step_latency_p99_ms=2.3)], baseline, 0.2), [])
+    self.assertEqual(compare_to_baseline([result(msgs_per_s=5000., step_latency_p50_ms=0.1, peak_rss_mb=10.)], baseline, 0.2), [])
+
+  def test_regression(self):
+    baseline = [result(), result(proc="paramsd")]
+    regressions = compare_to_baseline([result(msgs_per_s=700., step_latency_p50_ms=1.5), result(proc="paramsd", peak_rss_mb=150.)], baseline, 0.2)
+    self.assertEqual(len(regressions), 3)
+    self.assertTrue(regressions[0].startswith("radard seg: msgs_per_s"))
+    self.assertTrue(regressions[1].startswith("radard seg: step_latency_p50_ms"))
+    self.assertTrue(regressions[2].startswith("paramsd seg: peak_rss_mb"))
+
+  def test_skipped(self):
+    # results without a baseline, metrics that were zero, and memory measured differently are not compared
+    baseline = [result(step_latency_p99_ms=0.)]
+    results = [result(segment="other", msgs_per_s=1.), result(step_latency_p99_ms=10., peak_rss_mb=500., peak_rss_of="replay")]
+    self.assertEqual(compare_to_baseline(results, baseline, 0.2), [])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import math
+import numbers
+import unittest
+
+import dictdiffer
+from parameterized import parameterized
+
+from cereal import log
+from openpilot.selfdrive.test.process_replay.compare_logs import EPSILON, compare_logs, remove_ignored_fields
+
+
+def dictdiffer_compare_logs(log1, log2, ignore_fields=None, tolerance=None):
+  """The compare_logs before the lazy diff, the reference for its output"""
+  ignore_fields = ignore_fields or []
+  tolerance = EPSILON if tolerance is None else tolerance
+
+  def outside_tolerance(diff):
+    try:
+      if diff[0] == "change":
+        a, b = diff[2]
+        finite = math.isfinite(a) and math.isfinite(b)
+        if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+          return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
+    except TypeError:
+      pass
+    return True
+
+  diff = []
+  for msg1, msg2 in zip(log1, log2, strict=True):
+    msg1 = remove_ignored_fields(msg1, ignore_fields)
+    msg2 = remove_ignored_fields(msg2, ignore_fields)
+    if msg1.to_bytes() != msg2.to_bytes():
+      dd = dictdiffer.diff(msg1.as_reader().to_dict(verbose=True), msg2.as_reader().to_dict(verbose=True), ignore=ignore_fields)
+      diff.extend(filter(outside_tolerance, dd))
+  return diff
+
+
+def car_state(mono_time=0, v_ego=0., cruise_speed=0., buttons=()):
+  msg = log.Event.new_message(logMonoTime=mono_time, valid=True)
+  msg.init('carState')
+  msg.carState.vEgo = v_ego
+  msg.carState.cruiseState.speed = cruise_speed
+  msg.carState.buttonEvents = [{'type': t, 'pressed': p} for t, p in buttons]
+  return msg.as_reader()
+
+
+def controls_state(mono_time=0, curvature=0., cum_lag_ms=0., lat_state='pidState', output=0.):
+  msg = log.Event.new_message(logMonoTime=mono_time, valid=True)
+  msg.init('controlsState')
+  msg.controlsState.curvature = curvature
+  msg.controlsState.cumLagMs = cum_lag_ms
+  lat = msg.controlsState.lateralControlState.init(lat_state)
+  lat.active = True
+  lat.output = output
+  return msg.as_reader()
+
+
+CASES = {
+  "identical": (
+    [car_state(1, 1.), controls_state(2, 0.1)],
+    [car_state(1, 1.), controls_state(2, 0.1)],
+    [], None,
+  ),
+  "changed_fields": (
+    [car_state(1, 1., 10.), controls_state(2, 0.1, 5., output=0.5)],
+    [car_state(1, 2., 11.), controls_state(2, 0.2, 6., output=0.25)],
+    [], None,
+  ),
+  "nested_ignore": (
+    [car_state(1, 1., 10.), controls_state(2, 0.1, 5.)],
+    [car_state(1, 2., 11.), controls_state(2, 0.1, 6.)],
+    ["carState.cruiseState.speed", "controlsState.cumLagMs"], None,
+  ),
+  "nested_ignore_only_difference": (
+    [car_state(1, 1., 10.)],
+    [car_state(1, 1., 11.)],
+    ["carState.cruiseState.speed"], None,
+  ),
+  # a field without a message type is ignored in every message
+  "wildcard_ignore": (
+    [car_state(1, 1.), controls_state(2, 0.1), car_state(3, 1.)],
+    [car_state(4, 1.), controls_state(5, 0.2), car_state(6, 2.)],
+    ["logMonoTime"], None,
+  ),
+  "wildcard_and_nested_ignore": (
+    [car_state(1, 1., 10.), controls_state(2, 0.1, 5.)],
+    [car_state(4, 1., 11.), controls_state(5, 0.1, 6.)],
+    ["logMonoTime", "carState.cruiseState.speed", "controlsState.cumLagMs"], None,
+  ),
+  "list_index_ignore": (
+    [car_state(1, buttons=[('accelCruise', True), ('decelCruise', True)])],
+    [car_state(1, buttons=[('accelCruise', False), ('decelCruise', False)])],
+    ["carState.buttonEvents.0.pressed"], None,
+  ),
+  "list_element_changed": (
+    [car_state(1, buttons=[('accelCruise', True), ('decelCruise', True)])],
+    [car_state(1, buttons=[('accelCruise', True), ('cancel', True)])],
+    [], None,
+  ),
+  "list_grown": (
+    [car_state(1, buttons=[('accelCruise', True)])],
+    [car_state(1, buttons=[('accelCruise', False), ('decelCruise', True), ('cancel', False)])],
+    [], None,
+  ),
+  "list_shrunk": (
+    [car_state(1, buttons=[('accelCruise', True), ('decelCruise', True), ('cancel', False)])],
+    [car_state(1, buttons=[('accelCruise', True)])],
+    ["logMonoTime"], None,
+  ),
+  "list_emptied": (
+    [car_state(1, 1., buttons=[('accelCruise', True)])],
+    [car_state(1, 2.)],
+    [], None,
+  ),
+  "within_tolerance": (
+    [car_state(1, 10., 20.), controls_state(2, 0.1)],
+    [car_state(1, 10.005, 20.01), controls_state(2, 0.1001)],
+    [], 1e-3,
+  ),
+  "outside_tolerance": (
+    [car_state(1, 10., 20.), controls_state(2, 0.1)],
+    [car_state(1, 10.5, 20.01), controls_state(2, 0.2)],
+    [], 1e-3,
+  ),
+  "nan": (
+    [car_state(1, float('nan')), car_state(2, 1.)],
+    [car_state(1, float('nan')), car_state(2, float('nan'))],
+    [], 1e-3,
+  ),
+  "union_which_changed": (
+    [controls_state(1, 0.1, lat_state='pidState', output=0.5)],
+    [controls_state(1, 0.1, lat_state='torqueState', output=0.5)],
+    [], None,
+  ),
+  "union_which_changed_with_ignores": (
+    [controls_state(1, 0.1, 5., lat_state='pidState'), car_state(2, 1.)],
+    [controls_state(2, 0.2, 6., lat_state='torqueState'), car_state(3, 1.)],
+    ["logMonoTime", "controlsState.cumLagMs"], None,
+  ),
+  "union_same_which": (
+    [controls_state(1, lat_state='torqueState', output=0.5)],
+    [controls_state(1, lat_state='torqueState', output=0.75)],
+    ["controlsState.cumLagMs"], None,
+  ),
+}
+
+
+class TestCompareLogs(unittest.TestCase):
+  @parameterized.expand(CASES.items())
+  def test_matches_dictdiffer(self, _, case):
+    log1, log2, ignore_fields, tolerance = case
+    expected = dictdiffer_compare_logs(log1, log2, ignore_fields, tolerance)
+    # compared as repr, nan != nan
+    self.assertEqual(repr(compare_logs(log1, log2, ignore_fields, tolerance=tolerance)), repr(expected))
+
+  @parameterized.expand(CASES.items())
+  def test_read_and_built_messages(self, _, case):
+    # messages read from bytes have no known segments, builders aren't modified by clearing ignored fields
+    log1, log2, ignore_fields, tolerance = case
+    expected = dictdiffer_compare_logs(log1, log2, ignore_fields, tolerance)
+    read_log = [next(log.Event.read_multiple_bytes(m.as_builder().to_bytes())) for m in log1]
+    built_log = [m.as_builder() for m in log2]
+    built_bytes = [m.to_bytes() for m in built_log]
+    self.assertEqual(repr(compare_logs(read_log, built_log, ignore_fields, tolerance=tolerance)), repr(expected))
+    self.assertEqual([m.to_bytes() for m in built_log], built_bytes)
+
+  def test_cases_differ(self):
+    # make sure the reference isn't trivially empty
+    for name in ("changed_fields", "nested_ignore", "wildcard_ignore", "list_grown", "list_shrunk", "outside_tolerance", "union_which_changed"):
+      log1, log2, ignore_fields, tolerance = CASES[name]
+      self.assertGreater(len(dictdiffer_compare_logs(log1, log2, ignore_fields, tolerance)), 0, name)
+
+  def test_ignore_msgs(self):
+    log1 = [car_state(1, 1.), controls_state(2, 0.1)]
+    log2 = [car_state(1, 1.), controls_state(2, 0.2), controls_state(3, 0.3)]
+    self.assertEqual(compare_logs(log1, log2, ignore_msgs=["controlsState"]), [])
+
+
+if __name__ == "__main__":
+  unittest.main()
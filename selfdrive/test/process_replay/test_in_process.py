@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+import unittest
+
+from parameterized import parameterized
+
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_process_diff
+from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, replay_process
+from openpilot.selfdrive.test.process_replay.test_processes import segments
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.openpilotci import get_url
+
+TESTED_SEGMENTS = [segments[3]]  # TOYOTA
+IN_PROCESS_CONFIGS = [cfg for cfg in CONFIGS if cfg.in_process]
+
+
+class TestInProcess(unittest.TestCase):
+  @parameterized.expand([(cfg.proc_name, cfg, segment) for _, segment in TESTED_SEGMENTS for cfg in IN_PROCESS_CONFIGS])
+  def test_same_output(self, proc_name, cfg, segment):
+    route, sidx = segment.rsplit("--", 1)
+    lr = LogReader(get_url(route, sidx))
+
+    ref_msgs = replay_process(cfg, lr, disable_progress=True)
+    # twice, so state left behind by the first in-process replay shows up as a difference
+    for _ in range(2):
+      log_msgs = replay_process(cfg, lr, disable_progress=True, in_process=True)
+      diff = compare_logs(ref_msgs, log_msgs)
+      self.assertEqual(len(diff), 0, f"{proc_name} differs when replayed in-process:\n{format_process_diff(diff)[0]}")
+
+
+if __name__ == "__main__":
+  unittest.main()
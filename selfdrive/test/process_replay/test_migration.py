@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+import unittest
+from functools import partial
+
+from parameterized import parameterized
+
+from cereal import messaging
+from openpilot.selfdrive.car.fingerprints import MIGRATION
+from openpilot.selfdrive.car.toyota.values import EPS_SCALE
+from openpilot.selfdrive.manager.process_config import managed_processes
+from openpilot.selfdrive.test.process_replay.migration import migrate, migrate_all, migration, migrate_cameraStates, migrate_carParams, \
+                                                              migrate_deviceState, migrate_gpsLocation, migrate_managerState, \
+                                                              migrate_pandaStates, migrate_peripheralState, migrate_sensorEvents
+from panda import Panda
+
+OLD_FINGERPRINT, NEW_FINGERPRINT = next(iter(MIGRATION.items()))
+
+
+def new_message(t, service, *args, valid=True):
+  msg = messaging.new_message(service, *args)
+  msg.logMonoTime = int(t * 1e9)
+  msg.valid = valid
+  return msg
+
+
+def init_data(t, device_type='tici'):
+  msg = new_message(t, 'initData')
+  msg.initData.deviceType = device_type
+  return msg.as_reader()
+
+
+def car_params(t, fingerprint, brand='', valid=False):
+  msg = new_message(t, 'carParams', valid=valid)
+  msg.carParams.carName = 'toyota'
+  msg.carParams.carFingerprint = fingerprint
+  msg.carParams.carFw = [{'ecu': 'eps', 'fwVersion': b'1', 'brand': brand}]
+  msg.carParams.safetyConfigs = [{'safetyModel': 'toyota', 'safetyParam': 73}]
+  return msg.as_reader()
+
+
+def device_state(t, device_type=None):
+  msg = new_message(t, 'deviceState')
+  if device_type is not None:
+    msg.deviceState.deviceType = device_type
+  return msg.as_reader()
+
+
+def panda_states(t, safety_param):
+  msg = new_message(t, 'pandaStates', 1)
+  msg.pandaStates[0].safetyParam = safety_param
+  return msg.as_reader()
+
+
+def panda_state_deprecated(t):
+  msg = new_message(t, 'pandaStateDEPRECATED', valid=False)
+  msg.pandaStateDEPRECATED.ignitionLine = True
+  return msg.as_reader()
+
+
+def camera_state(t, service, frame_id, timestamp_sof=0):
+  msg = new_message(t, service)
+  getattr(msg, service).frameId = frame_id
+  getattr(msg, service).timestampSof = timestamp_sof
+  getattr(msg, service).timestampEof = int(t * 1e9)
+  return msg.as_reader()
+
+
+def encode_idx(t, service, frame_id):
+  msg = new_message(t, service)
+  getattr(msg, service).frameId = frame_id
+  getattr(msg, service).segmentId = frame_id - 100
+  return msg.as_reader()
+
+
+def sensor_events(t):
+  msg = new_message(t, 'sensorEventsDEPRECATED', 2)
+  accel, gyro = msg.sensorEventsDEPRECATED
+  accel.version, accel.sensor, accel.type, accel.timestamp = 1, 1, 1, int(t * 1e9)
+  accel.init('acceleration').v = [0.5, 1.5, 9.5]
+  gyro.version, gyro.sensor, gyro.type, gyro.timestamp = 1, 5, 16, int(t * 1e9) + 1
+  gyro.init('gyroUncalibrated').v = [0.25, 0.5, 0.75]
+  return msg.as_reader()
+
+
+def gps_location(t, flags, has_fix):
+  msg = new_message(t, 'gpsLocationExternal')
+  msg.gpsLocationExternal.flags = flags
+  msg.gpsLocationExternal.hasFix = has_fix
+  return msg.as_reader()
+
+
+def run_migration(m, lr, **kwargs):
+  return list(migrate(lr, [partial(m, **kwargs)]))
+
+
+class TestMigrate(unittest.TestCase):
+  def test_stages(self):
+    calls = []
+
+    @migration(["deviceState"])
+    def split(lr):
+      def fn(msg):
+        calls.append(("split", msg.logMonoTime))
+        return [msg, device_state(msg.logMonoTime / 1e9 + 0.5)]
+      return fn
+
+    @migration(["deviceState", "initData"])
+    def drop_late(lr):
+      # set up once with the whole log
+      calls.append(("setup", len(lr)))
+      def fn(msg):
+        calls.append(("drop_late", msg.logMonoTime))
+        return [] if msg.logMonoTime > 2e9 else [msg]
+      return fn
+
+    @migration(["deviceState"])
+    def not_needed(lr):
+      return None
+
+    lr = [init_data(0), device_state(1), device_state(2)]
+    out = list(migrate(iter(lr), [split, not_needed, drop_late]))
+    self.assertEqual([m.logMonoTime for m in out], [0, int(1e9), int(1.5e9), int(2e9)])
+    self.assertIs(out[0], lr[0])
+    self.assertIs(out[1], lr[1])
+    # the messages returned by a migration only go through the later ones
+    self.assertEqual(calls, [("setup", 3), ("drop_late", 0), ("split", int(1e9)), ("drop_late", int(1e9)), ("drop_late", int(1.5e9)),
+                             ("split", int(2e9)), ("drop_late", int(2e9)), ("drop_late", int(2.5e9))])
+
+
+class TestMigrations(unittest.TestCase):
+  def test_managerState(self):
+    msg = run_migration(migrate_managerState, [new_message(1, 'managerState').as_reader()])[0]
+    self.assertEqual([(p.name, p.running) for p in msg.managerState.processes], [(name, True) for name in managed_processes])
+    self.assertEqual(msg.logMonoTime, int(1e9))
+
+  def test_gpsLocation(self):
+    lr = [gps_location(1, 1, False), gps_location(2, 1, True), gps_location(3, 0, False)]
+    out = run_migration(migrate_gpsLocation, lr)
+    self.assertEqual([m.gpsLocationExternal.hasFix for m in out], [True, True, False])
+    # messages that don't need it aren't copied
+    self.assertIs(out[1], lr[1])
+    self.assertIs(out[2], lr[2])
+
+  def test_deviceState(self):
+    lr = [init_data(0), device_state(1), device_state(2, 'tici')]
+    out = run_migration(migrate_deviceState, lr)
+    self.assertEqual([str(m.deviceState.deviceType) for m in out[1:]], ['tici', 'tici'])
+    self.assertEqual(out[1].logMonoTime, int(1e9))
+    self.assertIs(out[2], lr[2])
+
+  @parameterized.expand([(OLD_FINGERPRINT, 73), ("TOYOTA_PRIUS", EPS_SCALE["TOYOTA_PRIUS"] | Panda.FLAG_TOYOTA_STOCK_LONGITUDINAL)])
+  def test_pandaStates(self, fingerprint, safety_param):
+    lr = [car_params(0, fingerprint), panda_state_deprecated(1), panda_states(2, 0), panda_states(3, safety_param)]
+    out = run_migration(migrate_pandaStates, lr)
+    self.assertEqual([m.which() for m in out], ['carParams', 'pandaStates', 'pandaStates', 'pandaStates'])
+    self.assertEqual([m.pandaStates[-1].safetyParam for m in out[1:]], [safety_param] * 3)
+    self.assertTrue(out[1].pandaStates[0].ignitionLine)
+    self.assertEqual((out[1].valid, out[1].logMonoTime), (False, int(1e9)))
+    self.assertIs(out[3], lr[3])
+
+    with self.assertRaises(AssertionError):
+      run_migration(migrate_pandaStates, lr[1:])
+
+  def test_peripheralState(self):
+    lr = [panda_state_deprecated(1), panda_states(2, 0)]
+    out = run_migration(migrate_peripheralState, lr)
+    self.assertEqual([m.which() for m in out], ['pandaStateDEPRECATED', 'peripheralState', 'pandaStates', 'peripheralState'])
+    self.assertEqual([(m.valid, m.logMonoTime) for m in out[1::2]], [(False, int(1e9)), (True, int(2e9))])
+
+    # logs with a peripheralState are left alone
+    lr.append(new_message(3, 'peripheralState').as_reader())
+    self.assertEqual(run_migration(migrate_peripheralState, lr), lr)
+
+  def test_cameraStates(self):
+    lr = [
+      encode_idx(1, 'roadEncodeIdx', 100),
+      camera_state(1, 'roadCameraState', 100),
+      # dropped without an encode index
+      camera_state(1.05, 'roadCameraState', 101, 1000),
+      encode_idx(1.1, 'roadEncodeIdx', 102),
+      camera_state(1.1, 'roadCameraState', 102, 2000),
+      # the driver camera has no encode index and fakes it
+      camera_state(1.2, 'driverCameraState', 7),
+      camera_state(1.3, 'driverCameraState', 8),
+    ]
+    out = [m for m in run_migration(migrate_cameraStates, lr) if m.which().endswith('CameraState')]
+    states = [(m.which(), getattr(m, m.which())) for m in out]
+    self.assertEqual([(w, s.frameId, s.encodeId) for w, s in states],
+                     [('roadCameraState', 0, 0), ('roadCameraState', 2, 2), ('driverCameraState', 0, 0), ('driverCameraState', 1, 1)])
+    # a missing timestampSof is derived from timestampEof
+    self.assertEqual([s.timestampSof for _, s in states], [int(1e9) - 18000000, 2000, int(1.2e9) - 18000000, int(1.3e9) - 18000000])
+    self.assertEqual([m.logMonoTime for m in out], [int(1e9), int(1.1e9), int(1.2e9), int(1.3e9)])
+
+  @parameterized.expand([(False,), (True,)])
+  def test_carParams(self, old_logtime):
+    lr = [car_params(1, OLD_FINGERPRINT), car_params(2, NEW_FINGERPRINT, 'toyota', valid=True), car_params(3, NEW_FINGERPRINT, 'toyota'),
+          car_params(4, NEW_FINGERPRINT, valid=True)]
+    out = run_migration(migrate_carParams, lr, old_logtime=old_logtime)
+    for m in out:
+      self.assertEqual(m.carParams.carFingerprint, NEW_FINGERPRINT)
+      self.assertEqual([fw.brand for fw in m.carParams.carFw], ['toyota'])
+      self.assertEqual(m.carParams.safetyConfigs[0].safetyParam, 73)
+      self.assertTrue(m.valid)
+
+    if old_logtime:
+      self.assertEqual([m.logMonoTime for m in out], [m.logMonoTime for m in lr])
+      self.assertIs(out[1], lr[1])
+    else:
+      self.assertTrue(all(m1.logMonoTime != m2.logMonoTime for m1, m2 in zip(out, lr, strict=True)))
+
+  @parameterized.expand([(False,), (True,)])
+  def test_sensorEvents(self, old_logtime):
+    out = run_migration(migrate_sensorEvents, [sensor_events(1)], old_logtime=old_logtime)
+    self.assertEqual([m.which() for m in out], ['accelerometer', 'gyroscope'])
+    accel, gyro = out[0].accelerometer, out[1].gyroscope
+    self.assertEqual((accel.version, accel.sensor, accel.type, list(accel.acceleration.v)), (1, 1, 1, [0.5, 1.5, 9.5]))
+    self.assertEqual((gyro.version, gyro.sensor, gyro.type, list(gyro.gyroUncalibrated.v)), (1, 5, 16, [0.25, 0.5, 0.75]))
+    self.assertTrue(all(m.valid for m in out))
+    if old_logtime:
+      self.assertEqual([m.logMonoTime for m in out], [int(1e9)] * 2)
+      self.assertEqual([accel.timestamp, gyro.timestamp], [int(1e9), int(1e9) + 1])
+    else:
+      self.assertEqual([accel.timestamp, gyro.timestamp], [0, 0])
+
+  def test_migrate_all(self):
+    lr = [init_data(0), car_params(0.5, OLD_FINGERPRINT), device_state(1), panda_state_deprecated(2), sensor_events(3),
+          gps_location(4, 1, False), new_message(5, 'managerState').as_reader(), camera_state(6, 'driverCameraState', 7)]
+    out = migrate_all(iter(lr), old_logtime=True, manager_states=True, panda_states=True, camera_states=True)
+    self.assertEqual([m.which() for m in out], ['initData', 'carParams', 'deviceState', 'pandaStates', 'peripheralState', 'accelerometer',
+                                                'gyroscope', 'gpsLocationExternal', 'managerState', 'driverCameraState'])
+    self.assertEqual([m.logMonoTime for m in out], [int(t * 1e9) for t in (0, 0.5, 1, 2, 2, 3, 3, 4, 5, 6)])
+
+    # the optional migrations are off by default
+    out = migrate_all(lr)
+    self.assertEqual([m.which() for m in out], ['initData', 'carParams', 'deviceState', 'pandaStateDEPRECATED', 'accelerometer', 'gyroscope',
+                                                'gpsLocationExternal', 'managerState', 'driverCameraState'])
+    self.assertIs(out[-1], lr[-1])
+
+
+if __name__ == "__main__":
+  unittest.main()
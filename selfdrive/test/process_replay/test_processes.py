@@ -3,6 +3,7 @@ import argparse
 import concurrent.futures
 import os
 import sys
+import time
 from collections import defaultdict
 from tqdm import tqdm
 from typing import Any
@@ -11,7 +12,9 @@ from openpilot.common.git import get_commit
 from openpilot.selfdrive.car.car_helpers import interface_names
 from openpilot.tools.lib.openpilotci import get_url, upload_file
 from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_diff
-from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, check_openpilot_enabled, replay_process
+from openpilot.selfdrive.test.process_replay.migration import migrate_all
+from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, check_openpilot_enabled, \
+                                                                   get_migration_config, replay_process
 from openpilot.tools.lib.filereader import FileReader
 from openpilot.tools.lib.logreader import LogReader
 from openpilot.tools.lib.helpers import save_log
@@ -67,14 +70,16 @@ excluded_interfaces = ["mock", "tesla"]
 BASE_URL = "https://commadataci.blob.core.windows.net/openpilotci/"
 REF_COMMIT_FN = os.path.join(PROC_REPLAY_DIR, "ref_commit")
 EXCLUDED_PROCS = {"modeld", "dmonitoringmodeld"}
+MIGRATED_LOG_DIR = os.path.join(FAKEDATA, "migrated")
 
 
 def run_test_process(data):
-  segment, cfg, args, cur_log_fn, ref_log_path, lr_dat = data
+  segment, cfg, args, cur_log_fn, ref_log_path, log_fn = data
   res = None
+  start_time = time.monotonic()
   if not args.upload_only:
-    lr = LogReader.from_bytes(lr_dat)
-    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs)
+    lr = LogReader(log_fn)
+    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs, args.in_process, migrated=True)
     # save logs so we can upload when updating refs
     save_log(cur_log_fn, log_msgs)
 
@@ -83,16 +88,32 @@ def run_test_process(data):
     assert os.path.exists(cur_log_fn), f"Cannot find log to upload: {cur_log_fn}"
     upload_file(cur_log_fn, os.path.basename(cur_log_fn))
     os.remove(cur_log_fn)
-  return (segment, cfg.proc_name, res)
+  return (segment, cfg.proc_name, res, time.monotonic() - start_time)
 
 
-def get_log_data(segment):
+def get_log_data(data):
+  segment, cfgs = data
   r, n = segment.rsplit("--", 1)
   with FileReader(get_url(r, n)) as f:
-    return (segment, f.read())
-
-
-def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None):
+    dat = f.read()
+
+  # migrate once for all processes that need the same migrations, the replay workers load the migrated logs from disk
+  log_fns = {}
+  variant_fns: dict[str, str] = {}
+  for cfg in cfgs:
+    migration_config = get_migration_config([cfg])
+    variant = "_".join(k for k, v in sorted(migration_config.items()) if v)
+    if variant not in variant_fns:
+      msgs = migrate_all(LogReader.from_bytes(dat), **migration_config)
+      msgs.sort(key=lambda m: m.logMonoTime)
+      variant_fns[variant] = os.path.join(MIGRATED_LOG_DIR, f"{segment}_{variant}.raw")
+      with open(variant_fns[variant], "wb") as f:
+        f.write(b"".join(m.as_builder().to_bytes() for m in msgs))
+    log_fns[cfg.proc_name] = variant_fns[variant]
+  return (segment, log_fns)
+
+
+def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None, in_process=False, migrated=False):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
@@ -101,7 +122,7 @@ def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=Non
   ref_log_msgs = list(LogReader(ref_log_path))
 
   try:
-    log_msgs = replay_process(cfg, lr, disable_progress=True)
+    log_msgs = replay_process(cfg, lr, disable_progress=True, in_process=in_process, migrated=migrated)
   except Exception as e:
     raise Exception("failed on segment: " + segment) from e
 
@@ -141,6 +162,8 @@ if __name__ == "__main__":
                       help="Updates reference logs using current commit")
   parser.add_argument("--upload-only", action="store_true",
                       help="Skips testing processes and uploads logs from previous test run")
+  parser.add_argument("--in-process", action="store_true",
+                      help="Replay python processes in-process instead of in separate processes")
   parser.add_argument("-j", "--jobs", type=int, default=max(cpu_count - 2, 1),
                       help="Max amount of parallel jobs")
   args = parser.parse_args()
@@ -152,6 +175,7 @@ if __name__ == "__main__":
   full_test = (tested_procs == all_procs) and (tested_cars == all_cars) and all(len(x) == 0 for x in (args.ignore_fields, args.ignore_msgs))
   upload = args.update_refs or args.upload_only
   os.makedirs(os.path.dirname(FAKEDATA), exist_ok=True)
+  os.makedirs(MIGRATED_LOG_DIR, exist_ok=True)
 
   if upload:
     assert full_test, "Need to run full test when updating refs"
@@ -176,22 +200,20 @@ if __name__ == "__main__":
 
   log_paths: defaultdict[str, dict[str, dict[str, str]]] = defaultdict(lambda: defaultdict(dict))
   with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+    tested_cfgs = [cfg for cfg in CONFIGS if cfg.proc_name in tested_procs]
+    log_fns: dict[str, dict[str, str]] = {}
     if not args.upload_only:
       download_segments = [seg for car, seg in segments if car in tested_cars]
-      log_data: dict[str, LogReader] = {}
-      p1 = pool.map(get_log_data, download_segments)
-      for segment, lr in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
-        log_data[segment] = lr
+      p1 = pool.map(get_log_data, [(seg, tested_cfgs) for seg in download_segments])
+      for segment, fns in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
+        log_fns[segment] = fns
 
     pool_args: Any = []
     for car_brand, segment in segments:
       if car_brand not in tested_cars:
         continue
 
-      for cfg in CONFIGS:
-        if cfg.proc_name not in tested_procs:
-          continue
-
+      for cfg in tested_cfgs:
         cur_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{cur_commit}.bz2")
         if args.update_refs:  # reference logs will not exist if routes were just regenerated
           ref_log_path = get_url(*segment.rsplit("--", 1))
@@ -199,17 +221,24 @@ if __name__ == "__main__":
           ref_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{ref_commit}.bz2")
           ref_log_path = ref_log_fn if os.path.exists(ref_log_fn) else BASE_URL + os.path.basename(ref_log_fn)
 
-        dat = None if args.upload_only else log_data[segment]
-        pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, dat))
+        log_fn = None if args.upload_only else log_fns[segment][cfg.proc_name]
+        pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, log_fn))
 
         log_paths[segment][cfg.proc_name]['ref'] = ref_log_path
         log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
 
     results: Any = defaultdict(dict)
+    job_times: list[tuple[float, str, str]] = []
     p2 = pool.map(run_test_process, pool_args)
-    for (segment, proc, result) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
+    for (segment, proc, result, wall_time) in tqdm(p2, desc="Running Tests", total=len(pool_args)):
       if not args.upload_only:
         results[segment][proc] = result
+      job_times.append((wall_time, segment, proc))
+
+  print("\n***** job wall times *****")
+  for wall_time, segment, proc in sorted(job_times, reverse=True):
+    print(f"  {wall_time:8.2f}s  {proc:<20} {segment}")
+  print(f"  {sum(t for t, *_ in job_times):8.2f}s  total\n")
 
   diff_short, diff_long, failed = format_diff(results, log_paths, ref_commit)
   if not upload:
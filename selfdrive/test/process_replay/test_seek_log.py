@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import json
+import random
+import unittest
+
+from cereal import messaging
+from openpilot.selfdrive.test.process_replay.process_replay import seek_log
+
+START_MONO_TIME = 1_000_000_000_000
+
+
+def new_message(t, service):
+  msg = messaging.new_message(service)
+  msg.logMonoTime = START_MONO_TIME + int(t * 1e9)
+  return msg
+
+
+def car_params(t, fingerprint):
+  msg = new_message(t, 'carParams')
+  msg.carParams.carFingerprint = fingerprint
+  return msg.as_reader()
+
+
+def init_data(t, version):
+  msg = new_message(t, 'initData')
+  msg.initData.version = version
+  return msg.as_reader()
+
+
+def live_calibration(t, valid_blocks):
+  msg = new_message(t, 'liveCalibration')
+  msg.liveCalibration.validBlocks = valid_blocks
+  return msg.as_reader()
+
+
+def live_parameters(t, stiffness_factor):
+  msg = new_message(t, 'liveParameters')
+  msg.liveParameters.stiffnessFactor = stiffness_factor
+  return msg.as_reader()
+
+
+def car_states(start, end):
+  return [new_message(t, 'carState').as_reader() for t in range(start, end)]
+
+
+def mono_time(t):
+  return START_MONO_TIME + int(t * 1e9)
+
+
+class TestSeekLog(unittest.TestCase):
+  def make_log(self):
+    return [
+      init_data(0, "1"),
+      car_params(0.1, "FIRST"),
+      init_data(0.2, "2"),
+      live_calibration(5, 1),
+      live_parameters(6, 0.9),
+      car_params(7, "SECOND"),
+      live_calibration(8, 2),
+      live_calibration(12, 3),
+      car_params(20.5, "THIRD"),
+      *car_states(0, 31),
+    ]
+
+  def test_warmup_window(self):
+    lr = self.make_log()
+    random.shuffle(lr)
+    msgs, custom_params = seek_log(lr, 15., warmup=5.)
+
+    # the state before the window is restored, everything from warmup seconds before start_time is replayed
+    self.assertEqual([m.which() for m in msgs[:2]], ["initData", "carParams"])
+    self.assertEqual(msgs[0].initData.version, "2")
+    self.assertEqual(msgs[1].carParams.carFingerprint, "SECOND")
+    window = msgs[2:]
+    self.assertEqual(window, sorted(window, key=lambda m: m.logMonoTime))
+    self.assertEqual(min(m.logMonoTime for m in window), mono_time(10))
+    self.assertEqual(sum(m.which() == "carState" for m in window), 21)
+    self.assertEqual([m.liveCalibration.validBlocks for m in window if m.which() == "liveCalibration"], [3])
+    self.assertEqual([m.carParams.carFingerprint for m in window if m.which() == "carParams"], ["THIRD"])
+
+    # params hold the last state before the window
+    self.assertEqual(messaging.log_from_bytes(custom_params["CalibrationParams"]).liveCalibration.validBlocks, 2)
+    self.assertEqual(json.loads(custom_params["LiveParameters"])["carFingerprint"], "SECOND")
+    self.assertNotIn("LiveTorqueParameters", custom_params)
+
+  def test_window_at_start(self):
+    # nothing comes before the window when start_time is within the warmup
+    lr = self.make_log()
+    msgs, custom_params = seek_log(lr, 3., warmup=5.)
+    self.assertEqual(len(msgs), len(lr))
+    self.assertEqual(msgs, sorted(lr, key=lambda m: m.logMonoTime))
+    self.assertEqual(set(custom_params), {"CarParamsPrevRoute"})
+
+  def test_car_params_after_window_start(self):
+    lr = [init_data(0, "1"), *car_states(0, 31), car_params(20.5, "THIRD")]
+    msgs, custom_params = seek_log(lr, 15., warmup=5.)
+    self.assertEqual(msgs[0].which(), "initData")
+    # the first carParams of the window is used for the params, and not replayed twice
+    self.assertEqual([m.carParams.carFingerprint for m in msgs if m.which() == "carParams"], ["THIRD"])
+    self.assertEqual(custom_params["CarParamsPrevRoute"], lr[-1].carParams.as_builder().to_bytes())
+
+  def test_past_end(self):
+    lr = self.make_log()
+    msgs, _ = seek_log(lr, 30.)
+    self.assertEqual(msgs[-1].logMonoTime, mono_time(30))
+    with self.assertRaises(AssertionError):
+      seek_log(lr, 31.)
+    with self.assertRaises(AssertionError):
+      seek_log([], 0.)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -2,11 +2,11 @@
 import os
 import shutil
 import threading
+import time
 from openpilot.system.hardware.hw import Paths
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.config import get_available_bytes, get_available_percent
 from openpilot.system.loggerd.uploader import listdir_by_creation
-from openpilot.system.loggerd.xattr_cache import getxattr
+from openpilot.system.loggerd.xattr_cache import getxattr, invalidate
 
 MIN_BYTES = 5 * 1024 * 1024 * 1024
 MIN_PERCENT = 10
@@ -18,6 +18,45 @@ PRESERVE_ATTR_VALUE = b'1'
 PRESERVE_COUNT = 5
 
 
+class DirectorySizes:
+  """Disk usage of the log directories, only computed again when the mtime of a directory changes"""
+  def __init__(self):
+    self.sizes: dict[str, tuple[int, int]] = {}
+
+  @staticmethod
+  def _disk_usage(path: str) -> int:
+    size = 0
+    for entry in os.scandir(path):
+      if entry.is_dir(follow_symlinks=False):
+        size += DirectorySizes._disk_usage(entry.path)
+      else:
+        size += entry.stat(follow_symlinks=False).st_blocks * 512
+    return size
+
+  def get(self, path: str) -> int:
+    st = os.stat(path)
+    cached = self.sizes.get(path)
+    if cached is None or cached[0] != st.st_mtime_ns:
+      size = self._disk_usage(path) if os.path.isdir(path) else st.st_blocks * 512
+      cached = self.sizes[path] = (st.st_mtime_ns, size)
+    return cached[1]
+
+  def prune(self, paths: set[str]) -> None:
+    self.sizes = {path: v for path, v in self.sizes.items() if path in paths}
+
+
+def get_bytes_to_free() -> int:
+  """Bytes that need to be freed to have at least MIN_BYTES and MIN_PERCENT available again"""
+  try:
+    statvfs = os.statvfs(Paths.log_root())
+  except OSError:
+    return 0
+
+  available_bytes = statvfs.f_bavail * statvfs.f_frsize
+  min_percent_bytes = MIN_PERCENT / 100. * statvfs.f_blocks * statvfs.f_frsize
+  return max(MIN_BYTES - available_bytes, min_percent_bytes - available_bytes, 0)
+
+
 def has_preserve_xattr(d: str) -> bool:
   return getxattr(os.path.join(Paths.log_root(), d), PRESERVE_ATTR_NAME) == PRESERVE_ATTR_VALUE
 
@@ -44,33 +83,59 @@ def get_preserved_segments(dirs_by_creation: list[str]) -> list[str]:
   return preserved
 
 
-def deleter_thread(exit_event):
-  while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
+def get_dirs_to_delete(bytes_to_free: int, dir_sizes: DirectorySizes) -> list[str]:
+  """The paths to delete, earliest first, whose sizes add up to bytes_to_free, or all that can be deleted"""
+  dirs = listdir_by_creation(Paths.log_root())
+  dir_sizes.prune({os.path.join(Paths.log_root(), d) for d in dirs})
 
-    if out_of_percent or out_of_bytes:
-      dirs = listdir_by_creation(Paths.log_root())
+  # skip deleting most recent N preserved segments (and their prior segment)
+  preserved_dirs = get_preserved_segments(dirs)
 
-      # skip deleting most recent N preserved segments (and their prior segment)
-      preserved_dirs = get_preserved_segments(dirs)
+  delete_paths = []
+  delete_bytes = 0
+  for delete_dir in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
+    delete_path = os.path.join(Paths.log_root(), delete_dir)
+    try:
+      if any(name.endswith(".lock") for name in os.listdir(delete_path)):
+        continue
+      delete_bytes += dir_sizes.get(delete_path)
+    except OSError:
+      continue
+
+    delete_paths.append(delete_path)
+    if delete_bytes >= bytes_to_free:
+      break
+  return delete_paths
 
-      # remove the earliest directory we can
-      for delete_dir in sorted(dirs, key=lambda d: (d in DELETE_LAST, d in preserved_dirs)):
-        delete_path = os.path.join(Paths.log_root(), delete_dir)
 
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
-          continue
+def deleter_thread(exit_event: threading.Event, rate_limit: float | None = None):
+  """rate_limit optionally limits deleting to that many bytes/s, so deleting doesn't starve loggerd's writes"""
+  dir_sizes = DirectorySizes()
+  while not exit_event.is_set():
+    bytes_to_free = get_bytes_to_free()
+
+    if bytes_to_free > 0:
+      delete_paths = get_dirs_to_delete(bytes_to_free, dir_sizes)
+      cloudlog.info(f"deleting {len(delete_paths)} directories to free {bytes_to_free} bytes")
 
+      for delete_path in delete_paths:
+        if exit_event.is_set():
+          break
+
+        start_time = time.monotonic()
+        size = dir_sizes.sizes.get(delete_path, (0, 0))[1]
         try:
           cloudlog.info(f"deleting {delete_path}")
           if os.path.isfile(delete_path):
             os.remove(delete_path)
           else:
             shutil.rmtree(delete_path)
-          break
+          invalidate(delete_path)
         except OSError:
           cloudlog.exception(f"issue deleting {delete_path}")
+
+        if rate_limit is not None:
+          exit_event.wait(max(size / rate_limit - (time.monotonic() - start_time), 0))
       exit_event.wait(.1)
     else:
       exit_event.wait(30)
@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
+import os
 import time
 import threading
 import unittest
 from collections import namedtuple
+from unittest import mock
 from pathlib import Path
 from collections.abc import Sequence
 
 import openpilot.system.loggerd.deleter as deleter
 from openpilot.common.timeout import Timeout, TimeoutException
+from openpilot.system.hardware.hw import Paths
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
 
 Stats = namedtuple("Stats", ['f_bavail', 'f_blocks', 'f_frsize'])
@@ -46,25 +49,27 @@ class TestDeleter(UploaderTestCase):
       self.join_thread()
 
   def assertDeleteOrder(self, f_paths: Sequence[Path], timeout: int = 5) -> None:
+    # directories are deleted in batches, so record the order of the deletes instead of polling the files
     deleted_order = []
-
-    self.start_thread()
-    try:
-      with Timeout(timeout, "Timeout waiting for files to be deleted"):
-        while True:
-          for f in f_paths:
-            if not f.exists() and f not in deleted_order:
-              deleted_order.append(f)
-          if len(deleted_order) == len(f_paths):
-            break
-          time.sleep(0.01)
-    except TimeoutException:
-      print("Not deleted:", [f for f in f_paths if f not in deleted_order])
-      raise
-    finally:
-      self.join_thread()
-
-    self.assertEqual(deleted_order, f_paths, "Files not deleted in expected order")
+    rmtree = deleter.shutil.rmtree
+    def record_rmtree(path):
+      deleted_order.append(path)
+      rmtree(path)
+
+    with mock.patch.object(deleter.shutil, "rmtree", side_effect=record_rmtree):
+      self.start_thread()
+      try:
+        with Timeout(timeout, "Timeout waiting for files to be deleted"):
+          while any(f.exists() for f in f_paths):
+            time.sleep(0.01)
+      except TimeoutException:
+        print("Not deleted:", [f for f in f_paths if f.exists()])
+        raise
+      finally:
+        self.join_thread()
+
+    exp_order = [os.path.join(Paths.log_root(), f.parent.name) for f in f_paths]
+    self.assertEqual(deleted_order, exp_order, "Files not deleted in expected order")
 
   def test_delete_order(self):
     self.assertDeleteOrder([
@@ -92,6 +97,33 @@ class TestDeleter(UploaderTestCase):
       self.make_file_with_data("crash", self.seg_format2[:-4]),
     ])
 
+  def test_delete_batch(self):
+    f_paths = [self.make_file_with_data(self.seg_format.format(i), self.f_type, 1) for i in range(4)]
+    f_paths.append(self.make_file_with_data(self.seg_format.format(4), self.f_type, 1, lock=True))
+
+    # enough directories to free the requested bytes, earliest first, skipping locked ones
+    dir_sizes = deleter.DirectorySizes()
+    delete_paths = deleter.get_dirs_to_delete(int(1.5 * 1024 * 1024), dir_sizes)
+    self.assertEqual(delete_paths, [os.path.join(Paths.log_root(), f.parent.name) for f in f_paths[:2]])
+    delete_paths = deleter.get_dirs_to_delete(100 * 1024 * 1024, dir_sizes)
+    self.assertEqual(delete_paths, [os.path.join(Paths.log_root(), f.parent.name) for f in f_paths[:4]])
+
+  def test_dir_sizes_cached(self):
+    f_path = self.make_file_with_data(self.seg_dir, self.f_type, 1)
+    dir_sizes = deleter.DirectorySizes()
+    size = dir_sizes.get(str(f_path.parent))
+    self.assertGreaterEqual(size, 1024 * 1024)
+
+    # the size is only computed again when the directory changes
+    with mock.patch.object(deleter.DirectorySizes, "_disk_usage", side_effect=AssertionError("size computed again")):
+      self.assertEqual(dir_sizes.get(str(f_path.parent)), size)
+
+    self.make_file_with_data(self.seg_dir, "qlog", 1)
+    st = os.stat(f_path.parent)
+    # a new mtime, also on filesystems with a coarse timestamp granularity
+    os.utime(f_path.parent, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    self.assertGreaterEqual(dir_sizes.get(str(f_path.parent)), size + 1024 * 1024)
+
   def test_no_delete_when_available_space(self):
     f_path = self.make_file_with_data(self.seg_dir, self.f_type)
 
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import bz2
 import os
 import time
 import threading
@@ -6,10 +7,13 @@ import unittest
 import logging
 import json
 from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 from openpilot.system.hardware.hw import Paths
 
+import openpilot.system.loggerd.uploader as uploader
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.uploader import main, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+from openpilot.system.loggerd.uploader import main, compress_file, NetworkType, UploadConcurrency, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
 
 from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
 
@@ -37,6 +41,11 @@ log_handler = FakeLogHandler()
 cloudlog.addHandler(log_handler)
 
 
+def fake_put(url, data, headers, timeout):
+  content_length = len(data.read())
+  return SimpleNamespace(status_code=200, request=SimpleNamespace(headers={"Content-Length": str(content_length)}))
+
+
 class TestUploader(UploaderTestCase):
   def setUp(self):
     super().setUp()
@@ -165,6 +174,45 @@ class TestUploader(UploaderTestCase):
       uploaded = UPLOAD_ATTR_NAME in os.listxattr(fn) and os.getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
       self.assertFalse(uploaded, "File upload when locked")
 
+  def test_upload_new_and_unlocked_segments(self):
+    self.start_thread()
+
+    # segments that are created or closed while the uploader is running are picked up
+    time.sleep(0.25)
+    self.seg_dir = self.seg_format.format(self.seg_num)
+    self.gen_files(lock=False, boot=False)
+    self.seg_dir = self.seg_format.format(self.seg_num + 1)
+    f_paths = self.gen_files(lock=True, boot=False)
+    time.sleep(1)
+    for f_path in f_paths:
+      os.unlink(f_path.with_suffix(f_path.suffix + ".lock"))
+
+    time.sleep(5)
+    self.join_thread()
+
+    exp_order = self.gen_order([self.seg_num, self.seg_num + 1], [], boot=False)
+    self.assertEqual(log_handler.upload_order, exp_order, "Files not uploaded in order or uploaded twice")
+
+  def test_rescan_after_getxattr_failure(self):
+    f_paths = self.gen_files(lock=False, boot=False)
+    # old enough to not be listed again because of its mtime
+    os.utime(f_paths[0].parent, (time.time() - 3600, time.time() - 3600))
+
+    up = uploader.Uploader("0000000000000000", Paths.log_root())
+    qlog = str(f_paths[0])
+    getxattr = uploader.getxattr
+    def failing_getxattr(path, attr_name):
+      if path == qlog:
+        raise OSError("transient failure")
+      return getxattr(path, attr_name)
+
+    with mock.patch.object(uploader, "getxattr", side_effect=failing_getxattr):
+      up.index.update()
+    self.assertNotIn(qlog, [e[3] for e in up.index])
+
+    up.index.update()
+    self.assertIn(qlog, [e[3] for e in up.index], "File not picked up after a transient error")
+
   def test_no_upload_with_xattr(self):
     self.gen_files(lock=False, xattr=UPLOAD_ATTR_VALUE)
 
@@ -175,6 +223,59 @@ class TestUploader(UploaderTestCase):
 
     self.assertEqual(len(log_handler.upload_order), 0, "File uploaded again")
 
+  def test_compress_file(self):
+    f_path = self.make_file_with_data(self.seg_dir, "rlog", 3)
+    with open(f_path, "rb") as f:
+      self.assertEqual(compress_file(str(f_path)).read(), bz2.compress(f.read()))
+
+  def test_compress_once_per_file(self):
+    uploader.fake_upload = False
+    for i in range(2):
+      self.make_file_with_data(self.seg_format.format(i), "qlog", 1)
+
+    compressed = []
+    def compress(fn):
+      compressed.append(fn)
+      return compress_file(fn)
+
+    up = uploader.Uploader("0000000000000000", Paths.log_root())
+    with mock.patch.object(uploader, "compress_file", side_effect=compress), mock.patch.object(uploader.requests, "put", side_effect=fake_put):
+      # one file at a time, the second one is compressed while the first one uploads
+      while up.step(NetworkType.cell4G, False):
+        pass
+
+    self.assertEqual(log_handler.upload_order, [f"{self.seg_format.format(i)}/qlog.bz2" for i in range(2)])
+    self.assertEqual(len(compressed), 2)
+    self.assertEqual(len(set(compressed)), 2, "File compressed more than once")
+
+  def test_concurrent_upload(self):
+    uploader.fake_upload = False
+    seg_nums = [0, 1, 2, 3, 4, 5, 6]
+    for i in seg_nums:
+      self.seg_dir = self.seg_format.format(i)
+      self.gen_files()
+    exp_order = self.gen_order(seg_nums, [])
+
+    up = uploader.Uploader("0000000000000000", Paths.log_root())
+    up.concurrency.network_type = NetworkType.wifi
+    up.concurrency.n = 3
+    with mock.patch.object(uploader.requests, "put", side_effect=fake_put), \
+         mock.patch.object(up.concurrency, "update", wraps=up.concurrency.update) as update:
+      while up.step(NetworkType.wifi, False):
+        # files are picked in order, even if a batch finishes out of order
+        uploaded = set(log_handler.upload_order)
+        self.assertEqual(uploaded, set(exp_order[:len(uploaded)]), "Files uploaded in wrong order")
+
+    self.assertEqual(update.call_args_list[0].args[0], 3, "Files not uploaded concurrently")
+    self.assertTrue(len(log_handler.upload_ignored) == 0, "Some files were ignored")
+    self.assertEqual(sorted(log_handler.upload_order), sorted(exp_order), "Files not uploaded exactly once")
+    for f_path in exp_order:
+      self.assertEqual(os.getxattr((Path(Paths.log_root()) / f_path).with_suffix(""), UPLOAD_ATTR_NAME), UPLOAD_ATTR_VALUE, "All files not uploaded")
+
+    # throughput is measured on the compressed bytes that were sent
+    batch = [(Path(Paths.log_root()) / f_path).with_suffix("") for f_path in exp_order[:3]]
+    self.assertEqual(update.call_args_list[0].args[2], sum(len(compress_file(str(f)).read()) for f in batch))
+
   def test_clear_locks_on_startup(self):
     f_paths = self.gen_files(lock=True, boot=False)
     self.start_thread()
@@ -186,5 +287,38 @@ class TestUploader(UploaderTestCase):
       self.assertFalse(lock_path.is_file(), "File lock not cleared on startup")
 
 
+class TestUploadConcurrency(unittest.TestCase):
+  def simulate(self, concurrency, bandwidth, steps=50):
+    # every file takes one second to upload, the total throughput is limited by the bandwidth
+    for _ in range(steps):
+      n = concurrency.get(NetworkType.wifi, False)
+      concurrency.update(n, True, n * 100, max(1., n * 100 / bandwidth))
+
+  def test_grows_to_bandwidth(self):
+    concurrency = UploadConcurrency(max_uploads=8)
+    self.simulate(concurrency, bandwidth=400)
+    self.assertIn(concurrency.get(NetworkType.wifi, False), (4, 5))
+
+    # never more than max_uploads
+    self.simulate(concurrency, bandwidth=1e6)
+    self.assertLessEqual(concurrency.get(NetworkType.wifi, False), 8)
+    self.assertGreaterEqual(concurrency.get(NetworkType.wifi, False), 7)
+
+  def test_failure_halves(self):
+    concurrency = UploadConcurrency(max_uploads=8)
+    self.simulate(concurrency, bandwidth=1e6)
+    n = concurrency.get(NetworkType.wifi, False)
+    concurrency.update(n, False, 0, 1.)
+    self.assertEqual(concurrency.get(NetworkType.wifi, False), n // 2)
+
+  def test_single_upload_on_metered_and_cell(self):
+    concurrency = UploadConcurrency(max_uploads=8)
+    self.simulate(concurrency, bandwidth=1e6)
+    self.assertEqual(concurrency.get(NetworkType.wifi, True), 1)
+    self.assertEqual(concurrency.get(NetworkType.cell4G, False), 1)
+    # starts over when the network changes
+    self.assertEqual(concurrency.get(NetworkType.wifi, False), 1)
+
+
 if __name__ == "__main__":
   unittest.main()
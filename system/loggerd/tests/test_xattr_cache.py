@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from openpilot.system.loggerd.xattr_cache import XattrCache
+
+ATTR_NAME = 'user.test'
+
+
+class TestXattrCache(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+
+  def make_file(self, *parts: str, value: bytes = None) -> str:
+    fn = os.path.join(self.root, *parts)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    open(fn, "w").close()
+    if value is not None:
+      os.setxattr(fn, ATTR_NAME, value)
+    return fn
+
+  def test_get_set(self):
+    cache = XattrCache()
+    fn = self.make_file("seg", "qlog")
+    self.assertIsNone(cache.get(fn, ATTR_NAME))
+    cache.set(fn, ATTR_NAME, b'1')
+    self.assertEqual(cache.get(fn, ATTR_NAME), b'1')
+    self.assertEqual(cache.get(fn, ATTR_NAME), b'1')
+    self.assertEqual(cache.stats()["hits"], 1)
+    self.assertEqual(cache.stats()["misses"], 2)
+
+    with self.assertRaises(OSError):
+      cache.get(os.path.join(self.root, "missing"), ATTR_NAME)
+
+  def test_bounded(self):
+    cache = XattrCache(maxsize=10)
+    fns = [self.make_file("seg", f"f{i}") for i in range(30)]
+    for fn in fns:
+      cache.get(fn, ATTR_NAME)
+      cache.get(fns[0], ATTR_NAME)
+    self.assertEqual(len(cache), 10)
+    self.assertEqual(cache.stats()["evictions"], 20)
+
+    # the most recently used entry is kept
+    hits = cache.stats()["hits"]
+    cache.get(fns[0], ATTR_NAME)
+    self.assertEqual(cache.stats()["hits"], hits + 1)
+
+  def test_invalidate(self):
+    cache = XattrCache()
+    seg = os.path.join(self.root, "seg")
+    fns = [self.make_file("seg", name, value=b'1') for name in ("qlog", "rlog")]
+    other = self.make_file("other", "qlog", value=b'1')
+    os.setxattr(seg, ATTR_NAME, b'1')
+    for fn in fns + [seg, other]:
+      self.assertEqual(cache.get(fn, ATTR_NAME), b'1')
+
+    # a new directory with the same name doesn't return the old values
+    shutil.rmtree(seg)
+    cache.invalidate(seg + "/")
+    self.assertEqual(len(cache), 1)
+    fns = [self.make_file("seg", name) for name in ("qlog", "rlog")]
+    for fn in fns + [seg]:
+      self.assertIsNone(cache.get(fn, ATTR_NAME))
+    self.assertEqual(cache.get(other, ATTR_NAME), b'1')
+
+  def test_set_during_get(self):
+    cache = XattrCache()
+    fn = self.make_file("seg", "qlog", value=b'0')
+
+    # the value read by get is stale once set returns, so it must not be cached
+    getxattr = os.getxattr
+    def racing_getxattr(path, attr_name):
+      value = getxattr(path, attr_name)
+      cache.set(path, attr_name, b'1')
+      return value
+
+    with mock.patch("os.getxattr", side_effect=racing_getxattr):
+      self.assertEqual(cache.get(fn, ATTR_NAME), b'0')
+    self.assertEqual(cache.get(fn, ATTR_NAME), b'1')
+    self.assertEqual(len(cache._set_generation), 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
+import bisect
 import bz2
 import io
+import itertools
 import json
 import os
 import random
@@ -9,6 +11,7 @@ import threading
 import time
 import traceback
 import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import BinaryIO
 from collections.abc import Iterator
 
@@ -18,7 +21,7 @@ from openpilot.common.api import Api
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware.hw import Paths
-from openpilot.system.loggerd.xattr_cache import getxattr, setxattr
+from openpilot.system.loggerd.xattr_cache import getxattr, invalidate, setxattr
 from openpilot.common.swaglog import cloudlog
 
 NetworkType = log.DeviceState.NetworkType
@@ -26,6 +29,17 @@ UPLOAD_ATTR_NAME = 'user.upload'
 UPLOAD_ATTR_VALUE = b'1'
 
 UPLOAD_QLOG_QCAM_MAX_SIZE = 5 * 1e6  # MB
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+MAX_CONCURRENT_UPLOADS = 8
+# an extra concurrent upload needs to increase the total throughput by this much to be kept
+MIN_THROUGHPUT_GAIN = 0.1
+
+# directories modified more recently than this are listed again on the next update, in case
+# a change landed within the timestamp granularity of the mtime that was seen
+MTIME_GRACE_NS = 2 * 10**9
+# safety net in case the index missed a change
+INDEX_FULL_SCAN_INTERVAL = 600  # secs
 
 allow_sleep = bool(os.getenv("UPLOADER_SLEEP", "1"))
 force_wifi = os.getenv("FORCEWIFI") is not None
@@ -60,6 +74,23 @@ def listdir_by_creation(d: str) -> list[str]:
     cloudlog.exception("listdir_by_creation failed")
     return []
 
+def get_upload_key(key: str) -> str:
+  # qlogs and bootlogs need to be compressed before uploading
+  if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.bz2')):
+    key += ".bz2"
+  return key
+
+def compress_file(fn: str) -> io.BytesIO:
+  """bz2 compresses fn in chunks, so only the compressed file is held in memory"""
+  compressor = bz2.BZ2Compressor()
+  data = io.BytesIO()
+  with open(fn, "rb") as f:
+    while len(chunk := f.read(UPLOAD_CHUNK_SIZE)):
+      data.write(compressor.compress(chunk))
+  data.write(compressor.flush())
+  data.seek(0)
+  return data
+
 def clear_locks(root: str) -> None:
   for logdir in os.listdir(root):
     path = os.path.join(root, logdir)
@@ -71,6 +102,170 @@ def clear_locks(root: str) -> None:
       cloudlog.exception("clear_locks failed")
 
 
+class UploadIndex:
+  """The files that are candidates for upload, kept in upload order. Instead of listing every log directory
+  to pick each file, directories are only listed again when their mtime changes, and only the ones that can
+  still change are checked: the log root, segments that are being written (locked) and the immediate folders."""
+  def __init__(self, root: str, immediate_folders: list[str], immediate_priority: dict[str, int]):
+    self.root = root
+    self.immediate_folders = immediate_folders
+    self.immediate_priority = immediate_priority
+
+    # (sort key, name, key, fn, logdir, ctime) in upload order
+    self.entries: list[tuple] = []
+    self.files: dict[str, tuple] = {}
+    self.dir_files: dict[str, list[str]] = {}
+    # last seen mtime of the root and of every directory that can still change
+    self.mtimes: dict[str, int] = {}
+    self.last_full_scan: float | None = None
+    # files are discarded by the upload threads
+    self.lock = threading.Lock()
+
+  def __iter__(self):
+    return iter(self.entries)
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+  def _changed(self, path: str) -> bool:
+    mtime = os.stat(path).st_mtime_ns
+    changed = self.mtimes.get(path) != mtime or time.time_ns() - mtime < MTIME_GRACE_NS
+    self.mtimes[path] = mtime
+    return changed
+
+  def discard(self, fn: str) -> None:
+    with self.lock:
+      entry = self.files.pop(fn, None)
+      if entry is not None:
+        del self.entries[bisect.bisect_left(self.entries, entry)]
+
+  def _remove_dir(self, logdir: str) -> None:
+    for fn in self.dir_files.pop(logdir, []):
+      self.discard(fn)
+    self.mtimes.pop(os.path.join(self.root, logdir), None)
+
+  def _scan_dir(self, logdir: str) -> None:
+    self._remove_dir(logdir)
+    path = os.path.join(self.root, logdir)
+    try:
+      # stat before listing, so anything added during the listing changes the mtime seen next time
+      mtime = os.stat(path).st_mtime_ns
+      names = os.listdir(path)
+    except OSError:
+      # try again on the next update
+      self.dir_files[logdir] = []
+      self.mtimes[path] = 0
+      return
+
+    locked = any(name.endswith(".lock") for name in names)
+    immediate = any(f in os.path.join(path, "") for f in self.immediate_folders)
+    if locked or immediate or time.time_ns() - mtime < MTIME_GRACE_NS:
+      self.mtimes[path] = mtime
+
+    self.dir_files[logdir] = []
+    if locked:
+      return
+
+    dir_sort = get_directory_sort(logdir)
+    failed = False
+    for name in names:
+      key = os.path.join(logdir, name)
+      fn = os.path.join(path, name)
+      # only files in the immediate folders or with an immediate priority are uploaded
+      is_immediate = any(f in fn for f in self.immediate_folders)
+      if not is_immediate and name not in self.immediate_priority:
+        continue
+
+      # skip files already uploaded
+      try:
+        ctime = os.path.getctime(fn)
+        is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+      except OSError:
+        cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
+        # deleter could have deleted, so skip. the error could also be transient, so list the directory again
+        failed = True
+        continue
+      if is_uploaded:
+        continue
+
+      entry = ((not is_immediate, dir_sort, self.immediate_priority.get(name, 1000), name), name, key, fn, logdir, ctime)
+      bisect.insort(self.entries, entry)
+      self.files[fn] = entry
+      self.dir_files[logdir].append(fn)
+
+    if failed:
+      self.mtimes[path] = 0
+
+  def update(self) -> None:
+    if self.last_full_scan is None or time.monotonic() - self.last_full_scan > INDEX_FULL_SCAN_INTERVAL:
+      self.last_full_scan = time.monotonic()
+      for logdir in list(self.dir_files):
+        self._remove_dir(logdir)
+      self.mtimes.clear()
+
+    try:
+      root_changed = self._changed(self.root)
+    except OSError:
+      root_changed = True
+
+    if root_changed:
+      logdirs = listdir_by_creation(self.root)
+      for logdir in set(self.dir_files) - set(logdirs):
+        self._remove_dir(logdir)
+        invalidate(os.path.join(self.root, logdir))
+      for logdir in logdirs:
+        if logdir not in self.dir_files:
+          self._scan_dir(logdir)
+
+    for path in list(self.mtimes):
+      if path == self.root:
+        continue
+      logdir = os.path.relpath(path, self.root)
+      try:
+        changed = self._changed(path)
+      except OSError:
+        changed = True
+      if changed:
+        self._scan_dir(logdir)
+
+
+class UploadConcurrency:
+  """How many files are uploaded at once. On unmetered wifi and ethernet this grows by one for as long as that
+  increases the total throughput, and halves when uploads fail. Other networks upload one file at a time."""
+  def __init__(self, max_uploads: int = MAX_CONCURRENT_UPLOADS):
+    self.max_uploads = max_uploads
+    self.n = 1
+    self.network_type: int | None = None
+    # last measured total throughput in bytes/s for each number of concurrent uploads
+    self.throughput: dict[int, float] = {}
+
+  def get(self, network_type: int, metered: bool) -> int:
+    if network_type != self.network_type:
+      self.network_type = network_type
+      self.n = 1
+      self.throughput.clear()
+
+    if metered or network_type not in (NetworkType.wifi, NetworkType.ethernet):
+      return 1
+    return self.n
+
+  def update(self, n: int, success: bool, nbytes: int, dt: float) -> None:
+    if not success:
+      self.n = max(self.n // 2, 1)
+      self.throughput.clear()
+      return
+
+    # fewer files than allowed were uploaded, which says little about the throughput at n
+    if n != self.n or dt <= 0:
+      return
+
+    self.throughput[n] = nbytes / dt
+    if self.throughput[n] > self.throughput.get(n - 1, 0.) * (1 + MIN_THROUGHPUT_GAIN):
+      self.n = min(n + 1, self.max_uploads)
+    else:
+      self.n = max(n - 1, 1)
+
+
 class Uploader:
   def __init__(self, dongle_id: str, root: str):
     self.dongle_id = dongle_id
@@ -84,58 +279,35 @@ class Uploader:
 
     self.immediate_folders = ["crash/", "boot/"]
     self.immediate_priority = {"qlog": 0, "qlog.bz2": 0, "qcamera.ts": 1}
+    self.index = UploadIndex(root, self.immediate_folders, self.immediate_priority)
+
+    # the next file is compressed while the current one uploads, bz2 releases the GIL
+    self.compress_pool = ThreadPoolExecutor(max_workers=1)
+    self.compressed: dict[str, Future] = {}
+
+    self.concurrency = UploadConcurrency()
+    self.upload_pool = ThreadPoolExecutor(max_workers=self.concurrency.max_uploads)
 
   def list_upload_files(self, metered: bool) -> Iterator[tuple[str, str, str]]:
     r = self.params.get("AthenadRecentlyViewedRoutes", encoding="utf8")
     requested_routes = [] if r is None else r.split(",")
 
-    for logdir in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logdir)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
-
-      if any(name.endswith(".lock") for name in names):
-        continue
-
-      for name in sorted(names, key=lambda n: self.immediate_priority.get(n, 1000)):
-        key = os.path.join(logdir, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          ctime = os.path.getctime(fn)
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
-          # deleter could have deleted, so skip
-          continue
-        if is_uploaded:
+    self.index.update()
+    for _, name, key, fn, logdir, ctime in self.index:
+      # limit uploading on metered connections
+      if metered:
+        dt = datetime.timedelta(hours=12)
+        if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
           continue
 
-        # limit uploading on metered connections
-        if metered:
-          dt = datetime.timedelta(hours=12)
-          if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
-            continue
-
-          if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
-            continue
+        if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
+          continue
 
-        yield name, key, fn
+      yield name, key, fn
 
   def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
-    upload_files = list(self.list_upload_files(metered))
-
-    for name, key, fn in upload_files:
-      if any(f in fn for f in self.immediate_folders):
-        return name, key, fn
-
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return name, key, fn
-
-    return None
+    # files in the immediate folders come first, then the ones with an immediate priority
+    return next(self.list_upload_files(metered), None)
 
   def do_upload(self, key: str, fn: str):
     url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
@@ -150,22 +322,43 @@ class Uploader:
     if fake_upload:
       return FakeResponse()
 
+    if key.endswith('.bz2') and not fn.endswith('.bz2'):
+      future = self.compressed.pop(fn, None)
+      data: BinaryIO = compress_file(fn) if future is None else future.result()
+      return requests.put(url, data=data, headers=headers, timeout=10)
+
     with open(fn, "rb") as f:
-      data: BinaryIO
-      if key.endswith('.bz2') and not fn.endswith('.bz2'):
-        compressed = bz2.compress(f.read())
-        data = io.BytesIO(compressed)
-      else:
-        data = f
+      return requests.put(url, data=f, headers=headers, timeout=10)
 
-      return requests.put(url, data=data, headers=headers, timeout=10)
+  def prefetch(self, name: str, key: str, fn: str, keep: set[str]) -> None:
+    """Starts compressing the file that is likely uploaded next, compressions of other files than the ones
+    in keep are dropped"""
+    for other_fn in set(self.compressed) - keep - {fn}:
+      self.compressed.pop(other_fn).cancel()
+
+    if not get_upload_key(key).endswith('.bz2') or fn.endswith('.bz2') or fn in self.compressed:
+      return
+
+    try:
+      sz = os.path.getsize(fn)
+    except OSError:
+      return
+    if sz == 0 or (name in self.immediate_priority and sz > UPLOAD_QLOG_QCAM_MAX_SIZE):
+      return
+
+    self.compressed[fn] = self.compress_pool.submit(compress_file, fn)
 
   def upload(self, name: str, key: str, fn: str, network_type: int, metered: bool) -> bool:
+    return self._upload(name, key, fn, network_type, metered)[0]
+
+  def _upload(self, name: str, key: str, fn: str, network_type: int, metered: bool) -> tuple[bool, int]:
+    """Returns whether the upload succeeded and how many bytes were sent"""
+    content_length = 0
     try:
       sz = os.path.getsize(fn)
     except OSError:
       cloudlog.exception("upload: getsize failed")
-      return False
+      return False, content_length
 
     cloudlog.event("upload_start", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
 
@@ -204,24 +397,42 @@ class Uploader:
       # tag file as uploaded
       try:
         setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+        self.index.discard(fn)
       except OSError:
         cloudlog.event("uploader_setxattr_failed", exc=last_exc, key=key, fn=fn, sz=sz)
 
-    return success
+    return success, content_length
 
 
   def step(self, network_type: int, metered: bool) -> bool | None:
-    d = self.next_file_to_upload(metered)
-    if d is None:
+    n = self.concurrency.get(network_type, metered)
+    upload_files = list(itertools.islice(self.list_upload_files(metered), n + 1))
+    if len(upload_files) == 0:
       return None
 
-    name, key, fn = d
-
-    # qlogs and bootlogs need to be compressed before uploading
-    if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.bz2')):
-      key += ".bz2"
-
-    return self.upload(name, key, fn, network_type, metered)
+    batch = upload_files[:n]
+    batch_fns = {fn for _, _, fn in batch}
+    if len(upload_files) > n:
+      # the files of this batch may have been prefetched in the last step
+      self.prefetch(*upload_files[n], keep=batch_fns)
+
+    def upload(f: tuple[str, str, str]) -> tuple[bool, int]:
+      name, key, fn = f
+      return self._upload(name, get_upload_key(key), fn, network_type, metered)
+
+    start_time = time.monotonic()
+    results = [upload(batch[0])] if len(batch) == 1 else list(self.upload_pool.map(upload, batch))
+    success = [r[0] for r in results]
+    # throughput of what was actually sent, i.e. after compression
+    nbytes = sum(r[1] for r in results)
+    self.concurrency.update(len(batch), all(success), nbytes, time.monotonic() - start_time)
+
+    # compressions that weren't used, e.g. the upload was ignored
+    for fn in batch_fns:
+      self.compressed.pop(fn, None)
+
+    # any upload that went through resets the backoff
+    return any(success)
 
 
 def main(exit_event: threading.Event = None) -> None:
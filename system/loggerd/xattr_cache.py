@@ -1,22 +1,127 @@
 import os
 import errno
+import threading
+from collections import OrderedDict
 
-_cached_attributes: dict[tuple, bytes | None] = {}
+MAX_CACHED_ATTRIBUTES = 10000
 
-def getxattr(path: str, attr_name: str) -> bytes | None:
-  key = (path, attr_name)
-  if key not in _cached_attributes:
+
+def _parent(path: str) -> str:
+  return os.path.dirname(os.path.normpath(path))
+
+
+class XattrCache:
+  """LRU cache of extended attributes. Entries can be invalidated per directory, which drops the
+  directory and the files directly in it, e.g. when a log directory is deleted."""
+  def __init__(self, maxsize: int = MAX_CACHED_ATTRIBUTES):
+    self.maxsize = maxsize
+    self.lock = threading.Lock()
+    self._cache: OrderedDict[tuple[str, str], bytes | None] = OrderedDict()
+    # parent directory -> cached keys of the files in it
+    self._keys_by_dir: dict[str, set[tuple[str, str]]] = {}
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    # a get that raced with a set of the same key must not cache the value it read. every set gets a
+    # generation, and keys set while reads are in flight remember theirs until no read is in flight
+    self._generation = 0
+    self._reads = 0
+    self._set_generation: dict[tuple[str, str], int] = {}
+
+  def __len__(self) -> int:
+    return len(self._cache)
+
+  def _put(self, key: tuple[str, str], value: bytes | None) -> None:
+    self._cache[key] = value
+    self._cache.move_to_end(key)
+    self._keys_by_dir.setdefault(_parent(key[0]), set()).add(key)
+    while len(self._cache) > self.maxsize:
+      self._pop(next(iter(self._cache)))
+      self.evictions += 1
+
+  def _pop(self, key: tuple[str, str]) -> None:
+    if key not in self._cache:
+      return
+    del self._cache[key]
+    parent = _parent(key[0])
+    keys = self._keys_by_dir[parent]
+    keys.discard(key)
+    if len(keys) == 0:
+      del self._keys_by_dir[parent]
+
+  @staticmethod
+  def _read(path: str, attr_name: str) -> bytes | None:
     try:
-      response = os.getxattr(path, attr_name)
+      return os.getxattr(path, attr_name)
     except OSError as e:
       # ENODATA means attribute hasn't been set
       if e.errno == errno.ENODATA:
-        response = None
-      else:
-        raise
-    _cached_attributes[key] = response
-  return _cached_attributes[key]
+        return None
+      raise
+
+  def get(self, path: str, attr_name: str) -> bytes | None:
+    key = (path, attr_name)
+    with self.lock:
+      if key in self._cache:
+        self.hits += 1
+        self._cache.move_to_end(key)
+        return self._cache[key]
+      self.misses += 1
+      generation = self._generation
+      self._reads += 1
+
+    try:
+      response = self._read(path, attr_name)
+      with self.lock:
+        if self._set_generation.get(key, generation) <= generation:
+          self._put(key, response)
+    finally:
+      with self.lock:
+        self._reads -= 1
+        if self._reads == 0:
+          self._set_generation.clear()
+    return response
+
+  def set(self, path: str, attr_name: str, attr_value: bytes) -> None:
+    os.setxattr(path, attr_name, attr_value)
+    key = (path, attr_name)
+    with self.lock:
+      self._pop(key)
+      self._generation += 1
+      if self._reads > 0:
+        self._set_generation[key] = self._generation
+
+  def invalidate(self, path: str) -> None:
+    path = os.path.normpath(path)
+    with self.lock:
+      for key in list(self._keys_by_dir.get(path, ())):
+        self._pop(key)
+      for key in [key for key in self._keys_by_dir.get(os.path.dirname(path), ()) if os.path.normpath(key[0]) == path]:
+        self._pop(key)
+
+  def stats(self) -> dict[str, int | float]:
+    with self.lock:
+      total = self.hits + self.misses
+      return {
+        "size": len(self._cache),
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "hit_rate": self.hits / total if total else 0.,
+      }
+
+
+_cache = XattrCache()
+
+def getxattr(path: str, attr_name: str) -> bytes | None:
+  return _cache.get(path, attr_name)
 
 def setxattr(path: str, attr_name: str, attr_value: bytes) -> None:
-  _cached_attributes.pop((path, attr_name), None)
-  return os.setxattr(path, attr_name, attr_value)
+  return _cache.set(path, attr_name, attr_value)
+
+def invalidate(path: str) -> None:
+  """Drops the cached attributes of path and the files directly in it, call after deleting it"""
+  _cache.invalidate(path)
+
+def cache_stats() -> dict[str, int | float]:
+  return _cache.stats()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import shutil
+from collections import defaultdict
+from collections.abc import Iterable
+
+import capnp
+import numpy as np
+
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.tools.lib.cache import DEFAULT_CACHE_DIR, cache_path_for_file_path
+from openpilot.tools.lib.logreader import LogIterable, LogReader, log_version
+
+COLUMNAR_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "columnar")
+TIME_FIELD = "logMonoTime"
+
+
+def _split_field(field: str) -> tuple[str, list[str]]:
+  service, *path = field.split(".")
+  if len(path) == 0:
+    raise ValueError(f"Field {field!r} must be of the form 'service.field'")
+  return service, path
+
+
+def _to_value(v):
+  if isinstance(v, capnp.lib.capnp._DynamicEnum):
+    return str(v)
+  elif isinstance(v, capnp.lib.capnp._DynamicListReader):
+    return [_to_value(x) for x in v]
+  elif isinstance(v, capnp.lib.capnp._DynamicStructReader):
+    raise ValueError(f"Cannot store struct {v.schema.node.displayName} as a column, select one of its fields")
+  return v
+
+
+def _to_column(values: list, dtype=None):
+  try:
+    return np.array(values, dtype=dtype)
+  except ValueError:
+    # ragged lists
+    col = np.empty(len(values), dtype=object)
+    col[:] = values
+    return col
+
+
+def extract_columns(lr: LogIterable, fields: Iterable[str]) -> dict[str, np.ndarray]:
+  """Decodes fields such as "carState.vEgo" from lr in a single pass. The logMonoTime of every event of a
+  requested service is returned as "<service>.logMonoTime"."""
+  paths: dict[str, list[tuple[str, list[str]]]] = defaultdict(list)
+  for field in fields:
+    service, path = _split_field(field)
+    if path == [TIME_FIELD]:
+      # always extracted for every requested service
+      paths.setdefault(service, [])
+    else:
+      paths[service].append((field, path))
+
+  values: dict[str, list] = {f"{service}.{TIME_FIELD}": [] for service in paths}
+  values.update({field: [] for service_paths in paths.values() for field, _ in service_paths})
+
+  for msg in lr:
+    which = msg.which()
+    if which not in paths:
+      continue
+
+    values[f"{which}.{TIME_FIELD}"].append(msg.logMonoTime)
+    evt = getattr(msg, which)
+    for field, path in paths[which]:
+      v = evt
+      for name in path:
+        v = getattr(v, name)
+      values[field].append(_to_value(v))
+
+  return {field: _to_column(v, np.int64 if field.endswith(f".{TIME_FIELD}") else None) for field, v in values.items()}
+
+
+def _column_path(segment_dir: str, field: str) -> str:
+  return os.path.join(segment_dir, f"{field}.npy")
+
+
+def _load_segment_columns(fn: str, fields: list[str], cache_dir: str) -> dict[str, np.ndarray]:
+  segment_dir = cache_path_for_file_path(fn, cache_dir)
+  version_path = os.path.join(segment_dir, "version")
+
+  # columns are only reused for the same version of the log, which is known without reading it
+  version = log_version(fn)
+  try:
+    with open(version_path) as f:
+      cached_version = f.read()
+  except OSError:
+    cached_version = None
+  if version is None or cached_version != version:
+    shutil.rmtree(segment_dir, ignore_errors=True)
+  os.makedirs(segment_dir, exist_ok=True)
+
+  # the log is only read for missing columns
+  missing = [f for f in fields if not os.path.exists(_column_path(segment_dir, f))]
+  if len(missing) > 0:
+    for field, col in extract_columns(LogReader(fn), missing).items():
+      with atomic_write_in_dir(_column_path(segment_dir, field), mode="wb", overwrite=True) as f:
+        np.save(f, col, allow_pickle=bool(col.dtype == object))
+    # written last, columns of an interrupted extraction are discarded
+    if version is not None:
+      with atomic_write_in_dir(version_path, mode="w", overwrite=True) as f:
+        f.write(version)
+
+  return {f: np.load(_column_path(segment_dir, f), allow_pickle=True) for f in fields}
+
+
+def _concatenate(cols: list[np.ndarray], field: str) -> np.ndarray:
+  # the empty column of a segment without the service has no dtype of its own, it mustn't promote the others
+  non_empty = [col for col in cols if len(col) > 0]
+  if len(non_empty) > 0:
+    return np.concatenate(non_empty)
+  return np.array([], dtype=np.int64 if field.endswith(f".{TIME_FIELD}") else None)
+
+
+def query(identifier: str | list[str], fields: Iterable[str], cache_dir: str = COLUMNAR_CACHE_DIR, **kwargs) -> dict[str, np.ndarray]:
+  """Returns the requested fields across all segments of identifier as arrays, plus the logMonoTime of
+  each requested service. Columns are cached per segment, so only fields not queried before are decoded.
+  kwargs are passed to LogReader to resolve the segments."""
+  fields = list(dict.fromkeys(fields))
+  time_fields = [f"{service}.{TIME_FIELD}" for service in sorted({_split_field(f)[0] for f in fields})]
+  all_fields = time_fields + [f for f in fields if f not in time_fields]
+
+  segment_columns = [_load_segment_columns(fn, all_fields, cache_dir) for fn in LogReader(identifier, **kwargs).logreader_identifiers]
+  return {f: _concatenate([cols[f] for cols in segment_columns], f) for f in all_fields}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Export fields from a route to a columnar npz file",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("route", help="The route, segment range or log to export")
+  parser.add_argument("fields", nargs="+", help="Fields to export, e.g. carState.vEgo controlsState.curvature")
+  parser.add_argument("--out", default="columns.npz", help="Output npz file")
+  args = parser.parse_args()
+
+  columns = query(args.route, args.fields)
+  np.savez(args.out, **columns)
+  for field, col in columns.items():
+    print(f"{field}: {col.dtype} {col.shape}")
@@ -1,3 +1,4 @@
+import mmap
 import os
 import socket
 from urllib.parse import urlparse
@@ -31,8 +32,60 @@ def file_exists(fn):
   return os.path.exists(fn)
 
 
-def FileReader(fn, debug=False):
+class MappedFileReader:
+  """Read-only memory map of a local file. Supports the file API used by the readers,
+  plus zero-copy access to byte ranges through view()."""
+  def __init__(self, fn):
+    self.name = fn
+    self.closed = False
+    self._pos = 0
+    with open(fn, "rb") as f:
+      # mmap keeps its own handle to the file open until closed
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size > 0 else None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback) -> None:
+    self.close()
+
+  def __len__(self) -> int:
+    return len(self._mm) if self._mm is not None else 0
+
+  def view(self, start: int = 0, end: int | None = None) -> memoryview:
+    if self.closed:
+      raise ValueError("I/O operation on closed file")
+    if self._mm is None:
+      return memoryview(b"")
+    return memoryview(self._mm)[start:end]
+
+  def read(self, ll: int | None = None) -> bytes:
+    end = len(self) if ll is None else min(self._pos + ll, len(self))
+    dat = bytes(self.view(self._pos, end))
+    self._pos = max(self._pos, end)
+    return dat
+
+  def seek(self, pos: int) -> None:
+    self._pos = pos
+
+  def tell(self) -> int:
+    return self._pos
+
+  def close(self) -> None:
+    self.closed = True
+    if self._mm is not None:
+      try:
+        self._mm.close()
+      except BufferError:
+        # views are still alive, the map is released once they are garbage collected
+        pass
+      self._mm = None
+
+
+def FileReader(fn, debug=False, use_mmap=False):
   fn = resolve_name(fn)
   if fn.startswith(("http://", "https://")):
     return URLFile(fn, debug=debug)
+  if use_mmap:
+    return MappedFileReader(fn)
   return open(fn, "rb")
@@ -1,16 +1,22 @@
 import json
 import os
 import pickle
+import queue
 import struct
 import subprocess
 import threading
+from collections import OrderedDict
 from enum import IntEnum
 from functools import wraps
 
 import numpy as np
-from lru import LRU
 
 import _io
+try:
+  import av
+except ImportError:
+  av = None
+
 from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR
 from openpilot.tools.lib.exceptions import DataUnreadableError
 from openpilot.tools.lib.vidindex import hevc_index
@@ -25,7 +31,7 @@ HEVC_SLICE_I = 2
 
 class GOPReader:
   def get_gop(self, num):
-    # returns (start_frame_num, num_frames, frames_to_skip, gop_data)
+    # returns (start_frame_num, num_frames, frames_to_skip, gop_prefix, gop_data)
     raise NotImplementedError
 
 
@@ -166,7 +172,7 @@ def rgb24tonv12(rgb):
   return nv12.clip(0, 255).astype('uint8')
 
 
-def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
+def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt, prefix=b""):
   threads = os.getenv("FFMPEG_THREADS", "0")
   cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
   args = ["ffmpeg", "-v", "quiet",
@@ -181,7 +187,16 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
           "-f", "rawvideo",
           "-pix_fmt", pix_fmt,
           "-"]
-  dat = subprocess.check_output(args, input=rawdat)
+  with subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as proc:
+    # the prefix is written ahead of rawdat instead of joining them, which would copy a memory mapped rawdat
+    try:
+      proc.stdin.write(prefix)
+    except BrokenPipeError:
+      # ffmpeg exited early, reported by its return code
+      pass
+    dat, _ = proc.communicate(input=rawdat)
+  if proc.returncode != 0:
+    raise subprocess.CalledProcessError(proc.returncode, args)
 
   if pix_fmt == "rgb24":
     ret = np.frombuffer(dat, dtype=np.uint8).reshape(-1, h, w, 3)
@@ -197,6 +212,142 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
   return ret
 
 
+def av_frame_to_ndarray(frame, pix_fmt):
+  # same layouts as decompress_video_data, with the plane row padding removed
+  frame = frame.reformat(format=pix_fmt)
+  planes = [np.frombuffer(p, dtype=np.uint8).reshape(-1, p.line_size) for p in frame.planes]
+  w, h = frame.width, frame.height
+
+  if pix_fmt == "rgb24":
+    return planes[0][:h, :w*3].reshape(h, w, 3)
+  elif pix_fmt == "nv12":
+    return np.concatenate([planes[0][:h, :w].reshape(-1), planes[1][:h//2, :w].reshape(-1)])
+  elif pix_fmt == "yuv420p":
+    return np.concatenate([planes[0][:h, :w].reshape(-1)] + [p[:h//2, :w//2].reshape(-1) for p in planes[1:]])
+  elif pix_fmt == "yuv444p":
+    return np.stack([p[:h, :w] for p in planes])
+  else:
+    raise NotImplementedError
+
+
+class DecoderPool:
+  """Persistent in-process HEVC decoders shared between frame readers, so decoding a GOP doesn't spawn
+  and probe a new ffmpeg process. Frames are decoded with decompress_video_data instead if PyAV isn't
+  installed, for CUDA decoding, or when opted out with use_pyav=False or FRAMEREADER_PYAV=0."""
+  def __init__(self, num_workers=2, use_pyav=None):
+    self.num_workers = num_workers
+    self.use_pyav = use_pyav if use_pyav is not None else os.getenv("FRAMEREADER_PYAV", "1") == "1"
+    self.decoders = queue.Queue()
+    for _ in range(num_workers):
+      # created on first use
+      self.decoders.put(None)
+
+  def available(self, vid_fmt):
+    return self.use_pyav and av is not None and vid_fmt == "hevc" and os.getenv("FFMPEG_CUDA", "0") != "1"
+
+  @staticmethod
+  def _create_decoder():
+    ctx = av.CodecContext.create("hevc", "r")
+    ctx.thread_count = int(os.getenv("FFMPEG_THREADS", "0"))
+    ctx.options = {"flags2": "+showall"}
+    return ctx
+
+  def decode(self, rawdat, vid_fmt, w, h, pix_fmt, prefix=b""):
+    if not self.available(vid_fmt):
+      return decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt, prefix)
+
+    ctx = self.decoders.get()
+    try:
+      if ctx is None:
+        ctx = self._create_decoder()
+
+      # flush the parser and decoder so every frame of the GOP is returned
+      frames = []
+      packets = ctx.parse(prefix) if len(prefix) else []
+      for packet in packets + ctx.parse(rawdat) + ctx.parse(None):
+        frames.extend(ctx.decode(packet))
+      frames.extend(ctx.decode(None))
+      ctx.flush_buffers()
+    except Exception:
+      ctx = None
+      raise
+    finally:
+      self.decoders.put(ctx)
+
+    if len(frames) == 0:
+      raise DataUnreadableError("no frames decoded")
+    return np.stack([av_frame_to_ndarray(frame, pix_fmt) for frame in frames])
+
+
+_default_decoder_pool = None
+_default_decoder_pool_lock = threading.Lock()
+
+def get_default_decoder_pool():
+  global _default_decoder_pool
+  with _default_decoder_pool_lock:
+    if _default_decoder_pool is None:
+      _default_decoder_pool = DecoderPool(int(os.getenv("FRAMEREADER_DECODERS", "2")))
+    return _default_decoder_pool
+
+
+class FrameCache:
+  """LRU cache of decoded frames bounded by their total size in bytes, shared between frame readers"""
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.frames = OrderedDict()
+    self.nbytes = 0
+    self.lock = threading.Lock()
+
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key, pix_fmt, count_miss=True):
+    with self.lock:
+      frame = self.frames.get((key, pix_fmt))
+      if frame is not None:
+        self.frames.move_to_end((key, pix_fmt))
+        self.hits += 1
+      else:
+        self.misses += int(count_miss)
+      return frame
+
+  def put(self, key, pix_fmt, frame):
+    with self.lock:
+      if (key, pix_fmt) in self.frames:
+        self.nbytes -= self.frames.pop((key, pix_fmt)).nbytes
+      self.frames[(key, pix_fmt)] = frame
+      self.nbytes += frame.nbytes
+
+      while self.nbytes > self.max_bytes and len(self.frames) > 0:
+        _, evicted = self.frames.popitem(last=False)
+        self.nbytes -= evicted.nbytes
+
+  def clear(self):
+    with self.lock:
+      self.frames.clear()
+      self.nbytes = 0
+
+  def stats(self):
+    with self.lock:
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "frames": len(self.frames),
+        "bytes": self.nbytes,
+      }
+
+
+_default_frame_cache = None
+_default_frame_cache_lock = threading.Lock()
+
+def get_default_frame_cache():
+  global _default_frame_cache
+  with _default_frame_cache_lock:
+    if _default_frame_cache is None:
+      _default_frame_cache = FrameCache(int(os.getenv("FRAMEREADER_CACHE_BYTES", str(512 * 1024 * 1024))))
+    return _default_frame_cache
+
+
 class BaseFrameReader:
   # properties: frame_type, frame_count, w, h
 
@@ -213,14 +364,15 @@ class BaseFrameReader:
     raise NotImplementedError
 
 
-def FrameReader(fn, cache_dir=DEFAULT_CACHE_DIR, readahead=False, readbehind=False, index_data=None):
+def FrameReader(fn, cache_dir=DEFAULT_CACHE_DIR, readahead=False, readbehind=False, index_data=None, decoder_pool=None, frame_cache=None):
   frame_type = fingerprint_video(fn)
   if frame_type == FrameType.raw:
     return RawFrameReader(fn)
   elif frame_type in (FrameType.h265_stream,):
     if not index_data:
       index_data = get_video_index(fn, frame_type, cache_dir)
-    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind)
+    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind, decoder_pool=decoder_pool,
+                             frame_cache=frame_cache)
   else:
     raise NotImplementedError(frame_type)
 
@@ -386,6 +538,14 @@ class StreamGOPReader(GOPReader):
     self.w = probe['streams'][0]['width']
     self.h = probe['streams'][0]['height']
 
+    # local videos stay mapped for the lifetime of the reader so GOPs can be sliced without reopening the file
+    self.mapped_file = FileReader(fn, use_mmap=True) if not resolve_name(fn).startswith(("http://", "https://")) else None
+
+  def close(self):
+    if self.mapped_file is not None:
+      self.mapped_file.close()
+      self.mapped_file = None
+
   def _lookup_gop(self, num):
     frame_b = num
     while frame_b > 0 and self.index[frame_b, 0] != HEVC_SLICE_I:
@@ -406,32 +566,35 @@ class StreamGOPReader(GOPReader):
 
     num_frames = frame_e - frame_b
 
-    with FileReader(self.fn) as f:
-      f.seek(offset_b)
-      rawdat = f.read(offset_e - offset_b)
-
-      if num < self.first_iframe:
-        assert self.prefix_frame_data
-        rawdat = self.prefix_frame_data + rawdat
-
-      rawdat = self.prefix + rawdat
+    if self.mapped_file is not None:
+      rawdat = self.mapped_file.view(offset_b, offset_e)
+    else:
+      with FileReader(self.fn) as f:
+        f.seek(offset_b)
+        rawdat = f.read(offset_e - offset_b)
 
+    # passed separately so the mapped GOP data isn't copied
+    prefix = self.prefix
     skip_frames = 0
     if num < self.first_iframe:
+      assert self.prefix_frame_data
+      prefix += self.prefix_frame_data
       skip_frames = self.num_prefix_frames
 
-    return frame_b, num_frames, skip_frames, rawdat
+    return frame_b, num_frames, skip_frames, prefix, rawdat
 
 
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
 
-  def __init__(self, readahead=False, readbehind=False):
+  def __init__(self, readahead=False, readbehind=False, decoder_pool=None, frame_cache=None):
     self.open_ = True
+    self.decoder_pool = decoder_pool if decoder_pool is not None else get_default_decoder_pool()
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
+    # frames are shared with other readers of the same file
+    self.frame_cache = frame_cache if frame_cache is not None else get_default_frame_cache()
 
     if self.readahead:
       self.cache_lock = threading.RLock()
@@ -479,23 +642,25 @@ class GOPFrameReader(BaseFrameReader):
   def _get_one(self, num, pix_fmt):
     assert num < self.frame_count
 
-    if (num, pix_fmt) in self.frame_cache:
-      return self.frame_cache[(num, pix_fmt)]
+    frame = self.frame_cache.get((self.fn, num), pix_fmt, count_miss=False)
+    if frame is not None:
+      return frame
 
     with self.cache_lock:
-      if (num, pix_fmt) in self.frame_cache:
-        return self.frame_cache[(num, pix_fmt)]
+      frame = self.frame_cache.get((self.fn, num), pix_fmt)
+      if frame is not None:
+        return frame
 
-      frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
+      frame_b, num_frames, skip_frames, prefix, rawdat = self.get_gop(num)
 
-      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
+      ret = self.decoder_pool.decode(rawdat, self.vid_fmt, self.w, self.h, pix_fmt, prefix)
       ret = ret[skip_frames:]
       assert ret.shape[0] == num_frames
 
       for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+        self.frame_cache.put((self.fn, frame_b+i), pix_fmt, ret[i])
 
-      return self.frame_cache[(num, pix_fmt)]
+      return ret[num - frame_b]
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -518,9 +683,13 @@ class GOPFrameReader(BaseFrameReader):
 
 
 class StreamFrameReader(StreamGOPReader, GOPFrameReader):
-  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False):
+  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False, decoder_pool=None, frame_cache=None):
     StreamGOPReader.__init__(self, fn, frame_type, index_data)
-    GOPFrameReader.__init__(self, readahead, readbehind)
+    GOPFrameReader.__init__(self, readahead, readbehind, decoder_pool, frame_cache)
+
+  def close(self):
+    GOPFrameReader.close(self)
+    StreamGOPReader.close(self)
 
 
 def GOPFrameIterator(gop_reader, pix_fmt):
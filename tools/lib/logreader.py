@@ -1,35 +1,226 @@
 #!/usr/bin/env python3
+import array
 import bz2
+import concurrent.futures
 from functools import partial
 import multiprocessing
 import capnp
 import enum
 import os
 import pathlib
+import pickle
+import struct
 import sys
+import tempfile
 import tqdm
 import urllib.parse
 import warnings
 
+from collections import OrderedDict, deque
 from collections.abc import Callable, Iterable, Iterator
 from urllib.parse import parse_qs, urlparse
 
 from cereal import log as capnp_log
 from openpilot.common.swaglog import cloudlog
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.tools.lib.cache import DEFAULT_CACHE_DIR, cache_path_for_file_path
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
 from openpilot.tools.lib.openpilotci import get_url
-from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available
+from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available, resolve_name
 from openpilot.tools.lib.route import Route, SegmentRange
+from openpilot.tools.lib.url_file import URLFile
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
 
 
+LOG_INDEX_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "logindex")
+STREAM_CHUNK_SIZE = 1024 * 1024
+MAX_CAPNP_SEGMENTS = 512
+
+
+def _message_spans(dat: bytes) -> Iterator[tuple[int, int]]:
+  """Yields (offset, length) of every complete capnp message framed in dat"""
+  offset = 0
+  while offset + 4 <= len(dat):
+    num_segments = struct.unpack_from("<I", dat, offset)[0] + 1
+    if num_segments > MAX_CAPNP_SEGMENTS:
+      raise ValueError(f"corrupted message framing at offset {offset}")
+
+    header_len = (4 * (num_segments + 1) + 7) & ~7
+    if offset + header_len > len(dat):
+      return
+
+    msg_len = header_len + 8 * sum(struct.unpack_from(f"<{num_segments}I", dat, offset + 4))
+    if offset + msg_len > len(dat):
+      return
+    yield offset, msg_len
+    offset += msg_len
+
+
+def _complete_messages_len(dat: bytes) -> int:
+  """Returns the length of the longest prefix of dat that only contains complete capnp messages"""
+  end = 0
+  try:
+    for offset, length in _message_spans(dat):
+      end = offset + length
+  except ValueError:
+    # let capnp raise on the corrupted data
+    return len(dat)
+  return end
+
+
+def _decompress_log(dat: bytes, ext: str | None = None) -> bytes:
+  if ext == ".bz2" or dat.startswith(b'BZh9'):
+    return bz2.decompress(dat)
+  return dat
+
+
+def _decompressed_chunks(f, compressed: bool | None, chunk_size: int):
+  decompressor = None
+  while len(chunk := f.read(chunk_size)) > 0:
+    if compressed is None:
+      compressed = chunk.startswith(b'BZh9')
+
+    if not compressed:
+      yield chunk
+      continue
+
+    while len(chunk) > 0:
+      if decompressor is None:
+        decompressor = bz2.BZ2Decompressor()
+      yield decompressor.decompress(chunk)
+      # bz2 files may contain multiple concatenated streams
+      chunk = decompressor.unused_data if decompressor.eof else b""
+      if decompressor.eof:
+        decompressor = None
+
+
+def _stream_events(fn: str, compressed: bool | None, chunk_size: int) -> Iterator[capnp._DynamicStructReader]:
+  buf = b""
+  with FileReader(fn) as f:
+    for dat in _decompressed_chunks(f, compressed, chunk_size):
+      buf += dat
+      complete_len = _complete_messages_len(buf)
+      if complete_len == 0:
+        continue
+
+      try:
+        yield from capnp_log.Event.read_multiple_bytes(buf[:complete_len])
+      except capnp.KjException:
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+        return
+      buf = buf[complete_len:]
+
+  if len(buf) > 0:
+    # trailing data that doesn't form a complete message
+    try:
+      yield from capnp_log.Event.read_multiple_bytes(buf)
+    except capnp.KjException:
+      pass
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+
+def _read_spans(fn: str, spans: Iterable[tuple[int, int]], compressed: bool | None) -> Iterator[bytes]:
+  """Yields the data of each (offset, length) span of the decompressed log, spans must be in offset order.
+  The log is only read and decompressed up to the end of the last span that is consumed."""
+  buf = b""
+  buf_offset = 0
+  with FileReader(fn) as f:
+    chunks = _decompressed_chunks(f, compressed, STREAM_CHUNK_SIZE)
+    for offset, length in spans:
+      end = offset + length
+      while buf_offset + len(buf) < end:
+        chunk = next(chunks, None)
+        if chunk is None:
+          warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+          return
+        # only keep the buffered data from the start of this span on
+        keep = min(max(offset - buf_offset, 0), len(buf))
+        buf = buf[keep:] + chunk
+        buf_offset += keep
+      yield buf[offset - buf_offset:end - buf_offset]
+
+
+def build_log_index(dat: bytes) -> dict:
+  """Indexes the union type, logMonoTime and byte span of each event in decompressed log data"""
+  type_names: list[str] = []
+  type_idxs: dict[str, int] = {}
+  types = array.array('H')
+  log_mono_times = array.array('Q')
+  offsets = array.array('Q')
+  lengths = array.array('I')
+
+  try:
+    for (offset, length), ent in zip(_message_spans(dat), capnp_log.Event.read_multiple_bytes(dat), strict=False):
+      try:
+        which = ent.which()
+      except capnp.KjException:
+        continue
+
+      type_idx = type_idxs.get(which)
+      if type_idx is None:
+        type_idx = type_idxs[which] = len(type_names)
+        type_names.append(which)
+      types.append(type_idx)
+      log_mono_times.append(ent.logMonoTime)
+      offsets.append(offset)
+      lengths.append(length)
+  except (ValueError, capnp.KjException):
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+  return {
+    'type_names': type_names,
+    'types': types,
+    'log_mono_times': log_mono_times,
+    'offsets': offsets,
+    'lengths': lengths,
+  }
+
+
+def log_version(fn: str) -> str | None:
+  """Identifies the contents of a log without reading it: the size and mtime of a local file, or the HEAD
+  validators of a remote one. None if a remote log can't be identified."""
+  fn = resolve_name(fn)
+  if fn.startswith(("http://", "https://")):
+    return URLFile(fn).get_version_online()
+  st = os.stat(fn)
+  return f"{st.st_size}_{st.st_mtime_ns}"
+
+
+def load_log_index(fn: str, version: str | None, cache_dir: str = LOG_INDEX_CACHE_DIR) -> dict | None:
+  """Returns the cached index of fn, or None if there is none for this version of the log"""
+  if version is None:
+    return None
+  try:
+    with open(cache_path_for_file_path(fn, cache_dir), "rb") as f:
+      index = pickle.load(f)
+  except (OSError, EOFError, pickle.UnpicklingError):
+    return None
+  return index if index.get('version') == version else None
+
+
+def save_log_index(fn: str, version: str | None, index: dict, cache_dir: str = LOG_INDEX_CACHE_DIR) -> None:
+  if version is None:
+    return
+  with atomic_write_in_dir(cache_path_for_file_path(fn, cache_dir), mode="wb", overwrite=True) as f:
+    pickle.dump({**index, 'version': version}, f, -1)
+
+
 class _LogFileReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None, streaming=False):
     self.data_version = None
     self._only_union_types = only_union_types
+    self._fn = fn
+    self._compressed: bool | None = None
+    self._ents: list[capnp._DynamicStructReader] | None = None
+    # the decompressed data the events are read from, events in file order and their spans in it
+    self._dat: bytes | None = None
+    self._file_ents: list[capnp._DynamicStructReader] | None = None
+    self._spans: dict[int, tuple[int, int]] | None = None
+    # approximate memory held by the decoded events
+    self.size = 0
 
     ext = None
     if not dat:
@@ -38,12 +229,18 @@ class _LogFileReader:
         # old rlogs weren't bz2 compressed
         raise Exception(f"unknown extension {ext}")
 
+      if streaming and not sort_by_time:
+        # events are decompressed and decoded incrementally on every iteration
+        self._compressed = True if ext == ".bz2" else None
+        return
+
       with FileReader(fn) as f:
         dat = f.read()
 
-    if ext == ".bz2" or dat.startswith(b'BZh9'):
-      dat = bz2.decompress(dat)
-
+    dat = _decompress_log(dat, ext)
+    self.size = len(dat)
+    # the events keep the data alive anyway
+    self._dat = dat
     ents = capnp_log.Event.read_multiple_bytes(dat)
 
     _ents = []
@@ -53,11 +250,29 @@ class _LogFileReader:
     except capnp.KjException:
       warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
 
+    self._file_ents = _ents
     self._ents = list(sorted(_ents, key=lambda x: x.logMonoTime) if sort_by_time else _ents)
     self._ts = [x.logMonoTime for x in self._ents]
 
+  def serialize(self, msgs: LogIterable) -> Iterator[bytes]:
+    """Yields the serialized bytes of msgs. Events of this log are sliced from its data, others are copied."""
+    if self._dat is not None and self._spans is None:
+      try:
+        self._spans = {id(ent): span for ent, span in zip(self._file_ents, _message_spans(self._dat), strict=False)}
+      except ValueError:
+        self._spans = {}
+
+    for msg in msgs:
+      # the events of this log are alive, so their ids can't be reused by other messages
+      span = self._spans.get(id(msg)) if self._spans is not None else None
+      if span is not None:
+        yield self._dat[span[0]:span[0] + span[1]]
+      else:
+        yield msg.as_builder().to_bytes()
+
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
+    ents = self._ents if self._ents is not None else _stream_events(self._fn, self._compressed, STREAM_CHUNK_SIZE)
+    for ent in ents:
       if self._only_union_types:
         try:
           ent.which()
@@ -244,26 +459,86 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               default_source=auto_source, sort_by_time=False, only_union_types=False):
+               default_source=auto_source, sort_by_time=False, only_union_types=False, streaming=False, use_index=False,
+               prefetch=0, max_cached_segments: int | None = None, max_cached_bytes: int | None = None):
     self.default_mode = default_mode
     self.default_source = default_source
     self.identifier = identifier
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
-
-    self.__lrs: dict[int, _LogFileReader] = {}
+    # decode events lazily with bounded memory instead of loading whole segments, ignored if sort_by_time is set
+    self.streaming = streaming
+    # filter and first use a per-segment message type index, cached on disk, to skip segments and events
+    self.use_index = use_index
+    # number of upcoming segments to download and decode in background threads while iterating
+    self.prefetch = prefetch
+    # limits for the least recently used cache of opened segments, unbounded if None
+    self.max_cached_segments = max_cached_segments
+    self.max_cached_bytes = max_cached_bytes
+
+    self.__lrs: OrderedDict[int, _LogFileReader] = OrderedDict()
     self.reset()
 
+  def _load_lr(self, i):
+    return _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                          streaming=self.streaming)
+
+  def _cache_lr(self, i, lr):
+    self.__lrs[i] = lr
+    self.__lrs.move_to_end(i)
+
+    cached_bytes = sum(cached.size for cached in self.__lrs.values())
+    while len(self.__lrs) > 0:
+      over_count = self.max_cached_segments is not None and len(self.__lrs) > self.max_cached_segments
+      over_bytes = self.max_cached_bytes is not None and cached_bytes > self.max_cached_bytes
+      if not (over_count or over_bytes):
+        break
+      _, evicted = self.__lrs.popitem(last=False)
+      cached_bytes -= evicted.size
+    return lr
+
   def _get_lr(self, i):
-    if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
-    return self.__lrs[i]
+    if i in self.__lrs:
+      self.__lrs.move_to_end(i)
+      return self.__lrs[i]
+    return self._cache_lr(i, self._load_lr(i))
+
+  def release(self, i: int | None = None):
+    """Drops the cached reader for segment i, or for all segments if i is None"""
+    if i is None:
+      self.__lrs.clear()
+    else:
+      self.__lrs.pop(i, None)
 
   def __iter__(self):
+    if self.prefetch > 0:
+      yield from self._iter_prefetch()
+      return
+
     for i in range(len(self.logreader_identifiers)):
       yield from self._get_lr(i)
 
+  def _iter_prefetch(self):
+    num_segs = len(self.logreader_identifiers)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.prefetch)
+    try:
+      futures: deque[concurrent.futures.Future] = deque()
+      next_seg = 0
+      for i in range(num_segs):
+        # keep the current segment plus the next prefetch segments in flight
+        while next_seg < num_segs and next_seg <= i + self.prefetch:
+          if next_seg in self.__lrs:
+            futures.append(concurrent.futures.Future())
+            futures[-1].set_result(self.__lrs[next_seg])
+          else:
+            # loading happens off-thread, the cache is only touched from the iterating thread
+            futures.append(pool.submit(self._load_lr, next_seg))
+          next_seg += 1
+        yield from self._cache_lr(i, futures.popleft().result())
+    finally:
+      pool.shutdown(wait=False, cancel_futures=True)
+
   def _run_on_segment(self, func, i):
     return func(self._get_lr(i))
 
@@ -275,6 +550,30 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
         ret.extend(p)
       return ret
 
+  def _run_on_segment_to_file(self, func, out_dir, i):
+    out_fn = os.path.join(out_dir, str(i))
+    lr = self._get_lr(i)
+    with open(out_fn, "wb") as f:
+      for dat in lr.serialize(func(lr)):
+        f.write(dat)
+    return out_fn
+
+  def stream_across_segments(self, num_processes, func, raw=False):
+    """Like run_across_segments, but func must return events, which are passed back serialized through
+    temporary files instead of being pickled. Yields events in segment order as each segment finishes,
+    or the serialized bytes of each segment if raw is set."""
+    with tempfile.TemporaryDirectory() as out_dir, multiprocessing.Pool(num_processes) as pool:
+      num_segs = len(self.logreader_identifiers)
+      for out_fn in tqdm.tqdm(pool.imap(partial(self._run_on_segment_to_file, func, out_dir), range(num_segs)), total=num_segs):
+        with open(out_fn, "rb") as f:
+          dat = f.read()
+        os.unlink(out_fn)
+
+        if raw:
+          yield dat
+        else:
+          yield from capnp_log.Event.read_multiple_bytes(dat)
+
   def reset(self):
     self.logreader_identifiers = self._parse_identifiers(self.identifier)
 
@@ -282,8 +581,45 @@ are uploaded or auto fallback to qlogs with '/a' selector at the end of the rout
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
+  def _filter_segment(self, i, msg_type: str):
+    if i in self.__lrs and self.__lrs[i]._ents is not None:
+      yield from (m for m in self.__lrs[i] if m.which() == msg_type)
+      return
+
+    fn = self.logreader_identifiers[i]
+    version = log_version(fn)
+
+    # the log is only read if its cached index has the type
+    dat = None
+    index = load_log_index(fn, version, LOG_INDEX_CACHE_DIR)
+    if index is None:
+      with FileReader(fn) as f:
+        dat = _decompress_log(f.read())
+      index = build_log_index(dat)
+      save_log_index(fn, version, index, LOG_INDEX_CACHE_DIR)
+
+    if msg_type not in index['type_names']:
+      return
+
+    type_idx = index['type_names'].index(msg_type)
+    idxs = [j for j, t in enumerate(index['types']) if t == type_idx]
+    spans = [(index['offsets'][j], index['lengths'][j]) for j in idxs]
+    if dat is None:
+      _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+      msgs = _read_spans(fn, spans, True if ext == ".bz2" else None)
+    else:
+      msgs = (dat[offset:offset + length] for offset, length in spans)
+
+    if self.sort_by_time:
+      # the spans are read in file order, then reordered
+      msgs = [m for _, m in sorted(zip(idxs, msgs, strict=False), key=lambda x: index['log_mono_times'][x[0]])]
+    for msg in msgs:
+      yield from capnp_log.Event.read_multiple_bytes(msg)
+
   def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+    if not self.use_index:
+      return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+    return (getattr(m, msg_type) for i in range(len(self.logreader_identifiers)) for m in self._filter_segment(i, msg_type))
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
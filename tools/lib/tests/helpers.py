@@ -0,0 +1,20 @@
+import os
+from collections.abc import Callable
+
+from cereal import log as capnp_log
+
+MSGS_PER_SEGMENT = 100
+
+
+def write_rlogs(out_dir: str, num_segs: int, new_event: Callable | None = None) -> list[str]:
+  """Writes num_segs uncompressed rlogs of MSGS_PER_SEGMENT events. Event t of the route is new_event(t),
+  an empty event with logMonoTime t by default."""
+  if new_event is None:
+    new_event = lambda t: capnp_log.Event.new_message(logMonoTime=t)
+
+  rlogs = []
+  for seg in range(num_segs):
+    rlogs.append(os.path.join(out_dir, f"rlog{seg}"))
+    with open(rlogs[-1], "wb") as f:
+      f.write(b"".join(new_event(seg * MSGS_PER_SEGMENT + i).to_bytes() for i in range(MSGS_PER_SEGMENT)))
+  return rlogs
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from cereal import log as capnp_log
+from openpilot.tools.lib.columnar import extract_columns, query
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.tests.helpers import write_rlogs
+from openpilot.tools.lib.url_file import URLFile
+
+
+def new_event(t):
+  msg = capnp_log.Event.new_message(logMonoTime=t)
+  if t % 2 == 0:
+    msg.init("carState")
+    msg.carState.vEgo = t / 10
+    msg.carState.gearShifter = "drive"
+  else:
+    msg.init("controlsState")
+    msg.controlsState.curvature = t / 100
+  return msg
+
+
+class TestColumnar(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.rlogs = write_rlogs(self.tmpdir.name, 3, new_event)
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+  def test_extract_columns(self):
+    cols = extract_columns(LogReader(self.rlogs[0]), ["carState.vEgo", "carState.gearShifter", "controlsState.curvature"])
+    np.testing.assert_array_equal(cols["carState.logMonoTime"], np.arange(0, 100, 2))
+    np.testing.assert_allclose(cols["carState.vEgo"], np.arange(0, 100, 2) / 10, rtol=1e-6)
+    np.testing.assert_allclose(cols["controlsState.curvature"], np.arange(1, 100, 2) / 100, rtol=1e-6)
+    self.assertTrue(all(cols["carState.gearShifter"] == "drive"))
+
+  def write_rlog(self, fn, msgs):
+    with open(fn, "wb") as f:
+      f.write(b"".join(msg.to_bytes() for msg in msgs))
+
+  def test_query_cache(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cols = query(self.rlogs, ["carState.vEgo"], cache_dir=cache_dir)
+      np.testing.assert_array_equal(cols["carState.logMonoTime"], np.arange(0, 300, 2))
+      np.testing.assert_allclose(cols["carState.vEgo"], np.arange(0, 300, 2) / 10, rtol=1e-6)
+
+      # unchanged logs aren't decoded again
+      with mock.patch("openpilot.tools.lib.columnar.extract_columns", side_effect=AssertionError("columns extracted again")):
+        cached_cols = query(self.rlogs, ["carState.vEgo"], cache_dir=cache_dir)
+      for field, col in cols.items():
+        np.testing.assert_array_equal(cached_cols[field], col)
+
+  def test_query_remote_log(self):
+    url = "https://example.com/rlog"
+    with tempfile.TemporaryDirectory() as cache_dir, \
+         mock.patch("openpilot.tools.lib.logreader.FileReader", side_effect=lambda fn: open(self.rlogs[0], "rb")) as file_reader_mock, \
+         mock.patch.object(URLFile, "get_version_online", return_value="1") as version_mock:
+      cols = query(url, ["carState.vEgo"], cache_dir=cache_dir)
+      np.testing.assert_allclose(cols["carState.vEgo"], np.arange(0, 100, 2) / 10, rtol=1e-6)
+      self.assertEqual(file_reader_mock.call_count, 1)
+
+      # the log is only downloaded for missing columns
+      query(url, ["carState.vEgo"], cache_dir=cache_dir)
+      self.assertEqual(file_reader_mock.call_count, 1)
+      query(url, ["carState.vEgo", "controlsState.curvature"], cache_dir=cache_dir)
+      self.assertEqual(file_reader_mock.call_count, 2)
+
+      # and again for a new version
+      version_mock.return_value = "2"
+      query(url, ["carState.vEgo"], cache_dir=cache_dir)
+      self.assertEqual(file_reader_mock.call_count, 3)
+
+  def test_query_rewritten_log(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      query(self.rlogs, ["carState.vEgo", "controlsState.curvature"], cache_dir=cache_dir)
+
+      msg = capnp_log.Event.new_message(logMonoTime=1000)
+      msg.init("carState")
+      msg.carState.vEgo = 5.
+      self.write_rlog(self.rlogs[1], [msg])
+      # a rewrite can land within the mtime granularity of the first write
+      os.utime(self.rlogs[1], ns=(0, 10**9))
+
+      cols = query(self.rlogs[1], ["carState.vEgo", "controlsState.curvature"], cache_dir=cache_dir)
+      np.testing.assert_array_equal(cols["carState.logMonoTime"], [1000])
+      np.testing.assert_array_equal(cols["carState.vEgo"], [5.])
+      self.assertEqual(len(cols["controlsState.curvature"]), 0)
+
+  def test_empty_columns(self):
+    # a segment without controlsState doesn't change the dtypes of the others
+    msg = capnp_log.Event.new_message(logMonoTime=1000)
+    msg.init("carState")
+    self.write_rlog(self.rlogs[1], [msg])
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cols = query(self.rlogs, ["controlsState.curvature", "controlsState.enabled"], cache_dir=cache_dir)
+      self.assertEqual(cols["controlsState.logMonoTime"].dtype, np.int64)
+      self.assertEqual(cols["controlsState.enabled"].dtype, np.bool_)
+      self.assertEqual(len(cols["controlsState.logMonoTime"]), 100)
+
+      cols = query(self.rlogs[1], ["controlsState.curvature"], cache_dir=cache_dir)
+      self.assertEqual(cols["controlsState.logMonoTime"].dtype, np.int64)
+      self.assertEqual(len(cols["controlsState.curvature"]), 0)
+
+if __name__ == "__main__":
+  unittest.main()
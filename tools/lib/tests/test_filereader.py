@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+
+from openpilot.tools.lib.filereader import FileReader, MappedFileReader
+
+DATA = bytes(range(256)) * 4
+
+
+class TestMappedFileReader(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.fn = os.path.join(self.tmpdir.name, "file")
+    with open(self.fn, "wb") as f:
+      f.write(DATA)
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+  def test_file_reader(self):
+    with FileReader(self.fn, use_mmap=True) as f:
+      self.assertIsInstance(f, MappedFileReader)
+      self.assertEqual(f.name, self.fn)
+    with FileReader(self.fn) as f:
+      self.assertNotIsInstance(f, MappedFileReader)
+
+  def test_read(self):
+    with MappedFileReader(self.fn) as f:
+      self.assertEqual(len(f), len(DATA))
+      self.assertEqual(f.read(10), DATA[:10])
+      self.assertEqual(f.read(10), DATA[10:20])
+      self.assertEqual(f.tell(), 20)
+      self.assertEqual(f.read(), DATA[20:])
+      # at the end, like a file
+      self.assertEqual(f.read(), b"")
+      self.assertEqual(f.read(10), b"")
+      self.assertEqual(f.tell(), len(DATA))
+
+  def test_read_matches_file(self):
+    with MappedFileReader(self.fn) as mf, open(self.fn, "rb") as f:
+      for pos, ll in [(0, None), (5, 0), (100, 50), (len(DATA) - 3, 10), (len(DATA) + 10, 5), (len(DATA) + 10, None)]:
+        mf.seek(pos)
+        f.seek(pos)
+        self.assertEqual(mf.read(ll), f.read(ll), (pos, ll))
+        self.assertEqual(mf.tell(), f.tell(), (pos, ll))
+
+  def test_seek(self):
+    with MappedFileReader(self.fn) as f:
+      f.seek(100)
+      self.assertEqual(f.tell(), 100)
+      self.assertEqual(f.read(4), DATA[100:104])
+      f.seek(0)
+      self.assertEqual(f.read(4), DATA[:4])
+      # seeking past the end is allowed, reading there returns nothing
+      f.seek(len(DATA) + 100)
+      self.assertEqual(f.read(4), b"")
+      self.assertEqual(f.tell(), len(DATA) + 100)
+
+  def test_view(self):
+    with MappedFileReader(self.fn) as f:
+      view = f.view(10, 20)
+      self.assertIsInstance(view, memoryview)
+      self.assertEqual(bytes(view), DATA[10:20])
+      self.assertEqual(bytes(f.view()), DATA)
+      self.assertEqual(bytes(f.view(len(DATA) - 5)), DATA[-5:])
+      # views don't move the position
+      self.assertEqual(f.tell(), 0)
+      del view
+
+  def test_empty_file(self):
+    open(self.fn, "wb").close()
+    with MappedFileReader(self.fn) as f:
+      self.assertEqual(len(f), 0)
+      self.assertEqual(f.read(), b"")
+      self.assertEqual(f.read(10), b"")
+      self.assertEqual(bytes(f.view()), b"")
+
+  def test_close(self):
+    f = MappedFileReader(self.fn)
+    self.assertFalse(f.closed)
+    f.close()
+    self.assertTrue(f.closed)
+    with self.assertRaises(ValueError):
+      f.read()
+    with self.assertRaises(ValueError):
+      f.view()
+    # closing twice is fine
+    f.close()
+
+    with MappedFileReader(self.fn) as f:
+      pass
+    self.assertTrue(f.closed)
+
+  def test_close_with_live_view(self):
+    f = MappedFileReader(self.fn)
+    view = f.view(0, 16)
+    f.close()
+    self.assertTrue(f.closed)
+    # the map stays valid as long as a view of it is alive
+    self.assertEqual(bytes(view), DATA[:16])
+    del view
+
+
+if __name__ == "__main__":
+  unittest.main()
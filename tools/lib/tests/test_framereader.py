@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from openpilot.tools.lib.framereader import HEVC_SLICE_I, HEVC_SLICE_P, DecoderPool, FrameCache, GOPFrameReader, StreamGOPReader, FrameType, \
+                                           av, decompress_video_data
+
+GOP_SIZE = 5
+
+
+class FakeDecoderPool:
+  def __init__(self):
+    self.decoded = []
+
+  def decode(self, rawdat, vid_fmt, w, h, pix_fmt, prefix=b""):
+    frame_b = int(rawdat)
+    self.decoded.append(frame_b)
+    return np.stack([np.full(w * h * 3 // 2, frame_b + i, dtype=np.uint8) for i in range(GOP_SIZE)])
+
+
+class FakeFrameReader(GOPFrameReader):
+  def __init__(self, fn, decoder_pool, frame_cache):
+    self.fn = fn
+    self.vid_fmt = "hevc"
+    self.frame_count = 4 * GOP_SIZE
+    self.w, self.h = 4, 2
+    super().__init__(decoder_pool=decoder_pool, frame_cache=frame_cache)
+
+  def get_gop(self, num):
+    frame_b = num - num % GOP_SIZE
+    return frame_b, GOP_SIZE, 0, b"", str(frame_b)
+
+
+class TestFrameCache(unittest.TestCase):
+  def test_byte_budget(self):
+    cache = FrameCache(max_bytes=250)
+    for i in range(3):
+      cache.put(("fn", i), "yuv420p", np.zeros(100, dtype=np.uint8))
+    self.assertIsNone(cache.get(("fn", 0), "yuv420p"))
+    self.assertEqual(cache.stats()["bytes"], 200)
+
+    # the least recently used frame is evicted first
+    self.assertIsNotNone(cache.get(("fn", 1), "yuv420p"))
+    cache.put(("fn", 3), "yuv420p", np.zeros(100, dtype=np.uint8))
+    self.assertIsNone(cache.get(("fn", 2), "yuv420p"))
+    self.assertIsNotNone(cache.get(("fn", 1), "yuv420p"))
+
+    # replacing a frame doesn't count it twice
+    cache.put(("fn", 1), "yuv420p", np.zeros(50, dtype=np.uint8))
+    self.assertEqual(cache.stats(), {"hits": 2, "misses": 2, "frames": 2, "bytes": 150})
+
+    cache.clear()
+    self.assertEqual(cache.stats()["bytes"], 0)
+
+  def test_pix_fmts_cached_separately(self):
+    cache = FrameCache(max_bytes=1000)
+    cache.put(("fn", 0), "yuv420p", np.zeros(12, dtype=np.uint8))
+    # rgb24 is always decoded, a conversion of the cached yuv frame isn't bit exact with the decoder's
+    self.assertIsNone(cache.get(("fn", 0), "rgb24"))
+    self.assertIsNone(cache.get(("fn", 0), "rgb24", count_miss=False))
+    self.assertEqual(cache.stats()["misses"], 1)
+
+  def test_shared_between_readers(self):
+    cache = FrameCache(max_bytes=1024 * 1024)
+    pool = FakeDecoderPool()
+    fr1 = FakeFrameReader("fn", pool, cache)
+    fr2 = FakeFrameReader("fn", pool, cache)
+    other = FakeFrameReader("other", pool, cache)
+
+    frames = fr1.get(3, count=4)
+    self.assertEqual([f[0] for f in frames], [3, 4, 5, 6])
+    self.assertEqual(pool.decoded, [0, 5])
+
+    # another reader of the same file reuses the decoded GOPs
+    frames = fr2.get(0, count=GOP_SIZE * 2)
+    self.assertEqual([f[0] for f in frames], list(range(GOP_SIZE * 2)))
+    self.assertEqual(pool.decoded, [0, 5])
+
+    other.get(0)
+    self.assertEqual(pool.decoded, [0, 5, 0])
+    self.assertEqual(cache.stats()["frames"], GOP_SIZE * 3)
+    self.assertEqual(cache.stats()["misses"], 3)
+    self.assertEqual(cache.stats()["hits"], 2 + GOP_SIZE * 2)
+
+
+class TestStreamGOPReader(unittest.TestCase):
+  def test_gop_not_copied(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      fn = os.path.join(tmpdir, "video.hevc")
+      dat = os.urandom(30)
+      with open(fn, "wb") as f:
+        f.write(dat)
+
+      index = np.array([[HEVC_SLICE_I, 0], [HEVC_SLICE_P, 10], [HEVC_SLICE_I, 20], [0xFFFFFFFF, 30]], dtype=np.uint32)
+      index_data = {'index': index, 'global_prefix': b"prefix", 'probe': {'streams': [{'width': 4, 'height': 2}]}}
+      reader = StreamGOPReader(fn, FrameType.h265_stream, index_data)
+      try:
+        frame_b, num_frames, skip_frames, prefix, rawdat = reader.get_gop(1)
+        self.assertEqual((frame_b, num_frames, skip_frames, prefix), (0, 2, 0, b"prefix"))
+        # a view of the mapped file, the prefix is passed to the decoder separately
+        self.assertIsInstance(rawdat, memoryview)
+        self.assertEqual(bytes(rawdat), dat[:20])
+        self.assertEqual(bytes(reader.get_gop(2)[4]), dat[20:])
+        del rawdat
+      finally:
+        reader.close()
+
+
+class TestDecoderPoolDefault(unittest.TestCase):
+  def test_pyav_by_default(self):
+    with mock.patch.dict(os.environ), mock.patch("openpilot.tools.lib.framereader.av", mock.MagicMock()):
+      os.environ.pop("FRAMEREADER_PYAV", None)
+      self.assertTrue(DecoderPool().available("hevc"))
+      self.assertFalse(DecoderPool(use_pyav=False).available("hevc"))
+      os.environ["FRAMEREADER_PYAV"] = "0"
+      self.assertFalse(DecoderPool().available("hevc"))
+
+  def test_ffmpeg_fallback(self):
+    with mock.patch.dict(os.environ), mock.patch("openpilot.tools.lib.framereader.decompress_video_data", return_value="ffmpeg") as decompress:
+      os.environ.pop("FRAMEREADER_PYAV", None)
+      with mock.patch("openpilot.tools.lib.framereader.av", None):
+        self.assertEqual(DecoderPool().decode(b"", "hevc", 64, 48, "yuv420p"), "ffmpeg")
+      with mock.patch("openpilot.tools.lib.framereader.av", mock.MagicMock()):
+        os.environ["FFMPEG_CUDA"] = "1"
+        self.assertEqual(DecoderPool().decode(b"", "hevc", 64, 48, "yuv420p"), "ffmpeg")
+      self.assertEqual(decompress.call_count, 2)
+
+
+@unittest.skipIf(av is None or shutil.which("ffmpeg") is None, "needs PyAV and ffmpeg")
+class TestDecoderPool(unittest.TestCase):
+  W, H = 64, 48
+
+  @classmethod
+  def setUpClass(cls):
+    try:
+      cls.hevc = subprocess.check_output(["ffmpeg", "-v", "quiet", "-f", "lavfi", "-i", f"testsrc=size={cls.W}x{cls.H}:rate=20",
+                                          "-frames:v", "10", "-c:v", "libx265", "-x265-params", "log-level=none", "-f", "hevc", "-"])
+    except subprocess.CalledProcessError:
+      raise unittest.SkipTest("ffmpeg can't encode HEVC") from None
+
+  def test_matches_ffmpeg(self):
+    pool = DecoderPool(num_workers=1, use_pyav=True)
+    for pix_fmt in ("yuv420p", "nv12", "rgb24"):
+      with self.subTest(pix_fmt=pix_fmt):
+        expected = decompress_video_data(self.hevc, "hevc", self.W, self.H, pix_fmt)
+        self.assertEqual(len(expected), 10)
+        # twice, the decoder is reused
+        for _ in range(2):
+          np.testing.assert_array_equal(pool.decode(self.hevc, "hevc", self.W, self.H, pix_fmt), expected)
+
+        # the prefix is fed ahead of a memoryview of the rest without joining them
+        rawdat = memoryview(self.hevc)[100:]
+        np.testing.assert_array_equal(decompress_video_data(rawdat, "hevc", self.W, self.H, pix_fmt, self.hevc[:100]), expected)
+        np.testing.assert_array_equal(pool.decode(rawdat, "hevc", self.W, self.H, pix_fmt, self.hevc[:100]), expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import bz2
 import capnp
 import contextlib
 import io
@@ -15,7 +16,8 @@ from unittest import mock
 from cereal import log as capnp_log
 from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException
 from openpilot.tools.lib.route import SegmentRange
-from openpilot.tools.lib.url_file import URLFileException
+from openpilot.tools.lib.tests.helpers import write_rlogs
+from openpilot.tools.lib.url_file import URLFile, URLFileException
 
 NUM_SEGS = 17  # number of segments in the test route
 ALL_SEGS = list(range(NUM_SEGS))
@@ -23,10 +25,25 @@ TEST_ROUTE = "344c5c15b34f2d8a/2024-01-03--09-37-12"
 QLOG_FILE = "https://commadataci.blob.core.windows.net/openpilotci/0375fdf7b1ce594d/2019-06-13--08-32-25/3/qlog.bz2"
 
 
+class CountingFile(io.FileIO):
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.bytes_read = 0
+
+  def read(self, size=-1):
+    dat = super().read(size)
+    self.bytes_read += len(dat)
+    return dat
+
+
 def noop(segment: LogIterable):
   return segment
 
 
+def odd_and_new(segment: LogIterable):
+  return [m for m in segment if m.logMonoTime % 2] + [capnp_log.Event.new_message(logMonoTime=1000).as_reader()]
+
+
 @contextlib.contextmanager
 def setup_source_scenario(is_internal=False):
   with (
@@ -183,6 +200,23 @@ class TestLogReader(unittest.TestCase):
     lr = LogReader(f"{TEST_ROUTE}/0:4")
     self.assertEqual(len(lr.run_across_segments(4, noop)), len(list(lr)))
 
+  def test_stream_across_segments(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      rlogs = write_rlogs(tmpdir, 4)
+      lr = LogReader(rlogs)
+      self.assertEqual([m.logMonoTime for m in lr.stream_across_segments(4, noop)], list(range(400)))
+
+      # the events are written as they are in the logs
+      dat = b""
+      for rlog in rlogs:
+        with open(rlog, "rb") as f:
+          dat += f.read()
+      self.assertEqual(b"".join(lr.stream_across_segments(4, noop, raw=True)), dat)
+
+      # filtered, and events that aren't from the logs
+      msgs = list(lr.stream_across_segments(4, odd_and_new))
+      self.assertEqual([m.logMonoTime for m in msgs], [t for seg in range(4) for t in [*range(seg * 100 + 1, seg * 100 + 100, 2), 1000]])
+
   @pytest.mark.slow
   def test_auto_mode(self):
     lr = LogReader(f"{TEST_ROUTE}/0/q")
@@ -226,6 +260,124 @@ class TestLogReader(unittest.TestCase):
     msgs = list(LogReader(f"{TEST_ROUTE}/0/q", sort_by_time=True))
     self.assertEqual(msgs, sorted(msgs, key=lambda m: m.logMonoTime))
 
+  @parameterized.expand([(True,), (False,)])
+  def test_streaming(self, compressed):
+    with tempfile.NamedTemporaryFile(suffix=".bz2" if compressed else "") as rlog:
+      dat = b"".join(capnp_log.Event.new_message(logMonoTime=i).to_bytes() for i in range(1000))
+      with open(rlog.name, "wb") as f:
+        f.write(bz2.compress(dat) if compressed else dat)
+
+      with mock.patch("openpilot.tools.lib.logreader.STREAM_CHUNK_SIZE", 100):
+        msgs = list(LogReader(rlog.name, streaming=True))
+      self.assertEqual([m.logMonoTime for m in msgs], list(range(1000)))
+      self.assertEqual([m.logMonoTime for m in msgs], [m.logMonoTime for m in LogReader(rlog.name)])
+
+  def test_prefetch(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      rlogs = write_rlogs(tmpdir, 5)
+      expected = [m.logMonoTime for m in LogReader(rlogs)]
+      self.assertEqual(expected, list(range(500)))
+      for prefetch in (1, 2, 10):
+        self.assertEqual([m.logMonoTime for m in LogReader(rlogs, prefetch=prefetch)], expected)
+
+  def test_segment_cache_eviction(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      rlogs = write_rlogs(tmpdir, 5)
+      seg_size = os.path.getsize(rlogs[0])
+
+      for kwargs, max_segs in (({"max_cached_segments": 2}, 2), ({"max_cached_bytes": seg_size * 3}, 3)):
+        lr = LogReader(rlogs, **kwargs)
+        self.assertEqual(len(list(lr)), 500)
+        self.assertEqual(list(lr._LogReader__lrs.keys()), list(range(5 - max_segs, 5)))
+
+        lr.release(4)
+        self.assertNotIn(4, lr._LogReader__lrs)
+        lr.release()
+        self.assertEqual(len(lr._LogReader__lrs), 0)
+        self.assertEqual(len(list(lr)), 500)
+
+  @parameterized.expand([(True,), (False,)])
+  def test_index_filter(self, compressed):
+    with tempfile.NamedTemporaryFile(suffix=".bz2" if compressed else "") as rlog, tempfile.TemporaryDirectory() as cache_dir:
+      msgs = []
+      for i in range(1000):
+        msg = capnp_log.Event.new_message(logMonoTime=1000 - i)
+        msg.init("carParams" if i % 10 == 0 else "carState")
+        msgs.append(msg.to_bytes())
+      with open(rlog.name, "wb") as f:
+        f.write(bz2.compress(b"".join(msgs)) if compressed else b"".join(msgs))
+
+      # indexed events are read in chunks that split them
+      with mock.patch("openpilot.tools.lib.logreader.LOG_INDEX_CACHE_DIR", cache_dir), \
+           mock.patch("openpilot.tools.lib.logreader.STREAM_CHUNK_SIZE", 100):
+        for sort_by_time in (False, True):
+          lr = LogReader(rlog.name, sort_by_time=sort_by_time)
+          expected = [m.logMonoTime for m in lr if m.which() == "carParams"]
+
+          lr = LogReader(rlog.name, sort_by_time=sort_by_time, use_index=True)
+          indexed = [m.logMonoTime for m in lr._filter_segment(0, "carParams")]
+          self.assertEqual(indexed, expected)
+          self.assertEqual(len(list(lr.filter("carState"))), 900)
+          self.assertIsNone(lr.first("liveCalibration"))
+
+        # subsequent lookups of missing types don't read the log
+        with mock.patch("openpilot.tools.lib.logreader.FileReader") as file_reader_mock:
+          self.assertIsNone(LogReader(rlog.name, use_index=True).first("liveCalibration"))
+          self.assertEqual(file_reader_mock.call_count, 0)
+
+  def test_index_remote_log(self):
+    with tempfile.NamedTemporaryFile() as rlog, tempfile.TemporaryDirectory() as cache_dir:
+      dat = b"".join(capnp_log.Event.new_message(logMonoTime=i, **{"carParams" if i == 0 else "carState": {}}).to_bytes()
+                     for i in range(1000))
+      with open(rlog.name, "wb") as f:
+        f.write(dat)
+
+      readers = []
+      def file_reader(fn):
+        readers.append(CountingFile(rlog.name, "rb"))
+        return readers[-1]
+
+      with mock.patch("openpilot.tools.lib.logreader.LOG_INDEX_CACHE_DIR", cache_dir), \
+           mock.patch("openpilot.tools.lib.logreader.STREAM_CHUNK_SIZE", 1000), \
+           mock.patch("openpilot.tools.lib.logreader.FileReader", side_effect=file_reader), \
+           mock.patch.object(URLFile, "get_version_online", return_value="1") as version_mock:
+        lr = LogReader("https://example.com/rlog", use_index=True)
+        self.assertEqual(lr.first("carParams").to_dict(), {})
+        self.assertEqual(len(readers), 1)
+
+        # the cached index is used without downloading the log, only the data up to the event is read
+        readers.clear()
+        self.assertIsNone(lr.first("liveCalibration"))
+        self.assertEqual(len(readers), 0)
+        self.assertEqual(lr.first("carParams").to_dict(), {})
+        self.assertLess(readers[0].bytes_read, len(dat))
+
+        # the index is rebuilt for a new version of the log
+        readers.clear()
+        version_mock.return_value = "2"
+        self.assertIsNone(lr.first("liveCalibration"))
+        self.assertEqual(len(readers), 1)
+
+        # logs without validators aren't cached
+        readers.clear()
+        version_mock.return_value = None
+        for _ in range(2):
+          self.assertIsNone(lr.first("liveCalibration"))
+        self.assertEqual(len(readers), 2)
+
+  def test_index_rewritten_log(self):
+    with tempfile.NamedTemporaryFile() as rlog, tempfile.TemporaryDirectory() as cache_dir:
+      with mock.patch("openpilot.tools.lib.logreader.LOG_INDEX_CACHE_DIR", cache_dir):
+        for which in ("carState", "carParams"):
+          with open(rlog.name, "wb") as f:
+            f.write(b"".join(capnp_log.Event.new_message(logMonoTime=i, **{which: {}}).to_bytes() for i in range(10)))
+          # the rewrite can land within the mtime granularity of the first write
+          os.utime(rlog.name, ns=(0, 10**9 * len(which)))
+
+          lr = LogReader(rlog.name, use_index=True)
+          self.assertEqual(len(list(lr.filter(which))), 10)
+          self.assertIsNone(lr.first("carState" if which == "carParams" else "carParams"))
+
   def test_only_union_types(self):
     with tempfile.NamedTemporaryFile() as qlog:
       # write valid Event messages
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import os
+import random
+import tempfile
+import unittest
+
+from openpilot.tools.lib.vidindex import HevcNalUnitType, VideoFileInvalid, hevc_index, hevc_index_reference
+
+
+def nal_unit(nal_unit_type: HevcNalUnitType, rbsp: bytes) -> bytes:
+  return b"\x00\x00\x01" + bytes([nal_unit_type << 1, 0x01]) + rbsp
+
+
+def random_rbsp(length: int) -> bytes:
+  # avoid emulating a start code in the payload
+  return os.urandom(length).replace(b"\x00\x00", b"\x00\x03")
+
+
+def synthetic_hevc(num_frames: int, gop_size: int = 20) -> bytes:
+  dat = b"\x00" + nal_unit(HevcNalUnitType.VPS_NUT, random_rbsp(16)) + nal_unit(HevcNalUnitType.SPS_NUT, random_rbsp(32)) + \
+        nal_unit(HevcNalUnitType.PPS_NUT, random_rbsp(8))
+  for i in range(num_frames):
+    if i % gop_size == 0:
+      # first slice, no_output_of_prior_pics, pps id 0, I slice
+      dat += b"\x00" + nal_unit(HevcNalUnitType.IDR_W_RADL, b"\xAC" + random_rbsp(random.randrange(1000)))
+    else:
+      # first slice, pps id 0, P slice
+      dat += b"\x00" + nal_unit(HevcNalUnitType.TRAIL_R, b"\xD0" + random_rbsp(random.randrange(500)))
+      # second slice of the same frame
+      dat += nal_unit(HevcNalUnitType.TRAIL_R, b"\x50" + random_rbsp(random.randrange(100)))
+  return dat
+
+
+class TestVidIndex(unittest.TestCase):
+  def _index_both(self, dat, allow_corrupt=False):
+    with tempfile.NamedTemporaryFile() as f:
+      f.write(dat)
+      f.flush()
+      return hevc_index_reference(f.name, allow_corrupt), hevc_index(f.name, allow_corrupt)
+
+  def test_matches_reference(self):
+    dat = synthetic_hevc(100)
+    reference, fast = self._index_both(dat)
+    self.assertEqual(reference, fast)
+
+    frame_types, dat_len, _ = fast
+    self.assertEqual(len(frame_types), 100)
+    self.assertEqual(dat_len, len(dat))
+    self.assertEqual([t for t, _ in frame_types[:3]], [2, 1, 1])
+
+  def test_corrupt(self):
+    dat = synthetic_hevc(50)
+    for end in (len(dat) // 2, len(dat) - 2):
+      reference, fast = self._index_both(dat[:end], allow_corrupt=True)
+      self.assertEqual(reference, fast)
+
+    with tempfile.NamedTemporaryFile() as f:
+      f.write(b"\x00\x00\x00\x00" + dat)
+      f.flush()
+      for index_fn in (hevc_index_reference, hevc_index):
+        with self.assertRaises(VideoFileInvalid):
+          index_fn(f.name)
+
+
+if __name__ == "__main__":
+  unittest.main()
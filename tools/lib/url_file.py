@@ -69,6 +69,16 @@ class URLFile:
     length = response.headers.get('content-length', 0)
     return int(length)
 
+  def get_version_online(self) -> str | None:
+    # identifies the contents of the remote file by its validators, without downloading it
+    response = self._request('HEAD', self._url)
+    if not (200 <= response.status <= 299):
+      return None
+    validators = [response.headers.get(h, '') for h in ('etag', 'last-modified')]
+    if not any(validators):
+      return None
+    return "_".join([response.headers.get('content-length', ''), *validators])
+
   def get_length(self) -> int:
     if self._length is not None:
       return self._length
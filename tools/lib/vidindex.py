@@ -2,9 +2,12 @@
 import argparse
 import os
 import struct
+import time
 from enum import IntEnum
 
-from openpilot.tools.lib.filereader import FileReader
+import numpy as np
+
+from openpilot.tools.lib.filereader import FileReader, MappedFileReader
 
 DEBUG = int(os.getenv("DEBUG", "0"))
 
@@ -258,7 +261,8 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
     raise VideoFileInvalid("slice_type must be 0, 1, or 2")
   return slice_type, is_first_slice
 
-def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+def hevc_index_reference(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+  # walks the stream one NAL unit at a time, kept to validate and benchmark hevc_index against
   with FileReader(hevc_file_name) as f:
     dat = f.read()
 
@@ -291,13 +295,87 @@ def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, in
 
   return frame_types, len(dat), prefix_dat
 
+def find_nal_unit_starts(dat: bytes) -> np.ndarray:
+  # emulation prevention guarantees the start code never occurs inside a NAL unit, so every
+  # 0x01 byte preceded by two 0x00 bytes is the start of a NAL unit
+  arr = np.frombuffer(dat, dtype=np.uint8)
+  ones = np.flatnonzero(arr[NAL_UNIT_START_CODE_SIZE - 1:] == 0x01)
+  ones = ones[(arr[ones] == 0x00) & (arr[ones + 1] == 0x00)]
+  return ones[ones >= 1]
+
+def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+  with FileReader(hevc_file_name, use_mmap=True) as f:
+    # local files are scanned in place without being read into memory
+    dat = f.view() if isinstance(f, MappedFileReader) else f.read()
+    return _hevc_index(dat, allow_corrupt)
+
+def _hevc_index(dat: bytes | memoryview, allow_corrupt: bool) -> tuple[list, int, bytes]:
+  if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
+    raise VideoFileInvalid("data is too short")
+
+  if dat[0] != 0x00:
+    raise VideoFileInvalid("first byte must be 0x00")
+
+  starts = find_nal_unit_starts(dat)
+  ends = np.append(starts[1:], len(dat))
+
+  # only parameter sets and the slice headers of coded slice segments need to be parsed
+  header_idxs = np.minimum(starts + NAL_UNIT_START_CODE_SIZE, len(dat) - 1)
+  nal_unit_types = (np.frombuffer(dat, dtype=np.uint8)[header_idxs] >> 1) & 0x3F
+
+  prefix_chunks = list()
+  frame_types = list()
+
+  i = 1 # skip past first byte 0x00
+  try:
+    if len(starts) == 0 or starts[0] != i:
+      raise VideoFileInvalid("data must begin with start code")
+
+    for i, end, nal_unit_type in zip(starts.tolist(), ends.tolist(), nal_unit_types.tolist(), strict=True):
+      if i + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE > len(dat):
+        raise VideoFileInvalid("data to short to contain nal unit header")
+
+      if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
+        prefix_chunks.append(dat[i:end])
+      elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
+        slice_type, is_first_slice = get_hevc_slice_type(dat, i, HevcNalUnitType(nal_unit_type))
+        if is_first_slice:
+          frame_types.append((slice_type, i))
+  except Exception as e:
+    if not allow_corrupt:
+      raise
+    print(f"ERROR: NAL unit skipped @ {i}\n", str(e))
+
+  return frame_types, len(dat), b"".join(prefix_chunks)
+
+def benchmark(hevc_file_name: str, runs: int = 3) -> None:
+  results = {}
+  for name, index_fn in (("reference", hevc_index_reference), ("fast", hevc_index)):
+    times = []
+    for _ in range(runs):
+      t = time.perf_counter()
+      results[name] = index_fn(hevc_file_name)
+      times.append(time.perf_counter() - t)
+    print(f"{name:>10}: {min(times) * 1000:.1f} ms (best of {runs})")
+
+  assert results["reference"] == results["fast"], "index mismatch"
+  print(f"{len(results['fast'][0])} frames, indexes match")
+
 def main() -> None:
   parser = argparse.ArgumentParser()
   parser.add_argument("input_file", type=str)
-  parser.add_argument("output_prefix_file", type=str)
-  parser.add_argument("output_index_file", type=str)
+  parser.add_argument("output_prefix_file", type=str, nargs="?")
+  parser.add_argument("output_index_file", type=str, nargs="?")
+  parser.add_argument("--benchmark", action="store_true", help="time against the reference indexer instead of writing outputs")
   args = parser.parse_args()
 
+  if args.benchmark:
+    benchmark(args.input_file)
+    return
+
+  if args.output_prefix_file is None or args.output_index_file is None:
+    parser.error("output_prefix_file and output_index_file are required")
+
   frame_types, dat_len, prefix_dat = hevc_index(args.input_file)
   with open(args.output_prefix_file, "wb") as f:
     f.write(prefix_dat)
@@ -10,9 +10,9 @@ import requests
 import argparse
 from functools import partial
 
+from cereal import log as capnp_log
 from openpilot.common.basedir import BASEDIR
 from openpilot.selfdrive.car.fingerprints import MIGRATION
-from openpilot.tools.lib.helpers import save_log
 from openpilot.tools.lib.logreader import LogReader, ReadMode
 
 juggle_dir = os.path.dirname(os.path.realpath(__file__))
@@ -78,22 +78,23 @@ def process(can, lr):
 def juggle_route(route_or_segment_name, can, layout, dbc=None):
   sr = LogReader(route_or_segment_name, default_mode=ReadMode.AUTO_INTERACTIVE)
 
-  all_data = sr.run_across_segments(24, partial(process, can))
-
-  # Infer DBC name from logs
-  if dbc is None:
-    for cp in [m for m in all_data if m.which() == 'carParams']:
+  with tempfile.NamedTemporaryFile(suffix='.rlog', dir=juggle_dir) as tmp:
+    # segments are written as they come in, and only parsed in this process until the first carParams
+    CP = None
+    for dat in sr.stream_across_segments(24, partial(process, can), raw=True):
+      if dbc is None and CP is None:
+        CP = next((m.carParams for m in capnp_log.Event.read_multiple_bytes(dat) if m.which() == 'carParams'), None)
+      tmp.write(dat)
+    tmp.flush()
+
+    # Infer DBC name from logs
+    if CP is not None:
       try:
-        DBC = __import__(f"openpilot.selfdrive.car.{cp.carParams.carName}.values", fromlist=['DBC']).DBC
-        fingerprint = cp.carParams.carFingerprint
-        dbc = DBC[MIGRATION.get(fingerprint, fingerprint)]['pt']
+        DBC = __import__(f"openpilot.selfdrive.car.{CP.carName}.values", fromlist=['DBC']).DBC
+        dbc = DBC[MIGRATION.get(CP.carFingerprint, CP.carFingerprint)]['pt']
       except Exception:
         pass
-      break
 
-  with tempfile.NamedTemporaryFile(suffix='.rlog', dir=juggle_dir) as tmp:
-    save_log(tmp.name, all_data, compress=False)
-    del all_data
     start_juggler(tmp.name, dbc, layout, route_or_segment_name)
 
 